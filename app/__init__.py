@@ -10,7 +10,9 @@ from app.utils.models import db, User, ServiceProvider, ensure_schema
 from app.utils.config_manager import config_manager
 from app.utils.logger_main import logger
 from app.utils.path_config import BASE_DIR
+from app.utils import aaa_directory, compression
 from app.utils.extensions import limiter
+from app.utils.sp_registry import sp_registry
 
 csrf = CSRFProtect()
 
@@ -359,6 +361,8 @@ def _init_database():
         if config_manager.scim_enabled():
             from app.routes.scim.bootstrap import seed_default_scim_data
             seed_default_scim_data()
+        # Seeding / migrations may have written SPs behind the registry's back.
+        sp_registry.invalidate()
     finally:
         lock_file.close()  # closing the fd releases the flock
 
@@ -383,6 +387,10 @@ def create_app(init_db=True):
     logger.info("Database file: %s", DB_FILE)
 
     db.init_app(app)
+    # Registered first so it runs after every other after_request hook.
+    compression.init_app(app)
+    # Every process that writes users / groups / MFA bumps the AAA snapshot.
+    aaa_directory.init_app(app)
     csrf.init_app(app)
     limiter.init_app(app)
 
@@ -430,8 +438,12 @@ def create_app(init_db=True):
         # SP-initiated SSO may arrive via the HTTP-POST binding (AuthnRequest in
         # a form with no Flask CSRF token). Exempt just the /sso view; /login
         # keeps CSRF protection (it's a browser form that includes the token).
+        # The loopback ACS, the SOAP /artifact back channel and /slo are
+        # likewise called by an SP, not by one of our own forms.
         csrf.exempt(app.view_functions['auth.sso'])
         csrf.exempt(app.view_functions['auth.saml_test_acs'])
+        csrf.exempt(app.view_functions['auth.artifact_resolve'])
+        csrf.exempt(app.view_functions['auth.single_logout'])
 
         # SCIM models are always imported so their tables exist; the SCIM
         # feature itself is gated at runtime by config_manager.scim_enabled().
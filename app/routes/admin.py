@@ -1,11 +1,22 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, session, jsonify
-from app.utils.models import db, User, ServiceProvider
+from flask import (Blueprint, Response, render_template, request, redirect, url_for, flash, session,
+                   jsonify, stream_with_context)
+from app.utils.models import (db, User, ServiceProvider, SIGNING_SCOPES, DEFAULT_SIGNING_SCOPE,
+                              RESPONSE_BINDINGS, DEFAULT_RESPONSE_BINDING, SLO_BINDINGS,
+                              DEFAULT_SLO_BINDING)
 from app.utils.models_scim import ScimGroup, ScimGroupMember
 from app.utils.config_manager import config_manager
 from app.utils.extensions import limiter
 from app.utils.activity import record
+from app.utils.claims import invalidate_claim_plan
+from app.utils.request_signing import invalidate_sp_key, normalize_certs
+from app.utils.sp_metadata import (MAX_METADATA_BYTES, SPMetadataError, fetch_metadata,
+                                   forget_source, import_fields, metadata_digest,
+                                   parsed_metadata, refresh_sp)
+from app.utils.sp_registry import sp_registry
 from werkzeug.security import generate_password_hash
 import json
+import time
+from datetime import datetime
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
 
@@ -25,6 +36,68 @@ def _ids_from_form(field):
     return [int(x) for x in request.form.getlist(field) if x.isdigit()]
 
 
+def _signing_scope_from_form(default=DEFAULT_SIGNING_SCOPE):
+    """The submitted SP signing scope, or `default` if missing/unknown."""
+    scope = request.form.get('signing_scope')
+    return scope if scope in SIGNING_SCOPES else default
+
+
+def _response_binding_from_form(default=DEFAULT_RESPONSE_BINDING):
+    """The submitted SP response binding, or `default` if missing/unknown."""
+    binding = request.form.get('response_binding')
+    return binding if binding in RESPONSE_BINDINGS else default
+
+
+def _slo_from_form(default_binding=DEFAULT_SLO_BINDING):
+    """(slo_url or None, slo_binding) from the SP form."""
+    binding = request.form.get('slo_binding')
+    return ((request.form.get('slo_url') or '').strip() or None,
+            binding if binding in SLO_BINDINGS else default_binding)
+
+
+def _request_signing_from_form():
+    """(signing_cert PEM or None, authn_requests_signed) from the SP form.
+
+    An uploaded SP metadata file supplies the certificate and can turn on
+    AuthnRequestsSigned; otherwise the pasted certificate is used. Raises
+    ValueError (with an admin-readable message) on a bad cert or metadata."""
+    required = request.form.get('authn_requests_signed') == 'on'
+    cert = None
+    upload = request.files.get('sp_metadata')
+    if upload and upload.filename:
+        data = upload.read(MAX_METADATA_BYTES + 1)
+        if len(data) > MAX_METADATA_BYTES:
+            raise ValueError('SP metadata file is too large')
+        meta = parsed_metadata(data)
+        cert = ''.join(meta['signing_certs']) or None
+        required = required or meta['authn_requests_signed']
+    if cert is None:
+        text = (request.form.get('signing_cert') or '').strip()
+        cert = normalize_certs(text) if text else None
+    if required and cert is None:
+        raise ValueError("requiring signed AuthnRequests needs the SP's signing certificate")
+    return cert, required
+
+
+def _metadata_from_form():
+    """(document bytes, etag, last_modified, url) for the SP metadata import —
+    fetched from the submitted URL, else read from the uploaded file.
+    Raises ValueError."""
+    url = (request.form.get('metadata_url') or '').strip()
+    if url:
+        if not url.startswith(('https://', 'http://')):
+            raise ValueError('metadata URL must be http(s)')
+        body, etag, last_modified = fetch_metadata(url, timeout=config_manager.SP_METADATA_TIMEOUT)
+        return body, etag, last_modified, url
+    upload = request.files.get('sp_metadata')
+    if not (upload and upload.filename):
+        raise ValueError('give a metadata URL or upload a metadata file')
+    data = upload.read(MAX_METADATA_BYTES + 1)
+    if len(data) > MAX_METADATA_BYTES:
+        raise ValueError('SP metadata file is too large')
+    return data, None, None, None
+
+
 def _reconcile_group_members(group, desired_user_ids):
     """Make `group`'s membership exactly `desired_user_ids` (User.id values).
     Adds missing links, removes the rest. Caller commits."""
@@ -61,6 +134,87 @@ def dashboard():
         config=config_manager.get_all_config(),
     )
 
+@admin_bp.route('/api/signing-pool', methods=['GET'])
+@admin_required
+def signing_pool_stats():
+    """SAML signing-pool metrics for this worker (queue wait vs. sign time)."""
+    from app.utils import signing_pool
+    return jsonify(signing_pool.stats())
+
+
+@admin_bp.route('/api/mint', methods=['POST'])
+@admin_required
+def mint_assertions():
+    """Bulk-mint signed SAML Responses for load-testing an SP, streamed as
+    NDJSON: one {"seq", "user", "sp", "acs_url", "saml_response"} line per
+    Response, then a {"done": true, ...} summary line.
+
+    JSON body: {"sp": entity ID or id, "count": N (at most MINT_HTTP_MAX_COUNT),
+                "users": [usernames] (default: all active users)}
+
+    Signs inline in this worker rather than forking a pool per request;
+    larger runs belong to the `python -m app.services.mint` CLI."""
+    from app.utils.claims import claim_plan
+    from app.utils.minting import MintError, mint, resolve_users, summary
+    from app.utils.saml import IdPHandler
+
+    body = request.get_json(silent=True) or {}
+    sp_key = body.get('sp')
+    sp = sp_registry.get(sp_key) if isinstance(sp_key, int) else sp_registry.by_entity_id(sp_key)
+    if sp is None:
+        return jsonify({'error': f'unknown Service Provider {sp_key!r}'}), 404
+    acs_url = sp.acs_url
+    if acs_url.startswith('/'):
+        acs_url = request.url_root.rstrip('/') + acs_url
+    try:
+        count = int(body.get('count', 1))
+        if count > config_manager.MINT_HTTP_MAX_COUNT:
+            raise MintError(f"count is limited to {config_manager.MINT_HTTP_MAX_COUNT} over HTTP; "
+                            "use `python -m app.services.mint` for bulk runs")
+        users = resolve_users(claim_plan(sp), body.get('users'))
+        rows = mint(IdPHandler(), sp, users, count, acs_url=acs_url, processes=0)
+    except (MintError, TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    record('saml', 'Minted SAML assertions', target=sp.name or sp.entity_id,
+           detail={'count': count, 'users': len(users)})
+
+    def generate():
+        started, minted = time.perf_counter(), 0
+        for row in rows:
+            minted += 1
+            yield json.dumps(row) + "\n"
+        yield json.dumps(summary(minted, started)) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@admin_bp.route('/api/artifacts', methods=['GET'])
+@admin_required
+def artifact_stats():
+    """HTTP-Artifact store metrics: live size plus this worker's counters."""
+    from app.utils.artifacts import artifact_store
+    return jsonify(artifact_store.stats())
+
+
+@admin_bp.route('/api/replay-cache', methods=['GET'])
+@admin_required
+def replay_cache_stats():
+    """AuthnRequest replay cache metrics: live size plus this worker's counters."""
+    from app.utils.replay_cache import replay_cache
+    return jsonify(replay_cache.stats())
+
+
+@admin_bp.route('/api/aaa-stats', methods=['GET'])
+@admin_required
+def aaa_stats():
+    """The AAA process's latest counters (log writer, RADIUS listeners and MFA
+    challenges, AAA directory), as it last wrote them to disk."""
+    from app.services.runner import STATS_FILE
+    try:
+        return jsonify(json.loads(STATS_FILE.read_text()))
+    except (OSError, ValueError):
+        return jsonify({'error': 'the AAA process has not published stats yet'}), 404
+
 @admin_bp.route('/settings')
 @admin_required
 def settings():
@@ -303,7 +457,9 @@ def delete_group(group_pk):
 def list_sps():
     sps = ServiceProvider.query.all()
     user_fields = User.get_editable_user_fields()
-    return render_template('admin/sp_list.html', sps=sps, user_fields=user_fields)
+    return render_template('admin/sp_list.html', sps=sps, user_fields=user_fields,
+                           signing_scopes=SIGNING_SCOPES, response_bindings=RESPONSE_BINDINGS,
+                           slo_bindings=SLO_BINDINGS)
 
 @admin_bp.route('/service-providers/add', methods=['POST'])
 @admin_required
@@ -325,27 +481,119 @@ def create_sp():
     if ServiceProvider.query.filter_by(entity_id=entity_id).first():
         flash('Service Provider with this Entity ID already exists', 'error')
         return redirect(url_for('admin.list_sps'))
+    try:
+        signing_cert, authn_requests_signed = _request_signing_from_form()
+    except ValueError as e:
+        flash(f'Invalid request signing settings: {e}', 'error')
+        return redirect(url_for('admin.list_sps'))
+    slo_url, slo_binding = _slo_from_form()
     
     sp = ServiceProvider(
         name=name,
         entity_id=entity_id,
         acs_url=acs_url,
-        attr_map=attr_map
+        attr_map=attr_map,
+        signing_scope=_signing_scope_from_form(),
+        response_binding=_response_binding_from_form(),
+        signing_cert=signing_cert,
+        authn_requests_signed=authn_requests_signed,
+        slo_url=slo_url,
+        slo_binding=slo_binding,
     )
     db.session.add(sp)
     db.session.commit()
-    record('service_provider', 'Created Service Provider', target=name, detail={'entity_id': entity_id, 'acs_url': acs_url})
+    sp_registry.invalidate()
+    record('service_provider', 'Created Service Provider', target=name,
+           detail={'entity_id': entity_id, 'acs_url': acs_url, 'signing_scope': sp.signing_scope,
+                   'response_binding': sp.response_binding,
+                   'authn_requests_signed': sp.authn_requests_signed,
+                   'signing_cert': bool(signing_cert)})
     flash('Service Provider added successfully', 'success')
     return redirect(url_for('admin.list_sps'))
 
+@admin_bp.route('/service-providers/import', methods=['POST'])
+@admin_required
+def import_sp():
+    """Create a Service Provider from its SAML metadata (URL or file). With a
+    URL and auto-refresh on, the AAA runner keeps it in sync from then on."""
+    try:
+        body, etag, last_modified, url = _metadata_from_form()
+        digest = metadata_digest(body)
+        meta = parsed_metadata(body, digest)
+        fields = import_fields(meta)
+    except ValueError as e:  # SPMetadataError included
+        flash(f'Could not import SP metadata: {e}', 'error')
+        return redirect(url_for('admin.list_sps'))
+    if ServiceProvider.query.filter_by(entity_id=fields['entity_id']).first():
+        flash('Service Provider with this Entity ID already exists', 'error')
+        return redirect(url_for('admin.list_sps'))
+
+    auto_refresh = bool(url) and request.form.get('auto_refresh') == 'on'
+    name = (request.form.get('name') or '').strip() or fields['entity_id']
+    sp = ServiceProvider(
+        name=name,
+        metadata_url=url if auto_refresh else None,
+        metadata_etag=etag, metadata_last_modified=last_modified,
+        metadata_digest=digest, metadata_updated_at=datetime.utcnow(),
+        **fields,
+    )
+    db.session.add(sp)
+    db.session.commit()
+    sp_registry.invalidate()
+    record('service_provider', 'Imported Service Provider', target=name,
+           detail={'entity_id': sp.entity_id, 'acs_url': sp.acs_url, 'source': url or 'file',
+                   'auto_refresh': auto_refresh, 'signing_scope': sp.signing_scope,
+                   'response_binding': sp.response_binding,
+                   'authn_requests_signed': sp.authn_requests_signed})
+    flash(f'Service Provider imported from metadata ({sp.entity_id})', 'success')
+    if meta['nameid_formats'] and not sp.nameid_format:
+        flash('The SP lists only NameID formats this IdP cannot issue '
+              f'({", ".join(meta["nameid_formats"])}); it will be sent an emailAddress NameID.',
+              'warning')
+    return redirect(url_for('admin.list_sps'))
+
+@admin_bp.route('/service-providers/<int:sp_id>/refresh-metadata')
+@admin_required
+def refresh_sp_metadata(sp_id):
+    """Re-fetch an auto-refreshed SP's metadata now (unconditionally)."""
+    sp = ServiceProvider.query.get_or_404(sp_id)
+    if not sp.metadata_url:
+        flash('This Service Provider has no metadata URL', 'error')
+        return redirect(url_for('admin.list_sps'))
+    try:
+        outcome, _ = refresh_sp(sp, force=True)
+    except SPMetadataError as e:
+        db.session.rollback()
+        flash(f'Metadata refresh failed: {e}', 'error')
+        return redirect(url_for('admin.list_sps'))
+    flash('Metadata refreshed: ' + ('changes applied' if outcome == 'updated' else 'no changes'),
+          'success')
+    return redirect(url_for('admin.list_sps'))
+
 @admin_bp.route('/service-providers/<int:sp_id>/edit', methods=['POST'])
 @admin_required
 def edit_sp(sp_id):
     sp = ServiceProvider.query.get_or_404(sp_id)
+    try:
+        signing_cert, authn_requests_signed = _request_signing_from_form()
+    except ValueError as e:
+        flash(f'Invalid request signing settings: {e}', 'error')
+        return redirect(url_for('admin.list_sps'))
     
     sp.name = request.form.get('name', sp.name)
     sp.entity_id = request.form.get('entity_id', sp.entity_id)
     sp.acs_url = request.form.get('acs_url', sp.acs_url)
+    sp.signing_scope = _signing_scope_from_form(sp.signing_scope)
+    sp.response_binding = _response_binding_from_form(sp.response_binding)
+    sp.signing_cert = signing_cert
+    sp.authn_requests_signed = authn_requests_signed
+    sp.slo_url, sp.slo_binding = _slo_from_form(sp.slo_binding)
+    metadata_url = (request.form.get('metadata_url') or '').strip() or None
+    if metadata_url != sp.metadata_url:
+        # New source: drop the old validators so the next refresh re-applies.
+        sp.metadata_url = metadata_url
+        sp.metadata_etag = sp.metadata_last_modified = sp.metadata_digest = None
+        forget_source(sp.id)
     
     # Parse attribute mappings
     attr_map = []
@@ -359,6 +607,9 @@ def edit_sp(sp_id):
     sp.attr_map = attr_map
     
     db.session.commit()
+    invalidate_claim_plan(sp.id)
+    invalidate_sp_key(sp.id)
+    sp_registry.invalidate()
     record('service_provider', 'Updated Service Provider', target=sp.name)
     flash('Service Provider updated successfully', 'success')
     return redirect(url_for('admin.list_sps'))
@@ -370,6 +621,10 @@ def delete_sp(sp_id):
     sp_name = sp.name
     db.session.delete(sp)
     db.session.commit()
+    invalidate_claim_plan(sp_id)
+    invalidate_sp_key(sp_id)
+    forget_source(sp_id)
+    sp_registry.invalidate()
     record('service_provider', 'Deleted Service Provider', target=sp_name)
     flash('Service Provider deleted successfully', 'success')
     return redirect(url_for('admin.list_sps'))
@@ -384,7 +639,16 @@ def get_sp_api(sp_id):
         'name': sp.name or '',
         'entity_id': sp.entity_id,
         'acs_url': sp.acs_url,
-        'attr_map': sp.attr_map or []
+        'attr_map': sp.attr_map or [],
+        'signing_scope': sp.signing_scope or DEFAULT_SIGNING_SCOPE,
+        'response_binding': sp.response_binding or DEFAULT_RESPONSE_BINDING,
+        'signing_cert': sp.signing_cert or '',
+        'authn_requests_signed': bool(sp.authn_requests_signed),
+        'nameid_format': sp.nameid_format or '',
+        'slo_url': sp.slo_url or '',
+        'slo_binding': sp.slo_binding or DEFAULT_SLO_BINDING,
+        'metadata_url': sp.metadata_url or '',
+        'metadata_updated_at': sp.metadata_updated_at.isoformat() if sp.metadata_updated_at else None,
     })
 
 @admin_bp.route('/api/service-providers/<int:sp_id>/xml', methods=['GET'])
@@ -395,7 +659,8 @@ def get_sp_xml(sp_id):
     sp = ServiceProvider.query.get_or_404(sp_id)
     
     # Generate SP metadata XML
-    nameid_format = "urn:oasis:names:tc:SAML:1.1:nameid-format:emailAddress"
+    from app.utils.saml import issued_nameid_format
+    nameid_format = issued_nameid_format(sp.nameid_format)
     
     attr_statements = ""
     if sp.attr_map:
@@ -404,13 +669,29 @@ def get_sp_xml(sp_id):
             for attr in sp.attr_map
         ])
     
+    key_descriptor = ""
+    if sp.signing_cert:
+        cert_body = "".join(l for l in sp.signing_cert.splitlines() if l and not l.startswith("-----"))
+        key_descriptor = f'''
+        <md:KeyDescriptor use="signing">
+            <ds:KeyInfo xmlns:ds="http://www.w3.org/2000/09/xmldsig#">
+                <ds:X509Data><ds:X509Certificate>{cert_body}</ds:X509Certificate></ds:X509Data>
+            </ds:KeyInfo>
+        </md:KeyDescriptor>'''
+    
+    slo_service = ""
+    if sp.slo_url:
+        slo_service = f'''
+        <md:SingleLogoutService Binding="urn:oasis:names:tc:SAML:2.0:bindings:{SLO_BINDINGS.get(sp.slo_binding, 'HTTP-Redirect')}"
+                                Location="{sp.slo_url}"/>'''
+    
     xml = f'''<?xml version="1.0" encoding="UTF-8"?>
 <md:EntityDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata"
                      entityID="{sp.entity_id}">
-    <md:SPSSODescriptor AuthnRequestsSigned="false" WantAssertionsSigned="true"
-                        protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+    <md:SPSSODescriptor AuthnRequestsSigned="{'true' if sp.authn_requests_signed else 'false'}" WantAssertionsSigned="{'true' if sp.want_assertions_signed else 'false'}"
+                        protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">{key_descriptor}{slo_service}
         <md:NameIDFormat>{nameid_format}</md:NameIDFormat>
-        <md:AssertionConsumerService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST"
+        <md:AssertionConsumerService Binding="urn:oasis:names:tc:SAML:2.0:bindings:{RESPONSE_BINDINGS.get(sp.response_binding, 'HTTP-POST')}"
                                      Location="{sp.acs_url}"
                                      index="0" isDefault="true"/>
         <md:AttributeConsumingService index="0">
@@ -1,11 +1,25 @@
 import base64
+import time
+from datetime import datetime
+from urllib.parse import urlencode
 
-from flask import Blueprint, request, render_template, session
+from flask import Blueprint, Response, current_app, redirect, request, render_template, session
+from flask_wtf.csrf import ValidationError, validate_csrf
 from lxml import etree
-
-from app.utils.saml import IdPHandler
+from app.utils import slo
+from app.utils.artifacts import ArtifactTooLarge, artifact_store
+from app.utils.claims import EMPTY_PLAN, claim_plan
+from app.utils.config_manager import config_manager
+from app.utils.logger_main import logger
+from app.utils.replay_cache import replay_cache
+from app.utils.request_signing import (RequestSignatureError, check_artifact_resolve,
+                                       check_authn_request, check_logout_request)
+from app.utils.saml import (BINDING_ARTIFACT, SAMLP_NS, IdPHandler, SAMLRequestTooLarge,
+                            STATUS_NO_PASSIVE, STATUS_PARTIAL_LOGOUT, STATUS_RESPONDER,
+                            STATUS_SUCCESS, issued_nameid_format, parse_xml)
+from app.utils.signing_pool import SigningPoolBusy, SigningPoolTimeout
 from app.utils.user_manager import UserManager
-from app.utils.models import ServiceProvider
+from app.utils.sp_registry import sp_registry
 from app.utils.extensions import limiter
 from app.utils.activity import record
 
@@ -13,11 +27,44 @@ auth_bp = Blueprint('auth', __name__)
 saml_handler = IdPHandler()
 
 
+def _session_user(plan=EMPTY_PLAN):
+    """The user of a live IdP session, or None.
+
+    A password login at /login opens the session; it stays valid for
+    IDP_SESSION_LIFETIME minutes, and only while the account is still active
+    (a SCIM deprovision ends it at the next SSO). The user is loaded through
+    `plan` so the groups its claims need come in the same query."""
+    lifetime = config_manager.IDP_SESSION_LIFETIME
+    user_id, auth_at = session.get('user_id'), session.get('idp_auth_at')
+    if not (lifetime and user_id and auth_at) or time.time() - auth_at > lifetime * 60:
+        return None
+    user = plan.load_user(id=user_id)
+    return user if user is not None and user.active else None
+
+
+def _absolute_acs(acs_url):
+    # A relative ACS (the built-in /saml-test/acs loopback) resolves to this
+    # deployment's own host, so the test works on any deploy without config.
+    if acs_url.startswith("/"):
+        return request.url_root.rstrip("/") + acs_url
+    return acs_url
+
+
+def _response_binding(sp, protocol_binding=None):
+    """"artifact" if the AuthnRequest asked for HTTP-Artifact or the SP is
+    configured for it; otherwise "post"."""
+    if protocol_binding == BINDING_ARTIFACT:
+        return "artifact"
+    return sp.response_binding if sp and sp.response_binding else "post"
+
+
 @auth_bp.route('/sso', methods=['GET', 'POST'])
 def sso():
     """SP-initiated SSO entry point. Accepts the AuthnRequest over either
-    binding (Redirect=GET, POST=form), resolves the requesting SP, stashes the
-    SAML context in the session, and shows the login form."""
+    binding (Redirect=GET, POST=form), resolves the requesting SP, enforces its
+    AuthnRequest signing policy, stashes the SAML context in the session, and
+    shows the login form — or, with a live IdP session and no ForceAuthn,
+    answers the SP straight away."""
     saml_request = request.args.get('SAMLRequest') or request.form.get('SAMLRequest')
     relay_state = request.args.get('RelayState') or request.form.get('RelayState')
     if not saml_request:
@@ -25,6 +72,8 @@ def sso():
 
     try:
         parsed = saml_handler.parse_request(saml_request)
+    except SAMLRequestTooLarge:
+        return "SAMLRequest too large", 413
     except Exception:
         # Malformed/unsupported request — fall back to a contextless login so a
         # human can still demo, but without an SP we can't build a response.
@@ -32,7 +81,30 @@ def sso():
 
     sp = None
     if parsed.get("issuer"):
-        sp = ServiceProvider.query.filter_by(entity_id=parsed["issuer"]).first()
+        sp = sp_registry.by_entity_id(parsed["issuer"])
+    if sp is not None:
+        # Redirect binding signs the query string; POST signs the XML.
+        query_string = request.query_string if request.args.get('SAMLRequest') else None
+        try:
+            signed = check_authn_request(sp, parsed["root"], query_string)
+        except RequestSignatureError as e:
+            logger.warning("Rejected AuthnRequest from %s: %s", sp.entity_id, e)
+            record('saml', 'Rejected AuthnRequest', target=sp.name or sp.entity_id,
+                   status='error', detail={'sp': sp.entity_id, 'reason': str(e)})
+            return "AuthnRequest signature verification failed", 403
+        if signed is not parsed["root"]:
+            parsed = saml_handler.request_fields(signed)
+
+    # Each AuthnRequest is answered at most once (claimed in _issue_response);
+    # refuse stale and already-answered ones before showing a login form.
+    if parsed.get("request_id"):
+        if replay_cache.is_stale(parsed.get("issue_instant")):
+            return ("This sign-in request has expired. Start single sign-on "
+                    "again from your Service Provider.", 400)
+        if replay_cache.seen(parsed.get("issuer"), parsed["request_id"]):
+            logger.warning("Replayed AuthnRequest %s from %s", parsed["request_id"], parsed.get("issuer"))
+            return ("This sign-in request has already been used. Start single "
+                    "sign-on again from your Service Provider.", 400)
 
     # The SP's configured ACS is authoritative; fall back to the request's ACS.
     acs_url = sp.acs_url if sp else parsed.get("acs_url")
@@ -43,7 +115,21 @@ def sso():
         "acs_url": acs_url,
         "relay_state": relay_state,
         "sp_id": sp.id if sp else None,
+        "binding": _response_binding(sp, parsed.get("protocol_binding")),
     }
+    # The session and IsPassive shortcuts answer without a prompt, so they
+    # only ever post to a registered SP's own ACS. An unregistered issuer
+    # names its ACS itself: it gets the interactive login, never a silent
+    # Response.
+    if sp is not None:
+        user = None if parsed.get("force_authn") else _session_user(claim_plan(sp))
+        if user is not None:
+            return _issue_response(user, session['saml_ctx'], sp, via='session')
+        if parsed.get("is_passive"):
+            return _no_passive_response(session['saml_ctx'])
+    elif parsed.get("is_passive"):
+        session.pop('saml_ctx', None)
+        return "IsPassive AuthnRequest from an unregistered Service Provider", 400
     return render_template('auth/login.html', sp_name=(sp.name if sp else None))
 
 
@@ -53,56 +139,218 @@ def login():
     username = request.form.get('username')
     password = request.form.get('password')
 
-    user = UserManager.get_user_by_username(username)
+    ctx = session.get('saml_ctx')
+    sp = sp_registry.get(ctx["sp_id"]) if ctx and ctx.get("sp_id") else None
+
+    # One query: the user plus whatever groups this SP's claims project.
+    user = claim_plan(sp).load_user(username=username)
     if not (user and UserManager.verify_password(user, password)):
         return "Invalid credentials", 401
 
+    if session.get('user_id') != user.id:
+        session.pop('idp_sid', None)  # another user: a new IdP session for SLO
     session['user_id'] = user.id
+    session['idp_auth_at'] = time.time()
 
-    ctx = session.get('saml_ctx')
     if not ctx or not ctx.get('acs_url'):
         return ("No active SAML request. Start single sign-on from your "
                 "Service Provider.", 400)
+    return _issue_response(user, ctx, sp, via='password')
 
-    # Build the per-SP claim set from the configured attribute mapping.
-    attributes = {}
-    sp = ServiceProvider.query.get(ctx["sp_id"]) if ctx.get("sp_id") else None
-    if sp and sp.attr_map:
-        for mapping in sp.attr_map:
-            claim = mapping.get("claim")
-            field = mapping.get("value")
-            if not claim or not field:
-                continue
-            val = getattr(user, field, None)
-            if val is None:
-                continue
-            attributes[claim] = val if isinstance(val, list) else [val]
 
-    # A relative ACS (the built-in /saml-test/acs loopback) resolves to this
-    # deployment's own host, so the test works on any deploy without config.
-    acs_url = ctx["acs_url"]
-    if acs_url.startswith("/"):
-        acs_url = request.url_root.rstrip("/") + acs_url
+def _issue_response(user, ctx, sp, via):
+    """Build and sign the Response for `ctx` on behalf of `user`, then deliver
+    it: auto-POST (HTTP-POST) or a redirect carrying only an artifact
+    (HTTP-Artifact). The SP is recorded as a participant of the IdP session,
+    for Single Logout. `via` ("password" / "session") is recorded in the
+    audit trail."""
+    # The per-SP claim set, from the SP's compiled attribute mapping.
+    attributes = claim_plan(sp).resolve(user)
 
+    acs_url = _absolute_acs(ctx["acs_url"])
     user_info = {"email": user.email, "attributes": attributes}
-    sp_info = {"entity_id": ctx.get("sp_entity_id") or "", "acs_url": acs_url}
+    sp_info = {"entity_id": ctx.get("sp_entity_id") or "", "acs_url": acs_url,
+               "signing_scope": sp.signing_scope if sp else None,
+               "nameid_format": sp.nameid_format if sp else None}
 
-    saml_response = saml_handler.build_response(
-        user_info, sp_info, request_id=ctx.get("request_id"),
-    )
+    sid = session.setdefault('idp_sid', slo.new_session_id())
+    request_id = ctx.get("request_id")
+    if request_id and not replay_cache.claim(ctx.get("sp_entity_id"), request_id):
+        # Another tab / worker already answered this AuthnRequest.
+        session.pop('saml_ctx', None)
+        record('saml', 'Refused replayed AuthnRequest', target=user.username, status='error',
+               detail={'sp': sp_info['entity_id'], 'request_id': request_id}, actor=user.username)
+        return ("This sign-in request has already been used. Start single "
+                "sign-on again from your Service Provider.", 400)
+    try:
+        xml_bytes = saml_handler.build_response_xml(
+            user_info, sp_info, request_id=request_id,
+            authn_instant=datetime.utcfromtimestamp(session['idp_auth_at']),
+            session_index=slo.session_index(sid, sp.id) if sp else None,
+        )
+    except SigningPoolBusy as e:
+        # Login storm: the signing pool is saturated, or didn't sign in time
+        # (SigningPoolTimeout). Shed load rather than queue; the SAML context
+        # stays in the session (and the request ID is released) so a retry works.
+        if isinstance(e, SigningPoolTimeout):
+            logger.warning("SAML signing pool timed out for %s: %s", user.username, e)
+        if request_id:
+            replay_cache.release(ctx.get("sp_entity_id"), request_id)
+        return ("The identity provider is busy. Please try again in a moment.",
+                503, {"Retry-After": "2"})
+    except Exception:
+        # Nothing was sent, so the AuthnRequest may still be answered.
+        if request_id:
+            replay_cache.release(ctx.get("sp_entity_id"), request_id)
+        raise
     relay_state = ctx.get("relay_state")
     session.pop('saml_ctx', None)
+    if sp is not None:
+        slo.record_participant(sid, user.id, sp, user.email,
+                               issued_nameid_format(sp.nameid_format))
+
+    artifact = None
+    if ctx.get("binding") == "artifact":
+        try:
+            artifact = artifact_store.issue(xml_bytes, sp_info["entity_id"])
+        except ArtifactTooLarge as e:
+            logger.warning("%s; delivering by HTTP-POST instead", e)
     record('saml', 'Issued SAML assertion', target=user.username,
-           detail={'sp': sp_info.get('entity_id'), 'acs': acs_url}, actor=user.username)
+           detail={'sp': sp_info.get('entity_id'), 'acs': acs_url, 'auth': via,
+                   'binding': 'artifact' if artifact else 'post'},
+           actor=user.username)
+
+    if artifact:
+        params = {"SAMLart": artifact}
+        if relay_state:
+            params["RelayState"] = relay_state
+        return redirect(acs_url + ("&" if "?" in acs_url else "?") + urlencode(params))
+    return render_template(
+        'auth/saml_post.html',
+        saml_response=base64.b64encode(xml_bytes).decode("ascii"),
+        acs_url=acs_url,
+        relay_state=relay_state,
+    )
 
+
+def _no_passive_response(ctx):
+    """IsPassive request without a live session: we may not prompt, so answer
+    the SP with a signed Responder/NoPassive status instead."""
+    acs_url = _absolute_acs(ctx["acs_url"])
+    saml_response = saml_handler.build_status_response(
+        {"entity_id": ctx.get("sp_entity_id") or "", "acs_url": acs_url},
+        STATUS_RESPONDER, STATUS_NO_PASSIVE, request_id=ctx.get("request_id"),
+    )
+    session.pop('saml_ctx', None)
     return render_template(
         'auth/saml_post.html',
         saml_response=saml_response,
         acs_url=acs_url,
+        relay_state=ctx.get("relay_state"),
+    )
+
+
+def _end_idp_session():
+    """Forget this browser's IdP login (and any pending SAML context)."""
+    for key in ('user_id', 'idp_auth_at', 'idp_sid', 'saml_ctx'):
+        session.pop(key, None)
+
+
+@auth_bp.route('/slo', methods=['GET', 'POST'])
+def single_logout():
+    """SAML Single Logout. With an SP's LogoutRequest (HTTP-Redirect = GET,
+    HTTP-POST = form): end that IdP session, notify every other participating
+    SP (app.utils.slo), and answer the SP with a LogoutResponse over the same
+    binding. Without one: IdP-initiated logout of this browser's session,
+    which GET only confirms — the logout itself is a POST with a CSRF token,
+    so a cross-site link or image can't sign the user out."""
+    saml_request = request.args.get('SAMLRequest') or request.form.get('SAMLRequest')
+    relay_state = request.args.get('RelayState') or request.form.get('RelayState')
+    if not saml_request:
+        if request.values.get('SAMLResponse'):
+            return "Unexpected LogoutResponse: this IdP notifies SPs over the back channel.", 400
+        return _idp_initiated_logout()
+
+    try:
+        parsed = saml_handler.parse_logout_request(saml_request)
+    except SAMLRequestTooLarge:
+        return "SAMLRequest too large", 413
+    except Exception:
+        return "Invalid LogoutRequest", 400
+    sp = sp_registry.by_entity_id(parsed["issuer"]) if parsed["issuer"] else None
+    if sp is None:
+        return "LogoutRequest from an unknown Service Provider", 400
+    redirect_binding = bool(request.args.get('SAMLRequest'))
+    try:
+        signed = check_logout_request(sp, parsed["root"],
+                                      request.query_string if redirect_binding else None)
+    except RequestSignatureError as e:
+        logger.warning("Rejected LogoutRequest from %s: %s", sp.entity_id, e)
+        record('saml', 'Rejected LogoutRequest', target=sp.name or sp.entity_id,
+               status='error', detail={'sp': sp.entity_id, 'reason': str(e)})
+        return "LogoutRequest signature verification failed", 403
+    verified = signed is not parsed["root"]
+    if verified:
+        parsed = saml_handler.logout_fields(signed)
+
+    # Front-channel bindings arrive through the user's browser, so its own
+    # IdP session is the one to end. Only a verified signature may name some
+    # other session through the participant table — an unsigned request from
+    # a cert-less SP could otherwise log out anyone by NameID.
+    user = _session_user()
+    if user is not None and user.email == parsed["name_id"] and session.get('idp_sid'):
+        sid = session['idp_sid']
+    elif verified:
+        sid = slo.session_for(sp.entity_id, parsed["name_id"], parsed["session_indexes"])
+    else:
+        sid = None
+    results = slo.logout(sid, exclude_sp_id=sp.id) if sid else []
+    if sid and sid == session.get('idp_sid'):
+        _end_idp_session()
+    partial = [r.sp for r in results if r.status in ("failed", "timeout")]
+    record('saml', 'Single Logout', target=parsed["name_id"], status='error' if partial else 'success',
+           detail={'initiator': sp.entity_id, 'notified': len(results) - len(partial),
+                   'failed': partial})
+
+    if not sp.slo_url:
+        return render_template('auth/logout.html', results=results, sp_name=sp.name)
+    status_args = (STATUS_SUCCESS, STATUS_PARTIAL_LOGOUT if partial else None)
+    if redirect_binding:
+        xml = saml_handler.build_logout_response(sp.slo_url, parsed["request_id"],
+                                                 *status_args, sign=False)
+        query = saml_handler.redirect_query("SAMLResponse", xml, relay_state)
+        return redirect(sp.slo_url + ("&" if "?" in sp.slo_url else "?") + query)
+    xml = saml_handler.build_logout_response(sp.slo_url, parsed["request_id"], *status_args)
+    return render_template(
+        'auth/saml_post.html',
+        saml_response=base64.b64encode(xml).decode("ascii"),
+        acs_url=sp.slo_url,
         relay_state=relay_state,
+        message="Signing you out… returning to your application.",
     )
 
 
+def _idp_initiated_logout():
+    if request.method != 'POST':
+        return render_template('auth/logout.html', confirm=True)
+    # /slo is CSRF-exempt for SP POSTs, so check the token here.
+    if current_app.config.get('WTF_CSRF_ENABLED', True):
+        try:
+            validate_csrf(request.form.get('csrf_token'))
+        except ValidationError:
+            return "Missing or invalid CSRF token", 400
+    sid = session.get('idp_sid')
+    user_id = session.get('user_id')
+    results = slo.logout(sid) if sid else []
+    _end_idp_session()
+    if sid:
+        partial = [r.sp for r in results if r.status in ("failed", "timeout")]
+        record('saml', 'Single Logout', status='error' if partial else 'success',
+               detail={'initiator': 'idp', 'user_id': user_id,
+                       'notified': len(results) - len(partial), 'failed': partial})
+    return render_template('auth/logout.html', results=results, sp_name=None)
+
+
 TEST_SP_ENTITY = "urn:cp-idp-simulator:saml-test"
 
 
@@ -110,7 +358,7 @@ TEST_SP_ENTITY = "urn:cp-idp-simulator:saml-test"
 def saml_test_start():
     """IdP-initiated SSO against the built-in loopback test SP — verify the
     full SAML flow end-to-end without any external Service Provider."""
-    sp = ServiceProvider.query.filter_by(entity_id=TEST_SP_ENTITY).first()
+    sp = sp_registry.by_entity_id(TEST_SP_ENTITY)
     if sp is None:
         return ("Built-in SAML test SP not found. Redeploy to re-seed it, or add "
                 f"a Service Provider with Entity ID '{TEST_SP_ENTITY}' and "
@@ -121,20 +369,59 @@ def saml_test_start():
         "acs_url": sp.acs_url,
         "relay_state": None,
         "sp_id": sp.id,
+        "binding": _response_binding(sp),
     }
+    user = _session_user(claim_plan(sp))
+    if user is not None:
+        return _issue_response(user, session['saml_ctx'], sp, via='session')
     return render_template('auth/login.html', sp_name="Built-in SAML Test")
 
 
-@auth_bp.route('/saml-test/acs', methods=['POST'])
+@auth_bp.route('/artifact', methods=['POST'])
+def artifact_resolve():
+    """SOAP ArtifactResolutionService — the SP's back-channel call that trades
+    an HTTP-Artifact for the Response /login parked. Each artifact resolves
+    once. The ArtifactResolve must be signed by the SP it names when that SP
+    has a certificate on file. CSRF-exempt (a SOAP call carries no Flask
+    token)."""
+    if (request.content_length or 0) > IdPHandler.MAX_REQUEST_BYTES:
+        return "ArtifactResolve too large", 413
+    try:
+        parsed = saml_handler.parse_artifact_resolve(request.get_data())
+    except Exception:
+        return "Invalid ArtifactResolve request.", 400
+    sp = sp_registry.by_entity_id(parsed["issuer"]) if parsed["issuer"] else None
+    if sp is None:
+        return "Unknown Service Provider.", 403
+    try:
+        signed = check_artifact_resolve(sp, parsed["root"])
+    except RequestSignatureError as e:
+        logger.warning("Rejected ArtifactResolve from %s: %s", sp.entity_id, e)
+        record('saml', 'Rejected ArtifactResolve', target=sp.name or sp.entity_id,
+               status='error', detail={'sp': sp.entity_id, 'reason': str(e)})
+        return "ArtifactResolve signature verification failed", 403
+    artifact_el = signed.find(f"{{{SAMLP_NS}}}Artifact")
+    artifact = (artifact_el.text or "").strip() if artifact_el is not None else ""
+    response_xml = artifact_store.resolve(artifact, sp.entity_id)
+    body = saml_handler.build_artifact_response(parsed["request_id"], response_xml)
+    return Response(body, mimetype='text/xml')
+
+
+@auth_bp.route('/saml-test/acs', methods=['GET', 'POST'])
 def saml_test_acs():
     """Loopback ACS: decode and display the assertion the IdP just issued, with
-    a signature-verified badge. CSRF-exempt (a SAML POST carries no Flask token)."""
-    raw = request.form.get('SAMLResponse', '')
+    a signature-verified badge. Accepts HTTP-POST (SAMLResponse) and
+    HTTP-Artifact (SAMLart — resolved in-process rather than over SOAP to our
+    own host). CSRF-exempt (a SAML POST carries no Flask token)."""
+    artifact = request.args.get('SAMLart')
     try:
-        xml_bytes = base64.b64decode(raw)
-        parser = etree.XMLParser(resolve_entities=False, no_network=True,
-                                 dtd_validation=False, load_dtd=False)
-        root = etree.fromstring(xml_bytes, parser=parser)
+        if artifact:
+            xml_bytes = artifact_store.resolve(artifact, TEST_SP_ENTITY)
+            if xml_bytes is None:
+                return "Unknown, expired or already used SAML artifact.", 400
+        else:
+            xml_bytes = base64.b64decode(request.form.get('SAMLResponse', ''))
+        root = parse_xml(xml_bytes)
     except Exception:
         return "Invalid or missing SAMLResponse.", 400
 
@@ -148,7 +435,7 @@ def saml_test_acs():
 
     return render_template(
         'auth/saml_test_result.html',
-        verified=saml_handler.verify_signature(xml_bytes),
+        verified=saml_handler.verify_signature(xml_bytes, root=root),
         nameid=(nameid_el.text if nameid_el is not None else None),
         attrs=attrs,
         pretty_xml=etree.tostring(root, pretty_print=True).decode("utf-8"),
@@ -1,39 +1,129 @@
-from flask import Blueprint, Response, render_template, make_response
+import hashlib
+import threading
+from datetime import datetime, timedelta
+
+from flask import Blueprint, Response, render_template, make_response, request
 from jinja2 import Template
+from lxml import etree
 from app.utils.config_manager import config_manager
-from app.utils.path_config import IDP_CERT, IDP_TEMPLATE
+from app.utils.path_config import IDP_TEMPLATE
+from app.utils.saml import signing_material, sign_enveloped, parse_xml
+from app.utils.version_file import file_stamp
 import os
 
 metadata_bp = Blueprint('metadata', __name__)
 
+# SPs and monitors poll /metadata constantly, but the document only changes
+# when the cert, the template, or the advertised endpoints do. The rendered
+# XML is cached per (entity ID, SSO URL, artifact URL, SLO URL) — all derived
+# from the request host unless pinned by env — and re-rendered when the signing
+# material or template file changes. Responses carry a strong ETag so pollers
+# get a 304 instead of the body.
+#
+# With SIGN_METADATA on, the cached document is the signed one: validUntil /
+# cacheDuration are stamped in and the signature computed once per host
+# variant, so polls never pay for an RSA/ECDSA operation. A variant is
+# re-signed when its inputs change or once half its validity window has
+# elapsed, so an SP always receives metadata with plenty of life left.
+METADATA_MAX_AGE = 300  # seconds an SP may reuse metadata before revalidating
+METADATA_CACHE_SIZE = 64
+
+_cache = {}       # (entity_id, sso_url, artifact_url, slo_url) -> (inputs stamp, xml, etag, refresh_at)
+_template = {"stamp": None, "template": None}
+_lock = threading.Lock()
+
+
+def _compiled_template(stamp):
+    """The parsed Jinja template, re-read only when the file changes."""
+    if _template["stamp"] != stamp:
+        with open(IDP_TEMPLATE, 'r') as f:
+            _template["template"] = Template(f.read())
+        _template["stamp"] = stamp
+    return _template["template"]
+
+
+def _sign_metadata(xml, material, now):
+    """Stamp validUntil / cacheDuration onto the EntityDescriptor and sign it.
+    md:EntityDescriptor allows ds:Signature only as its first child."""
+    root = parse_xml(xml.encode('utf-8'))
+    valid_until = now + timedelta(hours=config_manager.METADATA_VALID_HOURS)
+    root.set('validUntil', valid_until.strftime('%Y-%m-%dT%H:%M:%SZ'))
+    if config_manager.METADATA_CACHE_DURATION:
+        root.set('cacheDuration', config_manager.METADATA_CACHE_DURATION)
+    signed = sign_enveloped(root, material, position=0)
+    return etree.tostring(signed, xml_declaration=True, encoding='UTF-8')
+
+
+def get_metadata():
+    """(xml, etag) for the current request's effective entity ID / SSO URL."""
+    material = signing_material.current()
+    template_stamp = file_stamp(IDP_TEMPLATE)
+    sign = config_manager.SIGN_METADATA
+    stamp = (material.stamp, template_stamp, sign,
+             config_manager.METADATA_VALID_HOURS, config_manager.METADATA_CACHE_DURATION)
+    key = (config_manager.effective_entity_id(), config_manager.effective_sso_url(),
+           config_manager.effective_artifact_url(), config_manager.effective_slo_url())
+
+    def fresh(entry):
+        return (entry is not None and entry[0] == stamp
+                and (entry[3] is None or datetime.utcnow() < entry[3]))
+
+    cached = _cache.get(key)
+    if fresh(cached):
+        return cached[1], cached[2]
+
+    with _lock:
+        cached = _cache.get(key)
+        if fresh(cached):  # another thread rendered it while we waited
+            return cached[1], cached[2]
+        cert_data = material.cert_pem.decode('ascii').replace('-----BEGIN CERTIFICATE-----', '').replace('-----END CERTIFICATE-----', '').replace('\n', '')
+        xml = _compiled_template(template_stamp).render(
+            entity_id=key[0],
+            cert_content=cert_data,
+            sso_service_url=key[1],
+            artifact_resolution_url=key[2],
+            slo_service_url=key[3],
+            signing_method=material.signature_method_uri,
+        )
+        refresh_at = None
+        if sign:
+            now = datetime.utcnow()
+            xml = _sign_metadata(xml, material, now)
+            refresh_at = now + timedelta(hours=config_manager.METADATA_VALID_HOURS / 2)
+        body = xml if isinstance(xml, bytes) else xml.encode('utf-8')
+        etag = hashlib.sha256(body).hexdigest()[:32]
+        if key not in _cache:
+            while len(_cache) >= METADATA_CACHE_SIZE:
+                _cache.pop(next(iter(_cache)))
+        _cache[key] = (stamp, xml, etag, refresh_at)
+    return xml, etag
+
+
 def get_metadata_xml():
-    """Generate the SAML metadata XML"""
-    with open(IDP_CERT, 'r') as f:
-        cert_data = f.read().replace('-----BEGIN CERTIFICATE-----', '').replace('-----END CERTIFICATE-----', '').replace('\n', '')
-    
-    with open(IDP_TEMPLATE, 'r') as f:
-        template_str = f.read()
-    
-    template = Template(template_str)
-    return template.render(
-        entity_id=config_manager.effective_entity_id(),
-        cert_content=cert_data,
-        sso_service_url=config_manager.effective_sso_url()
-    )
+    """Generate the SAML metadata XML (signed bytes when SIGN_METADATA is on)"""
+    return get_metadata()[0]
+
+
+def _conditional(response, etag):
+    """Attach ETag / Cache-Control and turn a matching If-None-Match into 304."""
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f'public, max-age={METADATA_MAX_AGE}'
+    return response.make_conditional(request)
+
 
 @metadata_bp.route('/metadata')
 def metadata():
-    xml = get_metadata_xml()
-    return Response(xml, mimetype='text/xml')
+    xml, etag = get_metadata()
+    return _conditional(Response(xml, mimetype='text/xml'), etag)
 
 @metadata_bp.route('/download-metadata')
 def download_metadata():
     """Download the metadata as an XML file"""
-    xml = get_metadata_xml()
+    xml, etag = get_metadata()
     response = make_response(xml)
     response.headers['Content-Type'] = 'application/xml'
     response.headers['Content-Disposition'] = 'attachment; filename=idp-metadata.xml'
-    return response
+    return _conditional(response, etag)
 
 @metadata_bp.route('/')
 def index():
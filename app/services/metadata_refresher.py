@@ -0,0 +1,68 @@
+"""Background SP metadata refresher.
+
+Started by the AAA runner (app.services.runner) — one process, so the
+gunicorn workers don't each poll every SP. Every SP with a `metadata_url` is
+re-fetched when its refresh interval (cacheDuration / validUntil, see
+`sp_metadata.refresh_interval`) runs out, via `sp_metadata.refresh_sp`:
+a conditional GET, a digest check, and a DB write only when the document
+changed. Web workers see changes through the SP registry's version file.
+
+Nothing on the SSO path waits for this: /sso and /login read the registry
+snapshot, whatever the refresher is doing.
+"""
+import threading
+import time
+
+from app.utils.config_manager import config_manager
+from app.utils.logger_main import logger
+from app.utils.models import ServiceProvider, db
+from app.utils.sp_metadata import SPMetadataError, forget_source, refresh_sp
+
+POLL_SECONDS = 30
+# Spread the first round of fetches so a restart doesn't hit every SP at once.
+STARTUP_STAGGER_SECONDS = 2
+
+_due = {}   # ServiceProvider.id -> time.monotonic() the next fetch is due
+
+
+def run_once(now=None):
+    """Refresh every SP whose metadata is due. Returns {sp id: outcome}."""
+    now = time.monotonic() if now is None else now
+    outcomes = {}
+    sps = ServiceProvider.query.filter(ServiceProvider.metadata_url.isnot(None),
+                                       ServiceProvider.metadata_url != "").all()
+    for stale in set(_due) - {sp.id for sp in sps}:
+        _due.pop(stale, None)
+        forget_source(stale)
+    for i, sp in enumerate(sps):
+        if sp.id not in _due:
+            _due[sp.id] = now + i * STARTUP_STAGGER_SECONDS
+        if _due[sp.id] > now:
+            continue
+        try:
+            outcome, interval = refresh_sp(sp)
+        except SPMetadataError as e:
+            db.session.rollback()
+            outcome, interval = f"error: {e}", None
+            logger.warning("SP metadata refresh for %s failed: %s", sp.entity_id, e)
+        # A failed fetch retries at the minimum interval rather than waiting
+        # out a full cacheDuration on stale data.
+        _due[sp.id] = now + (interval or config_manager.SP_METADATA_MIN_REFRESH)
+        outcomes[sp.id] = outcome
+    return outcomes
+
+
+def _loop(app):
+    while True:
+        with app.app_context():
+            try:
+                run_once()
+            except Exception:
+                logger.exception("SP metadata refresher pass failed")
+            finally:
+                db.session.remove()
+        time.sleep(POLL_SECONDS)
+
+
+def start(app):
+    threading.Thread(target=_loop, args=(app,), daemon=True, name="sp-metadata").start()
@@ -0,0 +1,71 @@
+"""Bulk SAML assertion minting from the command line.
+
+Run as `python -m app.services.mint`. Mints signed Responses for one Service
+Provider straight from the database and signing key — no web server, no admin
+login — and writes them as NDJSON (see app.utils.minting), one Response per
+line followed by a summary line:
+
+    python -m app.services.mint --sp urn:cp-idp-simulator:saml-test --count 5000 > out.ndjson
+    python -m app.services.mint --sp 3 --user demo.user --user alice --processes 4
+
+Pass --base-url (the IdP's public URL) so the Issuer and a relative ACS match
+what the running IdP would send; otherwise IDP_ENTITY_ID's fallback is used.
+"""
+import argparse
+import json
+import sys
+import time
+
+from app import create_app
+from app.utils.minting import MintError, mint, resolve_users, summary
+from app.utils.claims import claim_plan
+from app.utils.saml import IdPHandler
+from app.utils.sp_registry import sp_registry
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--sp", required=True, help="SP entity ID or numeric id")
+    ap.add_argument("--count", type=int, default=1, help="Responses to mint")
+    ap.add_argument("--user", action="append", dest="users",
+                    help="username to mint for (repeatable; default: all active users)")
+    ap.add_argument("--processes", type=int, default=None,
+                    help="signing processes (default: one per core; 0 = inline)")
+    ap.add_argument("--base-url", default=None, help="the IdP's public URL, e.g. https://idp.example.com")
+    ap.add_argument("--output", default="-", help="NDJSON output file (default: stdout)")
+    args = ap.parse_args(argv)
+
+    app = create_app(init_db=False)
+    context = (app.test_request_context(base_url=args.base_url) if args.base_url
+               else app.app_context())
+    with context:
+        sp = sp_registry.get(int(args.sp)) if args.sp.isdigit() else sp_registry.by_entity_id(args.sp)
+        if sp is None:
+            sys.exit(f"mint: unknown Service Provider {args.sp!r}")
+        acs_url = sp.acs_url
+        if acs_url.startswith("/") and args.base_url:
+            acs_url = args.base_url.rstrip("/") + acs_url
+        try:
+            users = resolve_users(claim_plan(sp), args.users)
+            rows = mint(IdPHandler(), sp, users, args.count, acs_url=acs_url,
+                        processes=args.processes)
+        except MintError as e:
+            sys.exit(f"mint: {e}")
+
+        out = sys.stdout if args.output == "-" else open(args.output, "w")
+        try:
+            started, minted = time.perf_counter(), 0
+            for row in rows:
+                out.write(json.dumps(row) + "\n")
+                minted += 1
+            done = summary(minted, started)
+            out.write(json.dumps(done) + "\n")
+        finally:
+            if out is not sys.stdout:
+                out.close()
+    print(f"minted {done['minted']} Responses in {done['seconds']}s ({done['per_sec']}/s)",
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
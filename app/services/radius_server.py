@@ -1,32 +1,122 @@
 """RADIUS authentication + accounting server (pyrad packet over raw UDP).
 
-Authenticates against the shared `User` directory and returns the user's group
+Authenticates against the shared `User` directory (through the in-process
+`aaa_directory` snapshot, so a login reads no SQLite rows) and returns the user's group
 names as Class attributes. MFA users get an Access-Challenge for a one-time
 passcode. Connection settings (shared secret, ports, default OTP) come from
 `get_setting` (portal-editable, persisted) — secret/OTP are read live per
 request; ports are bound at startup.
 
 Runs inside the protocol process (app.services.runner), NOT the gunicorn web
-workers — only one process can bind a UDP port. Each server thread holds one
-app context and resets the session after every request.
+workers — only one process can bind a UDP port. Each port has one receiver
+thread feeding a bounded queue, drained by RADIUS_WORKERS worker threads, so
+a slow login (PBKDF2 check, SQLite commit) no longer stalls every NAS behind
+it. Each worker holds its own app context and resets its session after every
+request. When the queue is full (RADIUS_QUEUE_DEPTH) the packet is dropped,
+not rejected: the NAS retransmits, and a reject would lock the user out.
+
+Retransmits are answered from a per-port duplicate cache (RFC 5080 §2.2.2),
+keyed on (source address, port, Identifier, Request Authenticator). A copy
+that arrives while the original is still queued or being handled is
+dropped. A copy that arrives within RADIUS_DEDUP_WINDOW seconds after the
+answer gets the same reply bytes back. So a retransmit storm costs one
+password hash and one log row, and an MFA user gets one Access-Challenge
+with one State instead of one per copy.
 """
 import binascii
 import os
+import queue
 import socket
 import threading
+import time
+from collections import OrderedDict
 
 from pyrad import packet
 from pyrad.dictionary import Dictionary
 
 from app.utils.config_manager import config_manager
-from app.utils.models import db, User
-from app.utils.models_aaa import (
-    AaaUserAuth, gaia_radius_role, get_setting, log_event, verify_totp,
-)
+from app.utils.logger_main import logger
+from app.utils.metrics import Counters
+from app.utils.aaa_directory import aaa_directory
+from app.utils.models import db
+from app.utils.models_aaa import check_totp, get_setting, log_event
 
 _DICT = Dictionary(os.path.join(os.path.dirname(__file__), "radius_dictionary"))
-_challenges: dict[str, str] = {}
-_lock = threading.Lock()
+
+
+class _ChallengeStore:
+    """Outstanding MFA Access-Challenges: State (hex) -> username. Shared by
+    the auth workers. A State is good for RADIUS_CHALLENGE_TTL seconds
+    (about as long as a NAS waits for the passcode) and is used once. A user
+    holds at most RADIUS_CHALLENGE_PER_USER at a time, and the store at most
+    RADIUS_CHALLENGE_MAX_ENTRIES; the oldest go first. So abandoned
+    challenges, or a scan of made-up usernames, can't grow it without
+    bound."""
+
+    def __init__(self, ttl, max_entries, per_user):
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self.per_user = max(1, per_user)
+        self._entries = OrderedDict()  # state -> (expires, username), oldest first
+        self._by_user: dict[str, list] = {}
+        self._lock = threading.Lock()
+        self._counters = Counters("issued", "consumed", "expired", "evicted", "unknown")
+
+    def add(self, state, username):
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            mine = self._by_user.get(username, [])
+            while len(mine) >= self.per_user:
+                self._drop(mine[0])
+                self._counters.count("evicted")
+            while len(self._entries) >= self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self._counters.count("evicted")
+            self._entries[state] = (now + self.ttl, username)
+            self._by_user.setdefault(username, []).append(state)
+        self._counters.count("issued")
+
+    def pop(self, state):
+        """The username `state` was issued to, or None if it is unknown,
+        expired or already used."""
+        with self._lock:
+            self._expire(time.monotonic())
+            username = self._drop(state) if state in self._entries else None
+        self._counters.count("unknown" if username is None else "consumed")
+        return username
+
+    def _drop(self, state):
+        _, username = self._entries.pop(state)
+        mine = self._by_user[username]
+        mine.remove(state)
+        if not mine:
+            del self._by_user[username]
+        return username
+
+    def _expire(self, now):
+        while self._entries:
+            state, (expires, _) = next(iter(self._entries.items()))
+            if expires > now:
+                break
+            self._drop(state)
+            self._counters.count("expired")
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._expire(time.monotonic())
+            live, users = len(self._entries), len(self._by_user)
+        return {**self._counters.snapshot(), "live": live, "users": users,
+                "ttl": self.ttl, "max_entries": self.max_entries, "per_user": self.per_user}
+
+
+_challenges = _ChallengeStore(config_manager.RADIUS_CHALLENGE_TTL,
+                              config_manager.RADIUS_CHALLENGE_MAX_ENTRIES,
+                              config_manager.RADIUS_CHALLENGE_PER_USER)
+# Seconds between "queue full" warnings per port, so overload can't flood the log.
+DROP_LOG_INTERVAL = 10.0
+# Per-listener counters, by label ("auth", "acct").
+_stats: dict[str, "_Counters"] = {}
 
 
 def _text(v):
@@ -39,14 +129,13 @@ def _secret() -> bytes:
 
 def _accept(reply, user):
     reply.code = packet.AccessAccept
-    for group in (user.group_names or []):
+    for group in user.group_names:
         reply.AddAttribute("Class", group.encode())
     # Check Point Gaia role-based administration (vendor 2620). Gaia reads these
     # VSAs to assign the admin's role; non-Gaia NAS ignore unknown VSAs, so it's
     # always safe to send them. Role is decided by the user's directory groups.
-    role, superuser = gaia_radius_role(user)
-    reply.AddAttribute("CP-Gaia-User-Role", role)
-    reply.AddAttribute("CP-Gaia-SuperUser-Access", superuser)
+    reply.AddAttribute("CP-Gaia-User-Role", user.radius_role)
+    reply.AddAttribute("CP-Gaia-SuperUser-Access", user.radius_superuser)
     reply.AddAttribute("Reply-Message", "Authenticated by the Identity & Access simulator")
 
 
@@ -81,17 +170,15 @@ def handle_auth(data, addr):
 
     # Second leg of an MFA exchange: the password field carries the TOTP code.
     if state:
-        with _lock:
-            pending = _challenges.pop(state, None)
-        user = User.query.filter_by(username=username).first() if username else None
-        aaa = AaaUserAuth.query.filter_by(user_id=user.id).first() if user else None
-        if pending == username and verify_totp(aaa, password):
+        pending = _challenges.pop(state)
+        user = aaa_directory.get(username) if username else None
+        if user and pending == username and check_totp(user.totp_secret, password):
             _accept(reply, user)
-            role, su = gaia_radius_role(user)
             log_event("radius", "auth", username, nas, "accept", "TOTP verified",
                       meta={**meta, "reply": "Access-Accept", "auth_via": "TOTP (second factor)",
-                            "groups": list(user.group_names or []),
-                            "CP-Gaia-User-Role": role, "CP-Gaia-SuperUser-Access": su})
+                            "groups": list(user.group_names),
+                            "CP-Gaia-User-Role": user.radius_role,
+                            "CP-Gaia-SuperUser-Access": user.radius_superuser})
         else:
             reply.code = packet.AccessReject
             reply.AddAttribute("Reply-Message", "Invalid authenticator code")
@@ -100,7 +187,7 @@ def handle_auth(data, addr):
                             "reason": "invalid authenticator code"})
         return reply
 
-    user = User.query.filter_by(username=username).first()
+    user = aaa_directory.get(username)
     if not user or not user.active or not user.check_password(password):
         reason = ("unknown user" if not user
                   else "inactive user" if not user.active else "wrong password")
@@ -110,24 +197,22 @@ def handle_auth(data, addr):
                   meta={**meta, "reply": "Access-Reject", "reason": reason})
         return reply
 
-    aaa = AaaUserAuth.query.filter_by(user_id=user.id).first()
-    if aaa and aaa.mfa:
+    if user.mfa:
         token = os.urandom(8)
-        with _lock:
-            _challenges[binascii.hexlify(token).decode()] = username
+        _challenges.add(binascii.hexlify(token).decode(), username)
         reply.code = packet.AccessChallenge
         reply.AddAttribute("Reply-Message", "Enter the code from your authenticator app")
         reply.AddAttribute("State", token)
         log_event("radius", "auth", username, nas, "challenge", "MFA requested",
                   meta={**meta, "reply": "Access-Challenge", "mfa": "TOTP code requested",
-                        "groups": list(user.group_names or [])})
+                        "groups": list(user.group_names)})
     else:
         _accept(reply, user)
-        role, su = gaia_radius_role(user)
         log_event("radius", "auth", username, nas, "accept", "password OK",
                   meta={**meta, "reply": "Access-Accept", "auth_via": "password",
-                        "groups": list(user.group_names or []),
-                        "CP-Gaia-User-Role": role, "CP-Gaia-SuperUser-Access": su})
+                        "groups": list(user.group_names),
+                        "CP-Gaia-User-Role": user.radius_role,
+                        "CP-Gaia-SuperUser-Access": user.radius_superuser})
     return reply
 
 
@@ -147,25 +232,142 @@ def handle_acct(data, addr):
     return reply
 
 
+class _Counters(Counters):
+    """One listener's counters: received, handled, dropped, errors, queue
+    high-water, and retransmits replayed from / dropped by the duplicate
+    cache. Updated from the receive thread and every worker."""
+
+    def __init__(self, workers, queue_depth):
+        super().__init__("received", "handled", "dropped", "errors",
+                         "replayed", "in_flight_dupes", "high_water")
+        self.workers = workers
+        self.queue_depth = queue_depth
+
+    def stats(self) -> dict:
+        return {**self.snapshot(), "workers": self.workers, "queue_depth": self.queue_depth}
+
+
+class _ReplyCache:
+    """Recent requests of one listener and the replies they got. An entry is
+    in flight (reply None) from arrival until its reply is stored, then
+    lives RADIUS_DEDUP_WINDOW seconds. Oldest entries go first once
+    RADIUS_DEDUP_MAX_ENTRIES is reached."""
+
+    def __init__(self, window, max_entries):
+        self.window = window
+        self.max_entries = max(1, max_entries)
+        self._entries = OrderedDict()  # key -> (expires, reply bytes or None)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(data, addr):
+        # Code + Identifier (bytes 0-1) and the Request Authenticator (4-19).
+        return addr[0], addr[1], data[:2], data[4:20]
+
+    def claim(self, key):
+        """None if `key` is new, and mark it in flight. Otherwise the cached
+        reply bytes, or b"" while the original is still being handled."""
+        now = time.monotonic()
+        with self._lock:
+            while self._entries:
+                oldest = next(iter(self._entries.values()))
+                if oldest[0] > now:
+                    break
+                self._entries.popitem(last=False)
+            hit = self._entries.get(key)
+            if hit is not None:
+                return hit[1] or b""
+            self._entries[key] = (now + self.window, None)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return None
+
+    def store(self, key, reply):
+        with self._lock:
+            if key in self._entries:
+                self._entries[key] = (time.monotonic() + self.window, reply)
+                self._entries.move_to_end(key)
+
+    def forget(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
 def _serve(app, port, handler, label):
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     sock.bind((config_manager.AAA_BIND, port))
+    backlog = queue.Queue(maxsize=max(1, config_manager.RADIUS_QUEUE_DEPTH))
+    cache = None
+    if config_manager.RADIUS_DEDUP_WINDOW > 0:
+        cache = _ReplyCache(config_manager.RADIUS_DEDUP_WINDOW,
+                            config_manager.RADIUS_DEDUP_MAX_ENTRIES)
+    counters = _stats[label] = _Counters(max(1, config_manager.RADIUS_WORKERS), backlog.maxsize)
+    for n in range(counters.workers):
+        threading.Thread(target=_work, args=(app, sock, backlog, handler, label, counters, cache),
+                         daemon=True, name=f"radius-{label}-{n}").start()
+    next_warning = 0.0
+    while True:
+        try:
+            data, addr = sock.recvfrom(8192)
+        except OSError:
+            continue
+        counters.count("received")
+        key = None
+        if cache is not None and len(data) >= 20:
+            key = cache.key(data, addr)
+            cached = cache.claim(key)
+            if cached is not None:
+                if cached:
+                    counters.count("replayed")
+                    try:
+                        sock.sendto(cached, addr)
+                    except OSError:
+                        pass
+                else:
+                    counters.count("in_flight_dupes")
+                continue
+        try:
+            backlog.put_nowait((data, addr, key))
+        except queue.Full:
+            if key is not None:
+                cache.forget(key)  # let the retransmit have a go
+            dropped = counters.count("dropped")
+            now = time.monotonic()
+            if now >= next_warning:
+                next_warning = now + DROP_LOG_INTERVAL
+                logger.warning("RADIUS %s queue full (%d waiting): dropping requests, "
+                               "%d so far", label, backlog.maxsize, dropped)
+            continue
+        counters.peak("high_water", backlog.qsize())
+
+
+def _work(app, sock, backlog, handler, label, counters, cache):
     with app.app_context():
         while True:
+            data, addr, key = backlog.get()
             try:
-                data, addr = sock.recvfrom(8192)
-            except OSError:
-                continue
-            try:
-                reply = handler(data, addr)
-                sock.sendto(reply.ReplyPacket(), addr)
-            except Exception as exc:  # a malformed packet must never kill the loop
+                raw = handler(data, addr).ReplyPacket()
+                if key is not None:
+                    cache.store(key, raw)
+                sock.sendto(raw, addr)
+                counters.count("handled")
+            except Exception as exc:  # a malformed packet must never kill the worker
+                if key is not None:
+                    cache.forget(key)
+                counters.count("errors")
                 log_event("radius", label, "", addr[0] if addr else "", "error", str(exc))
             finally:
                 db.session.remove()
 
 
+def stats():
+    """Counters per listener ("auth", "acct") since startup, plus the MFA
+    challenge store."""
+    return {**{label: c.stats() for label, c in _stats.items()},
+            "challenges": _challenges.stats()}
+
+
 def start(app):
     """Bind the RADIUS auth + accounting listeners (ports read at startup)."""
     with app.app_context():
@@ -1,18 +1,36 @@
-"""Protocol process entrypoint — hosts the RADIUS + TACACS+ servers.
+"""Protocol process entrypoint — hosts the RADIUS + TACACS+ servers and the
+SP metadata refresher.
 
 Run as `python -m app.services.runner`. The container's entrypoint launches this
 alongside gunicorn. It builds the app with init_db=False (so only the web process
 migrates/seeds — no init race), waits for the web process to create the schema,
-then starts the listeners. Binding here, in one process, avoids the
-"address already in use" you'd get if each gunicorn worker tried to bind.
+then starts the listeners. Every AAA_STATS_INTERVAL seconds it logs the log
+writer / RADIUS / AAA directory counters and writes them to STATS_FILE, where
+the web process serves them at /admin/api/aaa-stats. Binding here, in one process, avoids the
+"address already in use" you'd get if each gunicorn worker tried to bind — and
+means SP metadata is polled once, not once per worker.
 """
+import json
+import os
+import signal
+import sys
 import time
+from datetime import datetime, timezone
 
 from sqlalchemy import inspect
 
 from app import create_app
+from app.utils.aaa_directory import aaa_directory
+from app.utils.config_manager import config_manager
+from app.utils.logger_main import logger
 from app.utils.models import db
-from app.services import radius_server, tacacs_server
+from app.utils.models_aaa import start_log_writer, stop_log_writer
+from app.utils.path_config import BASE_DIR
+from app.services import metadata_refresher, radius_server, tacacs_server
+
+# Latest counters of this process, for the web process (a different process)
+# to read.
+STATS_FILE = BASE_DIR / "data" / ".aaa-stats.json"
 
 
 def _wait_for_schema(app, timeout=180):
@@ -31,19 +49,71 @@ def _wait_for_schema(app, timeout=180):
         time.sleep(2)
 
 
+def snapshot(writer):
+    """The AAA process's counters: log writer, RADIUS listeners and MFA
+    challenges, AAA directory."""
+    return {
+        "at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "log_writer": writer.stats(),
+        "radius": radius_server.stats(),
+        "aaa_directory": aaa_directory.stats(),
+    }
+
+
+def publish_stats(writer, path=STATS_FILE):
+    """Log a one-line summary of snapshot() and write it to `path` (replaced
+    atomically, so a reader never sees half a file)."""
+    stats = snapshot(writer)
+    lw, ch, d = stats["log_writer"], stats["radius"]["challenges"], stats["aaa_directory"]
+    logger.info(
+        "AAA stats: log written=%s dropped=%s failed=%s pending=%s; "
+        "RADIUS %s; challenges live=%s evicted=%s; directory users=%s reloads=%s",
+        lw["written"], lw["dropped"], lw["failed"], lw["pending"],
+        " ".join(f"{label} handled={c['handled']} dropped={c['dropped']}"
+                 for label, c in stats["radius"].items() if label != "challenges"),
+        ch["live"], ch["evicted"], d["users"], d["reloads"],
+    )
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_text(json.dumps(stats))
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.warning("AAA stats: could not write %s (%s)", path, e)
+
+
 def main():
     app = create_app(init_db=False)
     if not _wait_for_schema(app):
         print("AAA runner: schema not ready after wait — starting anyway.", flush=True)
+    writer = start_log_writer(app)
+    with app.app_context():
+        try:
+            users = aaa_directory.load()
+        except Exception as e:
+            # Serve anyway: the first RADIUS / TACACS+ lookup loads it.
+            print(f"AAA runner: could not load the AAA directory ({e}) — "
+                  "will load on first use.", flush=True)
+            users = "no"
+    # The supervisor stops us with SIGTERM; exit through `finally` so queued
+    # AAA log rows are written first.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
     rad_auth, rad_acct = radius_server.start(app)
     tac_port = tacacs_server.start(app)
+    metadata_refresher.start(app)
     print(
         f"AAA protocols up — RADIUS auth :{rad_auth}/udp acct :{rad_acct}/udp ; "
-        f"TACACS+ :{tac_port}/tcp",
+        f"TACACS+ :{tac_port}/tcp ; {users} users in the AAA directory",
         flush=True,
     )
-    while True:  # daemon server threads do the work
-        time.sleep(3600)
+    try:
+        interval = config_manager.AAA_STATS_INTERVAL
+        while True:  # daemon server threads do the work
+            time.sleep(interval if interval > 0 else 3600)
+            if interval > 0:
+                publish_stats(writer)
+    finally:
+        stop_log_writer()
 
 
 if __name__ == "__main__":
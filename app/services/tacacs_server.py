@@ -9,7 +9,8 @@ wire protocol directly:
     everyone else priv-lvl=0 (the default TACP-0)
   * Accounting: SUCCESS + logged
 
-Authenticates against the shared `User` directory. The shared secret and bind
+Authenticates against the shared `User` directory, read through the
+in-process `aaa_directory` snapshot. The shared secret and bind
 port come from `get_setting` (portal-editable); the secret is resolved once per
 connection inside an app context and threaded through the handlers. Runs in the
 protocol process (app.services.runner), binding an unprivileged port (default
@@ -21,8 +22,9 @@ import struct
 import threading
 
 from app.utils.config_manager import config_manager
-from app.utils.models import db, User
-from app.utils.models_aaa import gaia_tacacs_privlvl, get_setting, log_event
+from app.utils.aaa_directory import aaa_directory
+from app.utils.models import db
+from app.utils.models_aaa import get_setting, log_event
 
 # Packet types
 TAC_AUTHEN, TAC_AUTHOR, TAC_ACCT = 0x01, 0x02, 0x03
@@ -122,12 +124,9 @@ def _parse_author_user(b):
 
 # ---- DB-backed verification ----------------------------------------------
 def _verify(app, username, password) -> bool:
-    with app.app_context():
-        try:
-            user = User.query.filter_by(username=username).first()
-            return bool(user and user.active and user.check_password(password))
-        finally:
-            db.session.remove()
+    with app.app_context():  # a stale snapshot reloads from the DB
+        user = aaa_directory.get(username)
+    return bool(user and user.active and user.check_password(password))
 
 
 def _log(app, kind, username, nas, result, detail="", meta=None):
@@ -187,11 +186,8 @@ def _author_avpairs(app, username):
     (priv-lvl 15 = full admin), so priv-lvl is the pair that matters for Gaia.
     shell:roles= / roles= are added for non-Gaia NAS (Aruba, etc.)."""
     with app.app_context():
-        try:
-            user = User.query.filter_by(username=username).first()
-            priv = gaia_tacacs_privlvl(user)
-        finally:
-            db.session.remove()
+        user = aaa_directory.get(username)
+    priv = user.tacacs_privlvl if user else 0
     role = "adminRole" if priv >= 15 else "monitorRole"
     return [f"priv-lvl={priv}", f"shell:roles={role}", f"roles={role}"], priv, role
 
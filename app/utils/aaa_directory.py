@@ -0,0 +1,182 @@
+"""In-process user directory snapshot for the RADIUS / TACACS+ hot path.
+
+A RADIUS or TACACS+ login used to cost a User query, an AaaUserAuth query and
+a lazy load of every membership and its group (for group_names) — four-plus
+SQLite round trips, contending with the web workers, before the password
+check even starts. The AAA runner instead keeps one snapshot of every user as
+an immutable `AaaUser`: password hash, active flag, MFA flag, the decrypted
+TOTP secret, group names and the Gaia role / TACACS+ priv-lvl those groups
+map to. Lookups are a dict read.
+
+Invalidation works like the SP registry: every commit that touches `user`,
+`aaa_user_auth`, `scim_group` or `scim_group_member` — in any process, through
+the ORM or a bulk query delete — replaces a small version file on the data
+volume (see `init_app`). A lookup stats that file and reloads the snapshot
+when it changed, in three queries however many users changed. Membership
+removals and MFA toggles carry no timestamp, so a change stamp is what makes
+them visible. A snapshot older than AAA_DIRECTORY_MAX_AGE seconds is reloaded
+anyway, to pick up writes made outside the app. A failed load is not retried
+for RELOAD_RETRY seconds; meanwhile lookups keep the previous snapshot (none
+before the first successful load, so every user is unknown).
+"""
+import threading
+import time
+from collections import namedtuple
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+from werkzeug.security import check_password_hash
+
+from app.utils.config_manager import config_manager
+from app.utils.logger_main import logger
+from app.utils.metrics import Counters
+from app.utils.models import db, User
+from app.utils.models_aaa import (
+    AaaUserAuth, gaia_radius_role, gaia_tacacs_privlvl, get_totp_secret,
+)
+from app.utils.models_scim import ScimGroup, ScimGroupMember
+from app.utils.path_config import BASE_DIR
+from app.utils.version_file import bump_version, version_stamp
+
+VERSION_FILE = BASE_DIR / "data" / ".aaa-directory-version"
+WATCHED_TABLES = frozenset({"user", "aaa_user_auth", "scim_group", "scim_group_member"})
+_DIRTY = "aaa_directory_dirty"
+RELOAD_RETRY = 5.0  # seconds between attempts after a failed load
+
+
+class AaaUser(namedtuple(
+        "AaaUser",
+        "id username password_hash active mfa totp_secret group_names "
+        "radius_role radius_superuser tacacs_privlvl")):
+    __slots__ = ()
+
+    def check_password(self, password):
+        return check_password_hash(self.password_hash, password)
+
+
+class AaaDirectory:
+    def __init__(self, version_file=VERSION_FILE):
+        self.version_file = version_file
+        self._by_username = {}
+        self._stamp = None
+        self._loaded = False
+        self._loaded_at = None
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+        self._counters = Counters("lookups", "reloads", "reload_failures")
+
+    def _stale(self, stamp):
+        if time.monotonic() < self._retry_at:
+            return False  # a load just failed; don't retry it on every lookup
+        return (self._loaded_at is None or stamp != self._stamp
+                or time.monotonic() - self._loaded_at > config_manager.AAA_DIRECTORY_MAX_AGE)
+
+    def _current(self):
+        if self._stale(version_stamp(self.version_file)):
+            with self._lock:
+                stamp = version_stamp(self.version_file)
+                if self._stale(stamp):
+                    self._load(stamp)
+        return self._by_username
+
+    def _load(self, stamp):
+        """Snapshot the directory. `stamp` is read BEFORE the queries, so a
+        write that lands mid-load bumps the file past it and triggers another
+        load. A failed load keeps serving the previous snapshot and holds off
+        the next attempt for RELOAD_RETRY seconds; with no snapshot yet, the
+        error is raised to the caller too."""
+        try:
+            with db.engine.connect() as conn:
+                users = conn.execute(select(
+                    User.id, User.username, User.password_hash, User.active)).all()
+                groups = conn.execute(
+                    select(ScimGroupMember.user_id, ScimGroup.display_name)
+                    .join(ScimGroup, ScimGroup.id == ScimGroupMember.group_pk)
+                    .order_by(ScimGroupMember.id)).all()
+                aaa = {r.user_id: r for r in conn.execute(select(
+                    AaaUserAuth.user_id, AaaUserAuth.mfa, AaaUserAuth.totp_secret)).all()}
+        except Exception:
+            self._counters.count("reload_failures")
+            self._retry_at = time.monotonic() + RELOAD_RETRY
+            if not self._loaded:
+                raise
+            logger.warning("AAA directory reload failed; serving the previous snapshot",
+                           exc_info=True)
+            return
+        names = {}
+        for user_id, name in groups:
+            names.setdefault(user_id, []).append(name)
+        by_username = {}
+        for u in users:
+            a = aaa.get(u.id)
+            rec = AaaUser(
+                id=u.id, username=u.username, password_hash=u.password_hash,
+                active=bool(u.active), mfa=bool(a and a.mfa),
+                totp_secret=get_totp_secret(a), group_names=tuple(names.get(u.id, ())),
+                radius_role=None, radius_superuser=0, tacacs_privlvl=0,
+            )
+            role, superuser = gaia_radius_role(rec)
+            by_username[u.username] = rec._replace(
+                radius_role=role, radius_superuser=superuser,
+                tacacs_privlvl=gaia_tacacs_privlvl(rec))
+        self._by_username = by_username
+        self._stamp = stamp
+        self._loaded = True
+        self._loaded_at = time.monotonic()
+        self._counters.count("reloads")
+
+    def get(self, username):
+        """The AaaUser for `username`, or None."""
+        self._counters.count("lookups")
+        return self._current().get(username)
+
+    def load(self):
+        """Load the snapshot now (the runner warms it up at startup)."""
+        return len(self._current())
+
+    def invalidate(self):
+        """Mark every process's snapshot stale. Called after each commit that
+        changed a watched table."""
+        self._loaded_at = None
+        bump_version(self.version_file, "AAA directory")
+
+    def stats(self) -> dict:
+        return {**self._counters.snapshot(), "users": len(self._by_username),
+                "max_age": config_manager.AAA_DIRECTORY_MAX_AGE}
+
+
+aaa_directory = AaaDirectory()
+
+
+def _after_flush(session, flush_context):
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        table = getattr(obj, "__table__", None)
+        if table is not None and table.name in WATCHED_TABLES:
+            session.info[_DIRTY] = True
+            return
+
+
+def _do_orm_execute(state):
+    # Bulk query.update() / .delete() bypass the flush.
+    if state.is_update or state.is_delete or state.is_insert:
+        table = getattr(state.statement, "table", None)
+        if table is not None and table.name in WATCHED_TABLES:
+            state.session.info[_DIRTY] = True
+
+
+def _after_commit(session):
+    if session.info.pop(_DIRTY, False):
+        aaa_directory.invalidate()
+
+
+def _after_rollback(session):
+    session.info.pop(_DIRTY, None)
+
+
+def init_app(app):
+    """Bump the directory version on every commit that changes a user, its
+    groups or its MFA settings. Idempotent."""
+    for name, fn in (("after_flush", _after_flush), ("do_orm_execute", _do_orm_execute),
+                     ("after_commit", _after_commit), ("after_rollback", _after_rollback)):
+        if not event.contains(Session, name, fn):
+            event.listen(Session, name, fn)
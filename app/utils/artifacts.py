@@ -0,0 +1,152 @@
+"""SAML 2.0 HTTP-Artifact binding — a short-lived, single-use Response store.
+
+With HTTP-POST the whole signed Response (hundreds of KB with big group
+claims) travels browser → proxy → SP. With HTTP-Artifact, /login parks the
+signed Response here and redirects the browser to the ACS with only a
+type-0x0004 artifact (44 bytes: type code, endpoint index, SHA-1 source ID of
+our entity ID, 20-byte random message handle). The SP then fetches the
+Response over the SOAP back channel (`/artifact`, ArtifactResolve), exactly
+once. The artifact travels through the browser, so it proves nothing about
+the caller: an SP with a certificate on file must sign its ArtifactResolve
+(`request_signing.check_artifact_resolve`), and a call naming the wrong SP
+leaves the artifact for the right one.
+
+The store is the `saml_artifact` table rather than process memory: gunicorn
+runs several workers and the SP's back-channel call can land on any of them.
+It is bounded three ways — ARTIFACT_TTL, ARTIFACT_MAX_ENTRIES and
+ARTIFACT_MAX_BYTES of parked XML — and evicts the oldest rows to make room.
+Counters are per process; `stats()` adds the live table totals.
+"""
+import base64
+import hashlib
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, select
+
+from app.utils.config_manager import config_manager
+from app.utils.logger_main import logger
+from app.utils.metrics import Counters
+from app.utils.models import db, SamlArtifact
+
+TYPE_CODE = b"\x00\x04"
+ENDPOINT_INDEX = b"\x00\x00"
+ARTIFACT_LENGTH = 44
+
+
+class ArtifactTooLarge(Exception):
+    """The Response doesn't fit the store's byte budget — send it by POST."""
+
+
+def source_id(entity_id):
+    """SAML artifact SourceID: SHA-1 of the issuer's entity ID."""
+    return hashlib.sha1(entity_id.encode("utf-8")).digest()
+
+
+class ArtifactStore:
+    def __init__(self):
+        self._counters = Counters("issued", "resolved", "missed", "expired", "wrong_issuer",
+                                  "evicted", "rejected", "bytes_issued")
+
+    def issue(self, response_xml: bytes, sp_entity_id: str) -> str:
+        """Park a signed Response for `sp_entity_id`; return the base64 artifact.
+
+        Raises ArtifactTooLarge if the Response alone exceeds ARTIFACT_MAX_BYTES."""
+        size = len(response_xml)
+        max_bytes = config_manager.ARTIFACT_MAX_BYTES
+        if size > max_bytes:
+            self._counters.count("rejected")
+            raise ArtifactTooLarge(f"Response of {size} bytes exceeds ARTIFACT_MAX_BYTES")
+
+        handle = os.urandom(20)
+        now = datetime.utcnow()
+        table = SamlArtifact.__table__
+        with db.engine.begin() as conn:
+            conn.execute(delete(table).where(table.c.expires_at <= now))
+            count, total = conn.execute(
+                select(func.count(), func.coalesce(func.sum(table.c.size), 0))
+            ).one()
+            evicted = 0
+            if count >= config_manager.ARTIFACT_MAX_ENTRIES or total + size > max_bytes:
+                for old_handle, old_size in conn.execute(
+                    select(table.c.handle, table.c.size).order_by(table.c.created_at)
+                ):
+                    if count < config_manager.ARTIFACT_MAX_ENTRIES and total + size <= max_bytes:
+                        break
+                    conn.execute(delete(table).where(table.c.handle == old_handle))
+                    count, total, evicted = count - 1, total - old_size, evicted + 1
+            conn.execute(table.insert().values(
+                handle=handle.hex(), sp_entity_id=sp_entity_id, payload=response_xml,
+                size=size, created_at=now,
+                expires_at=now + timedelta(seconds=config_manager.ARTIFACT_TTL),
+            ))
+        if evicted:
+            logger.warning("SAML artifact store full: evicted %d unresolved artifact(s)", evicted)
+        self._counters.add(issued=1, bytes_issued=size, evicted=evicted)
+
+        artifact = (TYPE_CODE + ENDPOINT_INDEX
+                    + source_id(config_manager.effective_entity_id()) + handle)
+        return base64.b64encode(artifact).decode("ascii")
+
+    def resolve(self, artifact: str, issuer: str):
+        """The parked Response for `artifact`, or None. `issuer` must be the
+        SP the Response was issued to; a call from anyone else leaves the
+        artifact in place. Issuer and expiry are checked before the row is
+        claimed (deleted), so the artifact resolves at most once, for the
+        right SP, inside ARTIFACT_TTL."""
+        try:
+            raw = base64.b64decode(artifact, validate=True)
+        except (ValueError, TypeError):
+            raw = b""
+        if len(raw) != ARTIFACT_LENGTH or raw[:2] != TYPE_CODE:
+            self._counters.count("missed")
+            return None
+
+        table = SamlArtifact.__table__
+        handle = raw[24:].hex()
+        with db.engine.begin() as conn:
+            row = conn.execute(
+                select(table.c.sp_entity_id, table.c.payload, table.c.expires_at)
+                .where(table.c.handle == handle)
+            ).first()
+            if row is None:
+                self._counters.count("missed")
+                return None
+            if row.sp_entity_id != issuer:
+                # Leave the row: a wrong caller must not burn the real SP's artifact.
+                self._counters.count("wrong_issuer")
+                logger.warning("ArtifactResolve from %r for an artifact issued to %r",
+                               issuer, row.sp_entity_id)
+                return None
+            expired = row.expires_at <= datetime.utcnow()
+            claimed = conn.execute(
+                delete(table).where(table.c.handle == handle)
+            ).rowcount == 1
+        if expired:
+            self._counters.count("expired")  # dead anyway; the delete just purges it
+            return None
+        if not claimed:
+            self._counters.count("missed")
+            return None
+        self._counters.count("resolved")
+        return row.payload
+
+    def stats(self) -> dict:
+        """Per-process counters plus the live table totals, for the admin API."""
+        m = self._counters.snapshot()
+        table = SamlArtifact.__table__
+        with db.engine.connect() as conn:
+            count, total = conn.execute(
+                select(func.count(), func.coalesce(func.sum(table.c.size), 0))
+            ).one()
+        return {
+            **m,
+            "stored": count,
+            "stored_bytes": total,
+            "ttl": config_manager.ARTIFACT_TTL,
+            "max_entries": config_manager.ARTIFACT_MAX_ENTRIES,
+            "max_bytes": config_manager.ARTIFACT_MAX_BYTES,
+        }
+
+
+artifact_store = ArtifactStore()
@@ -0,0 +1,99 @@
+"""Per-SP claim plans — what a login has to load to fill an SP's assertion.
+
+An SP's `attr_map` is a list of {"claim": ..., "value": <User field>} rows.
+Walking it with getattr() per login lazy-loads `user.scim_memberships` for a
+group claim and then issues one more query per membership through `m.group`.
+A `ClaimPlan` is that mapping compiled once: the (claim, field) pairs to emit
+and which group projections (display names / UUIDs) are needed, so
+`load_user()` can fetch the user and exactly those group columns in a single
+eager query.
+
+Plans are cached per SP primary key and rebuilt whenever the SP's attr_map no
+longer matches the one the plan was compiled from, so an edit made in another
+gunicorn worker is picked up on the next login there as well.
+`invalidate_claim_plan()` drops a plan eagerly when the SP is edited or
+deleted in this process.
+"""
+import threading
+
+from sqlalchemy.orm import joinedload
+
+from app.utils.models import User
+from app.utils.models_scim import ScimGroup, ScimGroupMember
+
+# Membership-derived claim sources (see User.group_names / User.group_ids) and
+# the ScimGroup column each one projects.
+GROUP_FIELDS = {
+    "group_names": "display_name",
+    "group_ids": "group_id",
+}
+
+
+class ClaimPlan:
+    """An SP's attribute mapping, compiled."""
+
+    __slots__ = ("attr_map", "entries", "group_fields")
+
+    def __init__(self, attr_map):
+        self.attr_map = [dict(m) for m in attr_map or ()]
+        self.entries = tuple(
+            (m.get("claim"), m.get("value")) for m in self.attr_map
+            if m.get("claim") and m.get("value")
+        )
+        self.group_fields = frozenset(f for _, f in self.entries if f in GROUP_FIELDS)
+
+    def query_options(self):
+        """Loader options that bring in exactly the group columns this plan reads."""
+        if not self.group_fields:
+            return ()
+        columns = [getattr(ScimGroup, GROUP_FIELDS[f]) for f in self.group_fields]
+        return (joinedload(User.scim_memberships)
+                .joinedload(ScimGroupMember.group)
+                .load_only(*columns),)
+
+    def query(self):
+        """User query with the plan's loader options applied."""
+        return User.query.options(*self.query_options())
+
+    def load_user(self, **criteria):
+        """The User matching `criteria` (filter_by kwargs), with the plan's
+        groups eager-loaded in the same round trip. None if there's no match."""
+        return self.query().filter_by(**criteria).first()
+
+    def resolve(self, user):
+        """{claim: [values...]} for `user`. Fields that are unset (or aren't a
+        User attribute) are left out, as are claims with no mapping value."""
+        groups = [m.group for m in user.scim_memberships] if self.group_fields else ()
+        attributes = {}
+        for claim, field in self.entries:
+            if field in GROUP_FIELDS:
+                attributes[claim] = [getattr(g, GROUP_FIELDS[field]) for g in groups]
+                continue
+            val = getattr(user, field, None)
+            if val is None:
+                continue
+            attributes[claim] = val if isinstance(val, list) else [val]
+        return attributes
+
+
+EMPTY_PLAN = ClaimPlan([])
+
+_plans = {}   # ServiceProvider.id -> ClaimPlan
+_plans_lock = threading.Lock()
+
+
+def claim_plan(sp):
+    """The compiled ClaimPlan for `sp` (EMPTY_PLAN for no SP)."""
+    if sp is None:
+        return EMPTY_PLAN
+    plan = _plans.get(sp.id)
+    if plan is None or plan.attr_map != (sp.attr_map or []):
+        plan = ClaimPlan(sp.attr_map)
+        with _plans_lock:
+            _plans[sp.id] = plan
+    return plan
+
+
+def invalidate_claim_plan(sp_id):
+    with _plans_lock:
+        _plans.pop(sp_id, None)
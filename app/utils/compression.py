@@ -0,0 +1,141 @@
+"""Content-negotiated response compression for the admin portal and SCIM.
+
+SCIM provisioners pull whole directories (`/Users` pages of up to MAX_COUNT
+resources with their groups) and admin pages list every user, often across
+a WAN link. JSON and HTML like that compress 5-10x. `init_app` registers an
+after_request hook that compresses a response when all of these hold:
+
+- the path is under /admin/ or the SCIM base path. The SAML endpoints
+  (/sso, /login, /slo, ...) are never compressed: their auto-POST pages put
+  a signed assertion next to the attacker-influenced RelayState, which is
+  the setup a BREACH length oracle needs. The `auth` blueprint is also
+  refused explicitly, so a future prefix change can't opt it in;
+- the client accepts br (when the optional `brotli` package is installed),
+  gzip or deflate, honouring q-values;
+- the body is a compressible type of at least COMPRESS_MIN_BYTES.
+
+A body of COMPRESS_STREAM_BYTES or more is sent as a chunked stream of
+compressed slices, so transmission starts before the whole body has been
+compressed and the full compressed copy is never held in memory. Streamed
+responses, such as the NDJSON mint endpoint, are compressed chunk by chunk
+with a sync flush, so each record still reaches the client as it is
+produced.
+"""
+import zlib
+
+from flask import request
+
+from app.utils.config_manager import config_manager
+
+try:
+    import brotli
+except ImportError:  # optional: br is simply not offered
+    brotli = None
+
+COMPRESSIBLE_TYPES = {
+    "application/json",
+    "application/scim+json",
+    "application/x-ndjson",
+    "application/xml",
+    "application/javascript",
+    "image/svg+xml",
+}
+STREAM_SLICE = 64 * 1024
+_ENCODINGS = (("br", "gzip", "deflate") if brotli is not None else ("gzip", "deflate"))
+
+
+class _Compressor:
+    """One-shot or incremental compressor for a content coding."""
+
+    def __init__(self, encoding, level):
+        self.encoding = encoding
+        if encoding == "br":
+            # Brotli quality 0-11; zlib's 1-9 scale maps onto its fast range.
+            self._c = brotli.Compressor(quality=min(11, max(0, level - 2)))
+        else:
+            wbits = 16 + zlib.MAX_WBITS if encoding == "gzip" else zlib.MAX_WBITS
+            self._c = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def compress(self, data):
+        if self.encoding == "br":
+            return self._c.process(data)
+        return self._c.compress(data)
+
+    def flush(self):
+        """Emit everything buffered so far without ending the stream."""
+        if self.encoding == "br":
+            return self._c.flush()
+        return self._c.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == "br":
+            return self._c.finish()
+        return self._c.flush(zlib.Z_FINISH)
+
+
+def _eligible_path(path):
+    return path.startswith("/admin/") or path.startswith(config_manager.SCIM_BASE_PATH)
+
+
+def _compressible(mimetype):
+    return mimetype.startswith("text/") or mimetype in COMPRESSIBLE_TYPES
+
+
+def _slices(body, compressor):
+    for i in range(0, len(body), STREAM_SLICE):
+        out = compressor.compress(body[i:i + STREAM_SLICE])
+        if out:
+            yield out
+    yield compressor.finish()
+
+
+def _chunks(iterable, compressor):
+    for chunk in iterable:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        out = compressor.compress(chunk) + compressor.flush()
+        if out:
+            yield out
+    yield compressor.finish()
+
+
+def compress_response(response):
+    """Compress `response` in place if the request and response qualify."""
+    if (not config_manager.COMPRESS_RESPONSES
+            or not _eligible_path(request.path)
+            or request.blueprint == "auth"
+            or request.method == "HEAD"
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or response.direct_passthrough
+            or "Content-Encoding" in response.headers
+            or not _compressible(response.mimetype or "")):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = request.accept_encodings.best_match(_ENCODINGS)
+    if encoding is None:
+        return response
+
+    compressor = _Compressor(encoding, config_manager.COMPRESS_LEVEL)
+    if response.is_streamed:
+        response.response = _chunks(response.response, compressor)
+        response.headers.pop("Content-Length", None)
+    else:
+        body = response.get_data()
+        if len(body) < config_manager.COMPRESS_MIN_BYTES:
+            return response
+        if len(body) >= config_manager.COMPRESS_STREAM_BYTES:
+            response.response = _slices(body, compressor)
+            response.headers.pop("Content-Length", None)
+        else:
+            response.set_data(compressor.compress(body) + compressor.finish())
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)  # the bytes differ from the identity body
+    return response
+
+
+def init_app(app):
+    """Register the compression hook. Call before other after_request hooks
+    are registered, so it runs last and sees their final response."""
+    app.after_request(compress_response)
@@ -86,6 +86,77 @@ class ConfigManager:
         self.CERT_PATH = os.getenv("CERT_PATH", "app/certs/idp-cert.pem")
         self.KEY_PATH = os.getenv("KEY_PATH", "app/certs/idp-key.pem")
         
+        # Optional SAML signing pool (app.utils.signing_pool). 0 = sign inline
+        # in the web worker (default). N > 0 = each gunicorn worker offloads
+        # the RSA signing to its own pool of N processes (entrypoint.py then
+        # runs gthread workers so other requests proceed meanwhile); at most
+        # SIGNING_POOL_MAX_QUEUE responses per worker may be waiting or signing
+        # at once (default 4 x N) — beyond that /login answers 503 instead of
+        # queueing.
+        self.SIGNING_POOL_SIZE = int(os.getenv("SIGNING_POOL_SIZE", 0))
+        self.SIGNING_POOL_MAX_QUEUE = int(os.getenv("SIGNING_POOL_MAX_QUEUE", 0)) or 4 * self.SIGNING_POOL_SIZE
+        self.SIGNING_POOL_TIMEOUT = float(os.getenv("SIGNING_POOL_TIMEOUT", 10))
+
+        # Most Responses one POST /admin/api/mint may ask for. The endpoint
+        # signs inline in the web worker, so this keeps a request well inside
+        # gunicorn's 30 s worker timeout; bulk runs use `python -m app.services.mint`.
+        self.MINT_HTTP_MAX_COUNT = int(os.getenv("MINT_HTTP_MAX_COUNT", 1000))
+
+        # IdP single sign-on session, in minutes. After a password login the
+        # browser session is trusted for this long: further AuthnRequests (to
+        # any SP) are answered without re-prompting, unless they carry
+        # ForceAuthn. 0 = no session, always prompt.
+        self.IDP_SESSION_LIFETIME = int(os.getenv("IDP_SESSION_LIFETIME", 480))
+
+        # HTTP-Artifact binding (app.utils.artifacts). Parked Responses expire
+        # after ARTIFACT_TTL seconds; the store holds at most
+        # ARTIFACT_MAX_ENTRIES rows / ARTIFACT_MAX_BYTES of Response XML and
+        # evicts the oldest to make room. A Response bigger than the whole
+        # budget falls back to HTTP-POST.
+        self.ARTIFACT_TTL = int(os.getenv("ARTIFACT_TTL", 60))
+        self.ARTIFACT_MAX_ENTRIES = int(os.getenv("ARTIFACT_MAX_ENTRIES", 10000))
+        self.ARTIFACT_MAX_BYTES = int(os.getenv("ARTIFACT_MAX_BYTES", 64 * 1024 * 1024))
+
+        # AuthnRequest replay protection. A request whose IssueInstant is more
+        # than AUTHN_REQUEST_MAX_AGE seconds old (plus clock skew) is refused;
+        # younger ones are remembered for that long, by (issuer, ID), so each
+        # can be answered with at most one assertion. The shared cache holds
+        # at most REPLAY_CACHE_MAX_ENTRIES IDs, oldest evicted first.
+        self.AUTHN_REQUEST_MAX_AGE = int(os.getenv("AUTHN_REQUEST_MAX_AGE", 300))
+        self.REPLAY_CACHE_MAX_ENTRIES = int(os.getenv("REPLAY_CACHE_MAX_ENTRIES", 100000))
+
+        # Single Logout fan-out: LogoutRequests go to at most SLO_CONCURRENCY
+        # SPs at a time, and each SP gets SLO_TIMEOUT seconds to answer before
+        # it is reported as timed out (partial logout).
+        self.SLO_CONCURRENCY = int(os.getenv("SLO_CONCURRENCY", 8))
+        self.SLO_TIMEOUT = float(os.getenv("SLO_TIMEOUT", 5))
+
+        # Response compression for /admin and SCIM (never the SAML pages).
+        # Bodies under COMPRESS_MIN_BYTES go out as-is; from
+        # COMPRESS_STREAM_BYTES up they are compressed and sent in chunks.
+        self.COMPRESS_RESPONSES = os.getenv("COMPRESS_RESPONSES", "true").lower() == "true"
+        self.COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", 6))
+        self.COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", 1024))
+        self.COMPRESS_STREAM_BYTES = int(os.getenv("COMPRESS_STREAM_BYTES", 256 * 1024))
+
+        # Signed IdP metadata. Off by default; when on, /metadata carries an
+        # enveloped signature plus validUntil (now + METADATA_VALID_HOURS) and
+        # cacheDuration. The signed bytes are cached and only re-signed on a
+        # cert/template/host change or once half the validity window is used.
+        self.SIGN_METADATA = os.getenv("SIGN_METADATA", "false").lower() == "true"
+        self.METADATA_VALID_HOURS = float(os.getenv("METADATA_VALID_HOURS", 168))
+        self.METADATA_CACHE_DURATION = os.getenv("METADATA_CACHE_DURATION", "PT6H")
+
+        # SP metadata auto-refresh (SPs imported from a metadata URL). The AAA
+        # runner re-fetches each one when its cacheDuration (else
+        # SP_METADATA_REFRESH seconds) runs out, clamped to the MIN/MAX bounds,
+        # with a conditional GET; SP rows are only written when the document
+        # actually changed.
+        self.SP_METADATA_REFRESH = int(os.getenv("SP_METADATA_REFRESH", 6 * 3600))
+        self.SP_METADATA_MIN_REFRESH = int(os.getenv("SP_METADATA_MIN_REFRESH", 300))
+        self.SP_METADATA_MAX_REFRESH = int(os.getenv("SP_METADATA_MAX_REFRESH", 24 * 3600))
+        self.SP_METADATA_TIMEOUT = float(os.getenv("SP_METADATA_TIMEOUT", 10))
+
         # Logging & Monitoring
         self.GLITCHTIP_DSN = os.getenv("GLITCHTIP_DSN")
         
@@ -131,6 +202,37 @@ class ConfigManager:
         self.TACACS_PORT = int(os.getenv("TACACS_PORT", 4949))
         self.AAA_DEFAULT_OTP = os.getenv("AAA_DEFAULT_OTP", "123456")
         self.AAA_BIND = os.getenv("AAA_BIND", "0.0.0.0")
+        # RADIUS concurrency: each port's requests are handled by RADIUS_WORKERS
+        # threads; at most RADIUS_QUEUE_DEPTH wait for one, beyond which new
+        # packets are dropped (the NAS retransmits) rather than answered late.
+        self.RADIUS_WORKERS = int(os.getenv("RADIUS_WORKERS", 4))
+        self.RADIUS_QUEUE_DEPTH = int(os.getenv("RADIUS_QUEUE_DEPTH", 128))
+        # RADIUS duplicate detection (RFC 5080): a retransmit within
+        # RADIUS_DEDUP_WINDOW seconds of the answer gets the cached reply; at
+        # most RADIUS_DEDUP_MAX_ENTRIES requests are remembered per port.
+        # 0 turns it off.
+        self.RADIUS_DEDUP_WINDOW = float(os.getenv("RADIUS_DEDUP_WINDOW", 10))
+        self.RADIUS_DEDUP_MAX_ENTRIES = int(os.getenv("RADIUS_DEDUP_MAX_ENTRIES", 10000))
+        # RADIUS MFA: an Access-Challenge State is honoured for
+        # RADIUS_CHALLENGE_TTL seconds; at most RADIUS_CHALLENGE_PER_USER are
+        # outstanding per user and RADIUS_CHALLENGE_MAX_ENTRIES overall.
+        self.RADIUS_CHALLENGE_TTL = float(os.getenv("RADIUS_CHALLENGE_TTL", 120))
+        self.RADIUS_CHALLENGE_MAX_ENTRIES = int(os.getenv("RADIUS_CHALLENGE_MAX_ENTRIES", 10000))
+        self.RADIUS_CHALLENGE_PER_USER = int(os.getenv("RADIUS_CHALLENGE_PER_USER", 3))
+        # AAA event log: the protocol process queues up to AAA_LOG_QUEUE rows
+        # (further events are dropped and counted) and writes them in batches of
+        # AAA_LOG_BATCH, or every AAA_LOG_FLUSH_MS milliseconds.
+        self.AAA_LOG_QUEUE = int(os.getenv("AAA_LOG_QUEUE", 10000))
+        self.AAA_LOG_BATCH = int(os.getenv("AAA_LOG_BATCH", 200))
+        self.AAA_LOG_FLUSH_MS = int(os.getenv("AAA_LOG_FLUSH_MS", 250))
+        # The AAA process keeps a snapshot of the user directory, reloaded when
+        # a commit changes users / groups / MFA, or after AAA_DIRECTORY_MAX_AGE
+        # seconds regardless (catches writes made outside the app).
+        self.AAA_DIRECTORY_MAX_AGE = float(os.getenv("AAA_DIRECTORY_MAX_AGE", 60))
+        # Every AAA_STATS_INTERVAL seconds the AAA process logs its counters
+        # (log writer, RADIUS, AAA directory) and writes them to data/ for
+        # /admin/api/aaa-stats. 0 turns it off.
+        self.AAA_STATS_INTERVAL = float(os.getenv("AAA_STATS_INTERVAL", 60))
         # The address gateways / Gaia point at. RADIUS (UDP) and TACACS+ reach
         # the container on the HOST's public IP, NOT the Traefik web domain — so
         # the portal shows the reachable address. Blank => auto-detect at runtime
@@ -152,18 +254,37 @@ class ConfigManager:
             pass
         return self.IDP_ENTITY_ID
 
+    def _endpoint_url(self, path):
+        """The URL to advertise for the IdP endpoint `path` ("/sso", "/slo",
+        ...): next to an explicit SSO_SERVICE_URL, else on the live request
+        host, else next to the default SSO_SERVICE_URL."""
+        if not self.SSO_SERVICE_URL_EXPLICIT:
+            try:
+                from flask import has_request_context, request
+                if has_request_context():
+                    return request.url_root.rstrip("/") + path
+            except Exception:
+                pass
+        sso = self.SSO_SERVICE_URL
+        base = sso[:-len("/sso")] if sso.endswith("/sso") else sso.rsplit("/", 1)[0]
+        return base + path
+
     def effective_sso_url(self):
         """The SSO endpoint URL to advertise. Explicit env var wins; otherwise
         derive from the live request host (…/sso) so SPs get a reachable URL."""
         if self.SSO_SERVICE_URL_EXPLICIT:
             return self.SSO_SERVICE_URL
-        try:
-            from flask import has_request_context, request
-            if has_request_context():
-                return request.url_root.rstrip("/") + "/sso"
-        except Exception:
-            pass
-        return self.SSO_SERVICE_URL
+        return self._endpoint_url("/sso")
+
+    def effective_artifact_url(self):
+        """The SOAP ArtifactResolutionService URL to advertise — the /artifact
+        endpoint next to the effective SSO URL."""
+        return self._endpoint_url("/artifact")
+
+    def effective_slo_url(self):
+        """The SingleLogoutService URL to advertise — the /slo endpoint next
+        to the effective SSO URL."""
+        return self._endpoint_url("/slo")
 
     def get_all_config(self):
         """Returns all configuration as a dictionary for template rendering.
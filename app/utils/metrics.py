@@ -0,0 +1,32 @@
+"""Counters behind the in-process stores' stats() (artifact store, replay
+cache, AAA log writer, RADIUS listeners, ...)."""
+import threading
+
+
+class Counters:
+    """Named counters under one lock, updated from any thread. `count` adds
+    to one and returns its new value, `add` bumps several at once, `peak`
+    keeps a maximum; `snapshot` is a consistent copy for stats()."""
+
+    def __init__(self, *names):
+        self._lock = threading.Lock()
+        self._values = dict.fromkeys(names, 0)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._values[name] += n
+            return self._values[name]
+
+    def add(self, **increments):
+        with self._lock:
+            for name, n in increments.items():
+                self._values[name] += n
+
+    def peak(self, name, value):
+        with self._lock:
+            if value > self._values[name]:
+                self._values[name] = value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._values)
@@ -0,0 +1,97 @@
+"""Bulk SAML assertion minting — signed Responses for load-testing an SP.
+
+Driving the browser login form is far too slow to produce thousands of
+assertions. `mint()` produces N signed Responses for a list of users and one
+SP with exactly the shape /login would send: the same claim plan, signing
+scope, assertion template and signer. It yields NDJSON-ready dicts as it goes,
+so the admin endpoint (`/admin/api/mint`) and the CLI (`python -m
+app.services.mint`) both stream.
+
+Rendering (cheap) happens in the calling process; the signatures (the
+expensive part) are spread over a dedicated process pool — one process per
+core by default — through `signing_pool.sign_many`. `processes=0` signs inline.
+
+Users are cycled in order until `count` Responses have been minted. Each
+Response is unsolicited (no InResponseTo) unless a `request_id` is given.
+"""
+import base64
+import os
+import time
+from itertools import cycle, islice
+
+from app.utils import signing_pool
+from app.utils.claims import claim_plan
+from app.utils.models import User
+
+MAX_MINT_COUNT = 100000
+
+
+class MintError(ValueError):
+    """Bad minting parameters (unknown SP/users, count out of range)."""
+
+
+def resolve_users(plan, usernames=None):
+    """Active users to mint for, loaded with the plan's groups in one query.
+    All active users if `usernames` is empty. Raises MintError on unknown names."""
+    query = plan.query().filter(User.active.is_(True))
+    if usernames:
+        users = query.filter(User.username.in_(usernames)).all()
+        by_name = {u.username: u for u in users}
+        missing = [n for n in usernames if n not in by_name]
+        if missing:
+            raise MintError(f"unknown or inactive users: {', '.join(missing)}")
+        return [by_name[n] for n in usernames]
+    users = query.order_by(User.id).all()
+    if not users:
+        raise MintError("no active users")
+    return users
+
+
+def mint(handler, sp, users, count, acs_url=None, processes=None, request_id=None):
+    """An iterator of {"seq", "user", "sp", "acs_url", "saml_response"} for
+    `count` Responses from `handler` (an IdPHandler) to `sp` (an SPRecord),
+    cycling through `users`. `acs_url` overrides the SP's (e.g. made
+    absolute). Arguments are validated, and claims resolved, before this
+    returns; the Responses are built and signed as the iterator is consumed."""
+    if not 1 <= count <= MAX_MINT_COUNT:
+        raise MintError(f"count must be between 1 and {MAX_MINT_COUNT}")
+    plan = claim_plan(sp)
+    sp_info = {"entity_id": sp.entity_id, "acs_url": acs_url or sp.acs_url,
+               "signing_scope": sp.signing_scope, "nameid_format": sp.nameid_format}
+    scope = sp.signing_scope or "both"
+    # Claims are per user, not per Response: resolve each user once.
+    user_infos = [(u.username, {"email": u.email, "attributes": plan.resolve(u)})
+                  for u in users]
+    picks = list(islice(cycle(user_infos), count))
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes < 0:
+        raise MintError("processes must be >= 0")
+    return _stream(handler, sp_info, scope, picks, processes, request_id)
+
+
+def _stream(handler, sp_info, scope, picks, processes, request_id):
+    if processes > 0:
+        jobs = ((handler.build_unsigned_xml(info, sp_info, request_id=request_id), scope)
+                for _, info in picks)
+        signed = signing_pool.sign_many(jobs, processes)
+    else:
+        signed = (handler.build_response_xml(info, sp_info, request_id=request_id)
+                  for _, info in picks)
+
+    for seq, ((username, _), xml_bytes) in enumerate(zip(picks, signed)):
+        yield {
+            "seq": seq,
+            "user": username,
+            "sp": sp_info["entity_id"],
+            "acs_url": sp_info["acs_url"],
+            "saml_response": base64.b64encode(xml_bytes).decode("ascii"),
+        }
+
+
+def summary(minted, started):
+    """The trailing NDJSON record: how many were minted and how fast."""
+    elapsed = time.perf_counter() - started
+    return {"done": True, "minted": minted, "seconds": round(elapsed, 3),
+            "per_sec": round(minted / elapsed, 1) if elapsed else None}
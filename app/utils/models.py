@@ -89,6 +89,52 @@ class User(db.Model, UserMixin):
         fields.append("password")
         return fields
 
+
+# Which parts of the SAML Response the IdP signs for an SP. Each signature is
+# an exclusive-C14N pass, a digest and an RSA private-key operation, so an SP
+# that validates only one of them can skip the other. "both" is the broadly
+# compatible default (SmartConsole validates the Response, most others the
+# Assertion).
+SIGNING_SCOPES = {
+    "both": "Response and Assertion",
+    "assertion": "Assertion only",
+    "response": "Response only",
+}
+DEFAULT_SIGNING_SCOPE = "both"
+
+
+def default_signing_scope(want_assertions_signed):
+    """Signing scope implied by an SP's metadata: `WantAssertionsSigned="true"`
+    means the SP validates the Assertion signature, so only the Assertion is
+    signed; `"false"` means it validates the Response, so only the Response
+    is; unstated (None) keeps the default, which satisfies either."""
+    if want_assertions_signed is None:
+        return DEFAULT_SIGNING_SCOPE
+    return "assertion" if want_assertions_signed else "response"
+
+
+# How the signed Response reaches the SP's ACS. "post" auto-POSTs the whole
+# base64 Response through the browser; "artifact" sends only a 44-byte SAML
+# artifact and the SP fetches the Response over the SOAP back channel
+# (/artifact) — see app.utils.artifacts.
+RESPONSE_BINDINGS = {
+    "post": "HTTP-POST",
+    "artifact": "HTTP-Artifact",
+}
+DEFAULT_RESPONSE_BINDING = "post"
+
+# How the IdP delivers a LogoutRequest to an SP's SingleLogoutService during
+# a logout fan-out. All three are sent server-side, in parallel: "soap" is
+# the synchronous back channel (the SP answers with a LogoutResponse); the
+# front-channel bindings are delivered as the browser would send them and a
+# 2xx/3xx counts as done (see app.utils.slo).
+SLO_BINDINGS = {
+    "soap": "SOAP",
+    "post": "HTTP-POST",
+    "redirect": "HTTP-Redirect",
+}
+DEFAULT_SLO_BINDING = "redirect"
+
     
 class ServiceProvider(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -97,8 +143,87 @@ class ServiceProvider(db.Model):
     name = db.Column(db.String(100))
     description = db.Column(db.Text)
     attr_map = db.Column(db.JSON, nullable=False, default=list)
+    # One of SIGNING_SCOPES — what build_response signs for this SP.
+    signing_scope = db.Column(db.String(16), nullable=False, default=DEFAULT_SIGNING_SCOPE)
+    # One of RESPONSE_BINDINGS — how /login delivers the Response to the ACS.
+    response_binding = db.Column(db.String(16), nullable=False, default=DEFAULT_RESPONSE_BINDING)
+    # PEM certificate the SP signs its AuthnRequests with (checked when present),
+    # and whether unsigned AuthnRequests are refused (metadata's AuthnRequestsSigned).
+    signing_cert = db.Column(db.Text)
+    authn_requests_signed = db.Column(db.Boolean, nullable=False, default=False)
+    # NameID Format to issue this SP: the first NameIDFormat in its metadata
+    # the IdP can issue (see saml.NAMEID_FORMATS), else empty. The value is
+    # always the user's email; saml.issued_nameid_format maps empty or an
+    # unsupported value to emailAddress.
+    nameid_format = db.Column(db.String(255))
+    # Metadata auto-refresh (see app.utils.sp_metadata.refresh_sp): the source
+    # URL, the HTTP validators and digest of the document last applied, and
+    # when it was applied. Empty metadata_url = managed by hand.
+    metadata_url = db.Column(db.String(1024))
+    metadata_etag = db.Column(db.String(255))
+    metadata_last_modified = db.Column(db.String(64))
+    metadata_digest = db.Column(db.String(64))
+    metadata_updated_at = db.Column(db.DateTime)
+    # SingleLogoutService endpoint and one of SLO_BINDINGS. Empty slo_url =
+    # the SP is not sent LogoutRequests.
+    slo_url = db.Column(db.String(1024))
+    slo_binding = db.Column(db.String(16), nullable=False, default=DEFAULT_SLO_BINDING)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    @property
+    def want_assertions_signed(self):
+        """The WantAssertionsSigned flag this SP's signing scope corresponds to."""
+        return self.signing_scope != "response"
+
+
+class SamlArtifact(db.Model):
+    """A signed Response parked for the HTTP-Artifact binding until the SP
+    resolves it (once) over SOAP. Rows live for ARTIFACT_TTL seconds; shared
+    through the DB so any gunicorn worker can answer the ArtifactResolve."""
+    __tablename__ = "saml_artifact"
+
+    handle = db.Column(db.String(40), primary_key=True)  # hex MessageHandle
+    sp_entity_id = db.Column(db.String(255), nullable=False)
+    payload = db.Column(db.LargeBinary, nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+
+class SeenAuthnRequest(db.Model):
+    """AuthnRequest replay cache: one row per (issuer, request ID) answered,
+    kept until the request could no longer be accepted anyway. Shared through
+    the DB so every gunicorn worker sees every other's (app.utils.replay_cache)."""
+    __tablename__ = "saml_seen_request"
+
+    key = db.Column(db.String(64), primary_key=True)  # sha256(issuer, ID) hex
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+class SessionParticipant(db.Model):
+    """An SP that was issued an assertion within an IdP login session — one
+    row per (IdP session, SP), with the NameID and SessionIndex it was sent,
+    so Single Logout knows whom to notify (app.utils.slo). Indexed by session
+    for the fan-out and by (SP, NameID) to find the session an SP's
+    LogoutRequest refers to."""
+    __tablename__ = "saml_session_participant"
+    __table_args__ = (
+        db.UniqueConstraint("session_id", "sp_id", name="uq_session_participant"),
+        db.Index("ix_session_participant_sp_nameid", "sp_entity_id", "name_id"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.String(64), nullable=False, index=True)
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    sp_id = db.Column(db.Integer, nullable=False)
+    sp_entity_id = db.Column(db.String(255), nullable=False)
+    name_id = db.Column(db.String(255), nullable=False)
+    name_id_format = db.Column(db.String(255))
+    session_index = db.Column(db.String(64), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+
 
 class ActivityLog(db.Model):
     """App-wide audit log — one row per notable change (auth, user/SP CRUD,
@@ -139,6 +264,47 @@ def ensure_schema(engine):
             conn.execute(text("ALTER TABLE user ADD COLUMN external_id VARCHAR(255)"))
             conn.execute(text("CREATE INDEX IF NOT EXISTS ix_user_external_id ON user (external_id)"))
 
+    # service_provider.signing_scope — added when the Response/Assertion
+    # signatures became configurable per SP. Existing SPs keep signing both.
+    if inspector.has_table("service_provider"):
+        sp_cols = {c["name"] for c in inspector.get_columns("service_provider")}
+        if "signing_scope" not in sp_cols:
+            with engine.begin() as conn:
+                conn.execute(text(
+                    "ALTER TABLE service_provider ADD COLUMN signing_scope VARCHAR(16) "
+                    "NOT NULL DEFAULT 'both'"
+                ))
+        # service_provider.response_binding — added with HTTP-Artifact support.
+        if "response_binding" not in sp_cols:
+            with engine.begin() as conn:
+                conn.execute(text(
+                    "ALTER TABLE service_provider ADD COLUMN response_binding VARCHAR(16) "
+                    "NOT NULL DEFAULT 'post'"
+                ))
+        # service_provider.signing_cert / authn_requests_signed — added with
+        # inbound AuthnRequest signature verification. Existing SPs stay unsigned.
+        if "signing_cert" not in sp_cols:
+            with engine.begin() as conn:
+                conn.execute(text("ALTER TABLE service_provider ADD COLUMN signing_cert TEXT"))
+        if "authn_requests_signed" not in sp_cols:
+            with engine.begin() as conn:
+                conn.execute(text(
+                    "ALTER TABLE service_provider ADD COLUMN authn_requests_signed BOOLEAN "
+                    "NOT NULL DEFAULT 0"
+                ))
+        # service_provider metadata import / auto-refresh and Single Logout columns.
+        for col, ddl in (("nameid_format", "VARCHAR(255)"),
+                         ("metadata_url", "VARCHAR(1024)"),
+                         ("metadata_etag", "VARCHAR(255)"),
+                         ("metadata_last_modified", "VARCHAR(64)"),
+                         ("metadata_digest", "VARCHAR(64)"),
+                         ("metadata_updated_at", "DATETIME"),
+                         ("slo_url", "VARCHAR(1024)"),
+                         ("slo_binding", "VARCHAR(16) NOT NULL DEFAULT 'redirect'")):
+            if col not in sp_cols:
+                with engine.begin() as conn:
+                    conn.execute(text(f"ALTER TABLE service_provider ADD COLUMN {col} {ddl}"))
+
     # scim_group.description — added when Groups became first-class admin-managed
     # entities. create_all() makes it on fresh DBs; this covers DBs that already
     # had scim_group (e.g. SCIM was used before this feature).
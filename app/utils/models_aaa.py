@@ -8,6 +8,8 @@ connection settings. Shared secrets and TOTP secrets are encrypted at rest.
 import io
 import json
 import os
+import queue
+import threading
 import time
 from datetime import datetime
 
@@ -18,6 +20,8 @@ import qrcode.image.svg
 from app.utils.models import db
 from app.utils.config_manager import config_manager
 from app.utils.crypto import encrypt_token, decrypt_token
+from app.utils.logger_main import logger
+from app.utils.metrics import Counters
 
 TOTP_ISSUER = "CP Identity & Access Sim"
 
@@ -201,7 +205,11 @@ def regenerate_totp(user_auth):
 
 
 def verify_totp(user_auth, code):
-    secret = get_totp_secret(user_auth)
+    return check_totp(get_totp_secret(user_auth), code)
+
+
+def check_totp(secret, code):
+    """True if `code` is the current (±1 step) TOTP for base32 `secret`."""
     if not secret or not code:
         return False
     try:
@@ -275,12 +283,134 @@ def recent_aaa_logs(proto=None, limit=150):
 
 
 def log_event(proto, kind, username, nas, result, detail="", meta=None):
+    """Record one AAA event. In the protocol process (after start_log_writer)
+    the row is queued for the batch writer; elsewhere it is committed here."""
+    row = {
+        "created_at": datetime.utcnow(), "proto": proto, "kind": kind,
+        "username": username or "", "nas": nas or "", "result": result,
+        "detail": (detail or "")[:255],
+        "meta": json.dumps(meta, default=str) if meta else None,
+    }
+    if _log_writer is not None:
+        _log_writer.submit(row)
+        return
     try:
-        db.session.add(AaaLog(
-            proto=proto, kind=kind, username=username or "",
-            nas=nas or "", result=result, detail=(detail or "")[:255],
-            meta=json.dumps(meta, default=str) if meta else None,
-        ))
+        db.session.add(AaaLog(**row))
         db.session.commit()
     except Exception:
         db.session.rollback()
+
+
+# --- Batched AAA log writer (protocol process) ------------------------------
+# A commit per RADIUS/TACACS+ packet is an fsync-class SQLite write in the
+# packet-handling thread, contending with the web workers for the one writer
+# lock. Instead, handlers queue rows and a single thread inserts them in one
+# executemany per AAA_LOG_BATCH rows or AAA_LOG_FLUSH_MS, whichever comes
+# first. A full queue (AAA_LOG_QUEUE) drops the event and counts it: logging
+# must never hold up an answer to a NAS.
+_log_writer = None
+_STOP = object()
+# Seconds between "log queue full" warnings.
+LOG_DROP_WARN_INTERVAL = 10.0
+
+
+class AaaLogWriter:
+    def __init__(self, app, max_queue, batch_size, flush_interval):
+        self._app = app
+        self._queue = queue.Queue(maxsize=max(1, max_queue))
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(0.0, flush_interval)
+        self._lock = threading.Lock()
+        self._next_warning = 0.0
+        self._counters = Counters("queued", "written", "dropped", "failed", "batches", "max_batch")
+        self._thread = threading.Thread(target=self._run, daemon=True, name="aaa-log-writer")
+
+    def submit(self, row):
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            dropped = self._counters.count("dropped")
+            with self._lock:
+                now = time.monotonic()
+                warn = now >= self._next_warning
+                if warn:
+                    self._next_warning = now + LOG_DROP_WARN_INTERVAL
+            if warn:
+                logger.warning("AAA log queue full (%d rows): dropping events, %d so far",
+                               self._queue.maxsize, dropped)
+            return
+        self._counters.count("queued")
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=10.0):
+        """Write out everything queued so far, then end the writer thread."""
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+
+    def _run(self):
+        with self._app.app_context():
+            stopping = False
+            while not stopping:
+                batch = []
+                item = self._queue.get()
+                deadline = time.monotonic() + self.flush_interval
+                while True:
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+                    if len(batch) >= self.batch_size:
+                        break
+                    try:
+                        item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+                if stopping:  # drain what was queued behind the stop marker
+                    while True:
+                        try:
+                            item = self._queue.get_nowait()
+                        except queue.Empty:
+                            break
+                        if item is not _STOP:
+                            batch.append(item)
+                if batch:
+                    self._write(batch)
+
+    def _write(self, rows):
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(AaaLog.__table__.insert(), rows)
+        except Exception:
+            self._counters.count("failed", len(rows))
+            logger.warning("AAA log write of %d rows failed", len(rows), exc_info=True)
+            return
+        self._counters.add(written=len(rows), batches=1)
+        self._counters.peak("max_batch", len(rows))
+
+    def stats(self) -> dict:
+        return {**self._counters.snapshot(), "pending": self._queue.qsize(), "max_queue": self._queue.maxsize,
+                "batch_size": self.batch_size, "flush_ms": int(self.flush_interval * 1000)}
+
+
+def start_log_writer(app):
+    """Route log_event through a batch writer thread (protocol process only)."""
+    global _log_writer
+    if _log_writer is None:
+        _log_writer = AaaLogWriter(app, config_manager.AAA_LOG_QUEUE,
+                                   config_manager.AAA_LOG_BATCH,
+                                   config_manager.AAA_LOG_FLUSH_MS / 1000.0).start()
+    return _log_writer
+
+
+def stop_log_writer():
+    """Flush queued log rows and go back to committing inline."""
+    global _log_writer
+    writer, _log_writer = _log_writer, None
+    if writer is not None:
+        writer.stop()
@@ -8,7 +8,7 @@ UTILS_DIR = APP_DIR / "utils"
 CONFIG_DIR = APP_DIR / "config"
 IDP_CONFIG_DIR = CONFIG_DIR / "idps"
 CERTS_DIR = APP_DIR / "certs"
-LOGS_DIR = BASE_DIR / "logs"
+LOGS_DIR = Path(os.getenv("IDP_LOGS_DIR") or BASE_DIR / "logs")
 STATIC_DIR = APP_DIR / "static"
 TEMPLATES_DIR = APP_DIR / "templates"
 
@@ -0,0 +1,146 @@
+"""AuthnRequest replay protection.
+
+Without it, one captured AuthnRequest can be posted to /sso over and over to
+mint an assertion per submission, each carrying the same InResponseTo. Two
+checks close that:
+
+- Freshness: a request whose IssueInstant is older than AUTHN_REQUEST_MAX_AGE
+  (plus CLOCK_SKEW) — or that far in the future — is refused outright.
+- Uniqueness: a request that is fresh is remembered by (issuer, ID) for as
+  long as it could still pass the freshness check. /sso refuses one it has
+  already seen (`seen`), and an assertion is only issued after atomically
+  claiming the ID (`claim`), so each AuthnRequest yields at most one.
+
+The remembered IDs live in the `saml_seen_request` table, not process
+memory: gunicorn runs several workers and a replay can land on any of them.
+Lookups and claims are primary-key operations on a fixed-width digest of
+(issuer, ID). Expired rows are purged, and the REPLAY_CACHE_MAX_ENTRIES bound
+enforced (oldest first), at most once every PURGE_INTERVAL seconds per
+process rather than on every claim, so the hot path never scans the table.
+Counters are per process; `stats()` adds the live table size.
+"""
+import hashlib
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.utils.config_manager import config_manager
+from app.utils.logger_main import logger
+from app.utils.metrics import Counters
+from app.utils.models import db, SeenAuthnRequest
+from app.utils.saml import parse_instant
+
+CLOCK_SKEW = timedelta(seconds=60)
+PURGE_INTERVAL = 10.0
+
+
+def _cache_key(issuer, request_id):
+    return hashlib.sha256(f"{issuer or ''}\0{request_id}".encode("utf-8")).hexdigest()
+
+
+class ReplayCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next_purge = 0.0
+        self._counters = Counters("lookups", "replays", "claimed", "released", "stale",
+                                  "purged", "evicted")
+
+    @property
+    def ttl(self):
+        return timedelta(seconds=config_manager.AUTHN_REQUEST_MAX_AGE) + CLOCK_SKEW
+
+    def is_stale(self, issue_instant):
+        """True if an AuthnRequest with this IssueInstant may no longer be
+        accepted: too old, too far in the future, or unreadable."""
+        issued = parse_instant(issue_instant)
+        now = datetime.utcnow()
+        stale = issued is None or issued < now - self.ttl or issued > now + CLOCK_SKEW
+        if stale:
+            self._counters.count("stale")
+        return stale
+
+    def seen(self, issuer, request_id):
+        """True if the request has already been answered (a replay)."""
+        self._counters.count("lookups")
+        table = SeenAuthnRequest.__table__
+        with db.engine.connect() as conn:
+            expires_at = conn.execute(
+                select(table.c.expires_at).where(table.c.key == _cache_key(issuer, request_id))
+            ).scalar()
+        replay = expires_at is not None and expires_at > datetime.utcnow()
+        if replay:
+            self._counters.count("replays")
+        return replay
+
+    def claim(self, issuer, request_id):
+        """Record the request as answered. True if this call claimed it; False
+        if it was already claimed (by any worker) and hasn't expired."""
+        self._counters.count("lookups")
+        key = _cache_key(issuer, request_id)
+        now = datetime.utcnow()
+        table = SeenAuthnRequest.__table__
+        with db.engine.begin() as conn:
+            conn.execute(delete(table).where(table.c.key == key, table.c.expires_at <= now))
+            claimed = conn.execute(
+                insert(table).values(key=key, created_at=now, expires_at=now + self.ttl)
+                .on_conflict_do_nothing(index_elements=[table.c.key])
+            ).rowcount == 1
+        self._counters.count("claimed" if claimed else "replays")
+        self._maybe_purge()
+        return claimed
+
+    def release(self, issuer, request_id):
+        """Undo a claim whose assertion was never sent (e.g. the signing pool
+        shed the login), so the user's retry isn't taken for a replay."""
+        table = SeenAuthnRequest.__table__
+        with db.engine.begin() as conn:
+            conn.execute(delete(table).where(table.c.key == _cache_key(issuer, request_id)))
+        self._counters.count("released")
+
+    def _maybe_purge(self):
+        mono = time.monotonic()
+        with self._lock:
+            if mono < self._next_purge:
+                return
+            self._next_purge = mono + PURGE_INTERVAL
+        try:
+            self.purge()
+        except SQLAlchemyError:
+            logger.warning("AuthnRequest replay cache purge failed", exc_info=True)
+
+    def purge(self):
+        """Drop expired rows, then the oldest beyond REPLAY_CACHE_MAX_ENTRIES."""
+        table = SeenAuthnRequest.__table__
+        with db.engine.begin() as conn:
+            purged = conn.execute(
+                delete(table).where(table.c.expires_at <= datetime.utcnow())
+            ).rowcount
+            size = conn.execute(select(func.count()).select_from(table)).scalar()
+            excess = size - config_manager.REPLAY_CACHE_MAX_ENTRIES
+            evicted = 0
+            if excess > 0:
+                oldest = select(table.c.key).order_by(table.c.created_at).limit(excess)
+                evicted = conn.execute(delete(table).where(table.c.key.in_(oldest))).rowcount
+        if evicted:
+            logger.warning("AuthnRequest replay cache full: evicted %d unexpired ID(s)", evicted)
+        self._counters.add(purged=purged, evicted=evicted)
+
+    def stats(self) -> dict:
+        """Per-process counters plus the live table size, for the admin API."""
+        m = self._counters.snapshot()
+        with db.engine.connect() as conn:
+            size = conn.execute(select(func.count()).select_from(SeenAuthnRequest.__table__)).scalar()
+        return {
+            **m,
+            "hit_rate": round(m["replays"] / m["lookups"], 4) if m["lookups"] else 0.0,
+            "size": size,
+            "max_entries": config_manager.REPLAY_CACHE_MAX_ENTRIES,
+            "ttl": int(self.ttl.total_seconds()),
+        }
+
+
+replay_cache = ReplayCache()
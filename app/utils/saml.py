@@ -1,7 +1,9 @@
 """SAML 2.0 Identity Provider logic.
 
 Parses an incoming SP `AuthnRequest` and emits a SAML `Response` containing a
-single **signed** `Assertion` (RSA-SHA256, exclusive C14N, enveloped signature).
+single **signed** `Assertion` (RSA-SHA256 — or ECDSA for an EC key — exclusive
+C14N, enveloped signature). Also reads and writes the Single Logout messages
+(`LogoutRequest` / `LogoutResponse`, see app.utils.slo).
 The signing key/cert are the IdP's X.509 material in app/certs — the same trust
 anchor advertised in /metadata, which Service Providers import and validate.
 
@@ -11,85 +13,455 @@ Design notes:
   moved into a new parent document.
 - `WantAssertionsSigned="true"` is what Check Point SPs request, so we sign the
   assertion (not the Response envelope).
+- Assertions are rendered from a per-SP `AssertionTemplate` compiled from
+  `_build_assertion`, which stays the reference builder for the XML shape.
 """
 import base64
+import copy
+import hashlib
+import threading
 import uuid
 import zlib
 from datetime import datetime, timedelta
+from urllib.parse import quote_plus
 
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
 from lxml import etree
-from signxml import XMLSigner, methods
+from OpenSSL.crypto import FILETYPE_PEM, load_certificate
+from signxml import XMLSigner, XMLVerifier, methods
+from signxml.util import iterate_pem
 
+from app.utils import signing_pool
 from app.utils.path_config import IDP_CERT, IDP_KEY
 from app.utils.config_manager import config_manager
+from app.utils.version_file import file_stamp
 
 SAML_NS = "urn:oasis:names:tc:SAML:2.0:assertion"
 SAMLP_NS = "urn:oasis:names:tc:SAML:2.0:protocol"
 DS_NS = "http://www.w3.org/2000/09/xmldsig#"
+SOAP_NS = "http://schemas.xmlsoap.org/soap/envelope/"
 NSMAP = {"samlp": SAMLP_NS, "saml": SAML_NS}
 
 NAMEID_EMAIL = "urn:oasis:names:tc:SAML:1.1:nameid-format:emailAddress"
+NAMEID_UNSPECIFIED = "urn:oasis:names:tc:SAML:1.1:nameid-format:unspecified"
+# NameID Formats the IdP can issue. The NameID value is the user's email in both.
+NAMEID_FORMATS = (NAMEID_EMAIL, NAMEID_UNSPECIFIED)
 ATTR_FORMAT_BASIC = "urn:oasis:names:tc:SAML:2.0:attrname-format:basic"
 AUTHN_CTX_PASSWORD = "urn:oasis:names:tc:SAML:2.0:ac:classes:PasswordProtectedTransport"
 STATUS_SUCCESS = "urn:oasis:names:tc:SAML:2.0:status:Success"
+STATUS_RESPONDER = "urn:oasis:names:tc:SAML:2.0:status:Responder"
+STATUS_NO_PASSIVE = "urn:oasis:names:tc:SAML:2.0:status:NoPassive"
+STATUS_REQUESTER = "urn:oasis:names:tc:SAML:2.0:status:Requester"
+STATUS_PARTIAL_LOGOUT = "urn:oasis:names:tc:SAML:2.0:status:PartialLogout"
+BINDING_POST = "urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST"
+BINDING_ARTIFACT = "urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Artifact"
+BINDING_REDIRECT = "urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect"
+BINDING_SOAP = "urn:oasis:names:tc:SAML:2.0:bindings:SOAP"
 
 
 def _iso(dt: datetime) -> str:
     return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
 
 
+def parse_instant(value):
+    """An xs:dateTime (IssueInstant, NotOnOrAfter, validUntil; UTC) as a naive
+    datetime to the second, or None if absent or malformed."""
+    try:
+        return datetime.strptime(value.strip()[:19], "%Y-%m-%dT%H:%M:%S") if value else None
+    except ValueError:
+        return None
+
+
 def _new_id() -> str:
     # SAML IDs must not start with a digit (xs:ID / NCName).
     return "_" + uuid.uuid4().hex
 
 
+def issued_nameid_format(sp_format) -> str:
+    """The NameID Format to issue for an SP's stored `nameid_format`:
+    emailAddress unless it is another of NAMEID_FORMATS."""
+    return sp_format if sp_format in NAMEID_FORMATS else NAMEID_EMAIL
+
+
 def _q(ns: str, tag: str) -> str:
     return f"{{{ns}}}{tag}"
 
 
+# Hardened lxml parser — no DTD, no entity resolution, no network, no huge
+# trees — so inbound SAML can't trigger XXE / entity expansion. lxml parsers
+# are reusable but not thread-safe, so each thread keeps its own.
+_parsers = threading.local()
+
+
+def parse_xml(data: bytes):
+    """Parse untrusted XML with this thread's shared hardened parser."""
+    parser = getattr(_parsers, "parser", None)
+    if parser is None:
+        parser = _parsers.parser = etree.XMLParser(
+            resolve_entities=False, no_network=True,
+            dtd_validation=False, load_dtd=False, huge_tree=False,
+        )
+    return etree.fromstring(data, parser=parser)
+
+
+class SAMLRequestTooLarge(ValueError):
+    """A SAMLRequest over the size limits, encoded or inflated."""
+
+
+# signxml algorithm fragment + XML-DSig URI per supported key. The signature
+# algorithm follows the key in app/certs — see entrypoint.generate_certificates
+# (IDP_KEY_TYPE) — and is advertised in /metadata as alg:SigningMethod.
+DSIG_MORE = "http://www.w3.org/2001/04/xmldsig-more#"
+_EC_SIGNATURE_ALGORITHMS = {
+    "secp256r1": "ecdsa-sha256",
+    "secp384r1": "ecdsa-sha384",
+}
+
+
+def _signature_algorithm_for(key):
+    """(signxml algorithm fragment, human-readable key type) for a private key."""
+    if isinstance(key, rsa.RSAPrivateKey):
+        return "rsa-sha256", f"RSA-{key.key_size}"
+    if isinstance(key, ec.EllipticCurvePrivateKey):
+        alg = _EC_SIGNATURE_ALGORITHMS.get(key.curve.name)
+        if alg is None:
+            raise ValueError(f"Unsupported EC curve for SAML signing: {key.curve.name}")
+        return alg, f"ECDSA P-{key.curve.key_size}"
+    raise ValueError(f"Unsupported signing key type: {type(key).__name__}")
+
+
+class SigningMaterial:
+    """The IdP key/cert, parsed once and reused for every signature.
+
+    signxml re-parses a PEM key on every `sign()` call when handed bytes, which
+    is two private-key loads per login. This holds the loaded `cryptography`
+    key object and the pre-split PEM cert chain instead, and reloads only when
+    the key or cert file's stamp (inode/mtime/size) changes — one cheap stat()
+    per file per signature, so a rotated cert is picked up without a restart.
+    """
+
+    def __init__(self, cert_path=IDP_CERT, key_path=IDP_KEY):
+        self.cert_path = cert_path
+        self.key_path = key_path
+        self._lock = threading.Lock()
+        self._stamp = None
+        self.cert_pem = b""
+        self.key_pem = b""
+        self.key = None
+        self.cert_chain = []
+        self.cert_x509 = None
+        self.signature_algorithm = "rsa-sha256"
+        self.key_type = None
+
+    @property
+    def stamp(self):
+        """Identity of the loaded files; changes whenever the material reloads."""
+        return self._stamp
+
+    @property
+    def signature_method_uri(self):
+        """XML-DSig SignatureMethod URI for the current key (for metadata)."""
+        return DSIG_MORE + self.signature_algorithm
+
+    def current(self):
+        """Return self after reloading the material if either file changed."""
+        stamp = (file_stamp(self.cert_path), file_stamp(self.key_path))
+        if stamp != self._stamp:
+            with self._lock:
+                if stamp != self._stamp:
+                    self._load(stamp)
+        return self
+
+    def _load(self, stamp):
+        with open(self.cert_path, "rb") as f:
+            cert_pem = f.read()
+        with open(self.key_path, "rb") as f:
+            key_pem = f.read()
+        key = load_pem_private_key(key_pem, password=None)
+        self.signature_algorithm, self.key_type = _signature_algorithm_for(key)
+        self.key = key
+        self.cert_chain = list(iterate_pem(cert_pem))
+        self.cert_x509 = load_certificate(FILETYPE_PEM, cert_pem)  # verifier trust anchor
+        self.cert_pem = cert_pem
+        self.key_pem = key_pem
+        self._stamp = stamp
+
+
+# The process-wide signing material, shared by every IdPHandler and by
+# /metadata (which advertises the algorithm it implies).
+signing_material = SigningMaterial()
+
+
+def sign_enveloped(element, material, position):
+    """Enveloped / exclusive-C14N signature over `element` with `material`'s
+    key, referencing the element's own ID, and with ds:Signature moved to
+    child index `position` (schemas pin where the Signature may appear)."""
+    signer = XMLSigner(
+        method=methods.enveloped,
+        signature_algorithm=material.signature_algorithm,
+        digest_algorithm="sha256",
+        c14n_algorithm="http://www.w3.org/2001/10/xml-exc-c14n#",
+    )
+    signed = signer.sign(element, key=material.key, cert=material.cert_chain,
+                         reference_uri=element.get("ID"))
+    sig = signed.find(_q(DS_NS, "Signature"))
+    if sig is not None:
+        signed.remove(sig)
+        signed.insert(position, sig)
+    return signed
+
+
+_REDIRECT_HASHES = {
+    "rsa-sha256": hashes.SHA256,
+    "ecdsa-sha256": hashes.SHA256,
+    "ecdsa-sha384": hashes.SHA384,
+}
+
+
+def redirect_query(param, xml_bytes, material, relay_state=None):
+    """HTTP-Redirect binding query string for a SAML message: the XML
+    deflated and base64'd into `param` ("SAMLRequest" / "SAMLResponse"),
+    signed over `param=..&RelayState=..&SigAlg=..` with `material`'s key
+    (SAML Bindings §3.4.4.1)."""
+    deflater = zlib.compressobj(9, zlib.DEFLATED, -15)
+    encoded = base64.b64encode(deflater.compress(xml_bytes) + deflater.flush()).decode("ascii")
+    query = f"{param}={quote_plus(encoded)}"
+    if relay_state:
+        query += f"&RelayState={quote_plus(relay_state)}"
+    query += f"&SigAlg={quote_plus(material.signature_method_uri)}"
+    hash_alg = _REDIRECT_HASHES[material.signature_algorithm]()
+    data = query.encode("ascii")
+    if isinstance(material.key, rsa.RSAPrivateKey):
+        signature = material.key.sign(data, padding.PKCS1v15(), hash_alg)
+    else:
+        signature = material.key.sign(data, ec.ECDSA(hash_alg))
+    return query + "&Signature=" + quote_plus(base64.b64encode(signature).decode("ascii"))
+
+
+class AssertionTemplate:
+    """A pre-built Assertion skeleton for one SP shape, filled in per login.
+
+    The skeleton is produced by `IdPHandler._build_assertion` itself (with
+    placeholder values), so its element order, attribute order and namespace
+    declarations are exactly what the reference builder emits. Everything that
+    is constant for an SP — issuer, audience, recipient ACS, the claim names —
+    and NameID Format — is baked in; a login only deep-copies the tree (one
+    C-level call) and sets
+    the per-login slots: IDs, timestamps, NameID, InResponseTo and the
+    attribute values.
+    """
+
+    _EPOCH = datetime(1970, 1, 1)
+
+    def __init__(self, build, issuer, audience, acs_url, attr_names, with_request_id,
+                 nameid_format=NAMEID_EMAIL):
+        self.attr_names = attr_names
+        placeholder = {"email": "", "attributes": {name: [] for name in attr_names}}
+        self.skeleton = build(
+            placeholder, issuer, audience, acs_url, "",
+            self._EPOCH, self._EPOCH, self._EPOCH,
+            "_" if with_request_id else None,
+            nameid_format=nameid_format,
+        )
+
+    def render(self, user_info, assertion_id, now, not_before, not_after, request_id,
+               authn_instant=None, session_index=None):
+        issued, expires = _iso(now), _iso(not_after)
+        assertion = copy.deepcopy(self.skeleton)
+        assertion.set("ID", assertion_id)
+        assertion.set("IssueInstant", issued)
+
+        subject = assertion.find(_q(SAML_NS, "Subject"))
+        subject.find(_q(SAML_NS, "NameID")).text = user_info["email"]
+        scd = subject.find(f"{_q(SAML_NS, 'SubjectConfirmation')}/{_q(SAML_NS, 'SubjectConfirmationData')}")
+        scd.set("NotOnOrAfter", expires)
+        if request_id:
+            scd.set("InResponseTo", request_id)
+
+        conditions = assertion.find(_q(SAML_NS, "Conditions"))
+        conditions.set("NotBefore", _iso(not_before))
+        conditions.set("NotOnOrAfter", expires)
+
+        authn = assertion.find(_q(SAML_NS, "AuthnStatement"))
+        authn.set("AuthnInstant", _iso(authn_instant) if authn_instant else issued)
+        authn.set("SessionIndex", session_index or assertion_id)
+
+        attributes = user_info.get("attributes") or {}
+        if attributes:
+            attr_stmt = assertion.find(_q(SAML_NS, "AttributeStatement"))
+            for attr, name in zip(attr_stmt, self.attr_names):
+                for v in attributes[name]:
+                    etree.SubElement(attr, _q(SAML_NS, "AttributeValue")).text = str(v)
+        return assertion
+
+
 class IdPHandler:
-    def __init__(self):
-        with open(IDP_CERT, "rb") as f:
-            self.cert = f.read()
-        with open(IDP_KEY, "rb") as f:
-            self.key = f.read()
+    # Compiled AssertionTemplates, keyed by everything that shapes the
+    # skeleton. Bounded: oldest entries are dropped once it's full.
+    TEMPLATE_CACHE_SIZE = 256
+    # verify_signature results, keyed by (assertion ID, SHA-256 of the
+    # document) and kept until the assertion's NotOnOrAfter.
+    VERIFY_CACHE_SIZE = 1024
+    # Inbound AuthnRequest limits: the base64 SAMLRequest as received, and the
+    # XML after Redirect-binding inflation (a few KB is typical for both).
+    MAX_REQUEST_BYTES = 64 * 1024
+    MAX_INFLATED_BYTES = 256 * 1024
+
+    def __init__(self, material=None):
+        """`material` (a SigningMaterial) defaults to the process-wide IdP
+        key/cert in app/certs."""
+        self.material = (material or signing_material).current()
+        self._templates = {}
+        self._templates_lock = threading.Lock()
+        self._verified = {}
+        self._verified_lock = threading.Lock()
+
+    @property
+    def cert(self) -> bytes:
+        """PEM bytes of the current signing certificate."""
+        return self.material.current().cert_pem
+
+    @property
+    def key(self) -> bytes:
+        """PEM bytes of the current signing key."""
+        return self.material.current().key_pem
 
     # ------------------------------------------------------------------ inbound
     def decode_request(self, saml_request_b64: str) -> bytes:
         """Decode a SAMLRequest. HTTP-Redirect binding deflates the XML;
-        HTTP-POST binding sends it raw. Try inflate, fall back to plain."""
+        HTTP-POST binding sends it raw. Try inflate, fall back to plain.
+
+        Raises SAMLRequestTooLarge before decoding when the encoded request is
+        over MAX_REQUEST_BYTES, and stops inflating once the output passes
+        MAX_INFLATED_BYTES, so a small deflate bomb can't balloon in memory."""
+        if len(saml_request_b64) > self.MAX_REQUEST_BYTES:
+            raise SAMLRequestTooLarge("SAMLRequest exceeds %d bytes" % self.MAX_REQUEST_BYTES)
         decoded = base64.b64decode(saml_request_b64)
+        inflater = zlib.decompressobj(-15)
         try:
-            return zlib.decompress(decoded, -15)
+            xml = inflater.decompress(decoded, self.MAX_INFLATED_BYTES + 1)
         except zlib.error:
             return decoded
+        if len(xml) > self.MAX_INFLATED_BYTES:
+            raise SAMLRequestTooLarge("inflated SAMLRequest exceeds %d bytes" % self.MAX_INFLATED_BYTES)
+        if not inflater.eof:
+            return decoded  # truncated / not a deflate stream after all
+        return xml
 
     def parse_request(self, saml_request_b64: str) -> dict:
-        """Extract the request ID, issuer (SP entityID) and optional ACS URL.
-
-        Parsed with a hardened parser (no DTD, no entity resolution, no network)
-        so a malicious AuthnRequest can't trigger XXE / entity-expansion."""
-        xml = self.decode_request(saml_request_b64)
-        parser = etree.XMLParser(
-            resolve_entities=False, no_network=True,
-            dtd_validation=False, load_dtd=False, huge_tree=False,
-        )
-        root = etree.fromstring(xml, parser=parser)
+        """Extract the request ID, issuer (SP entityID) and optional ACS URL
+        (see `request_fields`), plus the parsed tree as "root" for signature
+        checks (app.utils.request_signing).
+
+        Parsed with the shared hardened parser (see `parse_xml`) so a
+        malicious AuthnRequest can't trigger XXE / entity-expansion."""
+        root = parse_xml(self.decode_request(saml_request_b64))
+        return {**self.request_fields(root), "root": root}
+
+    @staticmethod
+    def request_fields(root) -> dict:
+        """The fields /sso acts on, read from an AuthnRequest element."""
         issuer_el = root.find(_q(SAML_NS, "Issuer"))
         issuer = issuer_el.text.strip() if issuer_el is not None and issuer_el.text else None
         return {
             "request_id": root.get("ID"),
+            "issue_instant": root.get("IssueInstant"),
             "issuer": issuer,
             "acs_url": root.get("AssertionConsumerServiceURL"),
+            "force_authn": root.get("ForceAuthn") in ("true", "1"),
+            "is_passive": root.get("IsPassive") in ("true", "1"),
+            "protocol_binding": root.get("ProtocolBinding"),
+        }
+
+    def parse_logout_request(self, saml_request_b64: str) -> dict:
+        """Extract the request ID, issuer, NameID and SessionIndex values of a
+        LogoutRequest (either binding), plus the parsed tree as "root".
+        Raises ValueError if the message isn't a LogoutRequest."""
+        root = parse_xml(self.decode_request(saml_request_b64))
+        if root.tag != _q(SAMLP_NS, "LogoutRequest"):
+            raise ValueError("not a samlp:LogoutRequest")
+        return {**self.logout_fields(root), "root": root}
+
+    @staticmethod
+    def logout_fields(root) -> dict:
+        """The fields /slo acts on, read from a LogoutRequest element."""
+        def text(el):
+            return el.text.strip() if el is not None and el.text else None
+        return {
+            "request_id": root.get("ID"),
+            "issuer": text(root.find(_q(SAML_NS, "Issuer"))),
+            "name_id": text(root.find(_q(SAML_NS, "NameID"))),
+            "session_indexes": [t for t in map(text, root.findall(_q(SAMLP_NS, "SessionIndex"))) if t],
+        }
+
+    def parse_artifact_resolve(self, xml_bytes: bytes) -> dict:
+        """Extract ID, Issuer and Artifact from a SOAP-wrapped ArtifactResolve.
+        Raises ValueError if the envelope doesn't carry one."""
+        if len(xml_bytes) > self.MAX_REQUEST_BYTES:
+            raise SAMLRequestTooLarge("ArtifactResolve exceeds %d bytes" % self.MAX_REQUEST_BYTES)
+        envelope = parse_xml(xml_bytes)
+        resolve = envelope.find(f"{_q(SOAP_NS, 'Body')}/{_q(SAMLP_NS, 'ArtifactResolve')}")
+        if resolve is None:
+            raise ValueError("no samlp:ArtifactResolve in SOAP Body")
+        issuer_el = resolve.find(_q(SAML_NS, "Issuer"))
+        artifact_el = resolve.find(_q(SAMLP_NS, "Artifact"))
+        return {
+            "root": resolve,
+            "request_id": resolve.get("ID"),
+            "issuer": issuer_el.text.strip() if issuer_el is not None and issuer_el.text else None,
+            "artifact": artifact_el.text.strip() if artifact_el is not None and artifact_el.text else "",
         }
 
     # ----------------------------------------------------------------- outbound
-    def build_response(self, user_info: dict, sp_info: dict, request_id=None) -> str:
+    def build_response(self, user_info: dict, sp_info: dict, request_id=None,
+                       authn_instant=None) -> str:
         """Return a base64-encoded, signed SAML Response (for HTTP-POST to ACS).
+        See `build_response_xml` for the arguments."""
+        return base64.b64encode(self.build_response_xml(
+            user_info, sp_info, request_id=request_id, authn_instant=authn_instant,
+        )).decode("ascii")
+
+    def build_response_xml(self, user_info: dict, sp_info: dict, request_id=None,
+                           authn_instant=None, session_index=None) -> bytes:
+        """Return the signed SAML Response as serialized XML.
 
         user_info: {"email": str, "attributes": {name: [values...]}}
-        sp_info:   {"entity_id": str, "acs_url": str}
+        sp_info:   {"entity_id": str, "acs_url": str,
+                    "signing_scope": "both" | "assertion" | "response" (optional),
+                    "nameid_format": one of NAMEID_FORMATS (optional, emailAddress)}
+        authn_instant: when the user actually authenticated (an IdP session
+                       reused across SPs); defaults to now.
+        session_index: the AuthnStatement SessionIndex the SP will quote in
+                       Single Logout; defaults to the assertion ID.
         """
+        response, assertion = self._unsigned_response(user_info, sp_info, request_id,
+                                                      authn_instant, session_index)
+        scope = sp_info.get("signing_scope") or "both"
+        if signing_pool.enabled():
+            # Hand the RSA work to the signing pool so this worker isn't held
+            # for it; raises SigningPoolBusy when the pool's queue is full.
+            response.append(assertion)
+            xml_bytes = signing_pool.sign(etree.tostring(response), scope)
+        else:
+            xml_bytes = etree.tostring(self._apply_signatures(response, assertion, scope),
+                                       xml_declaration=False)
+        return xml_bytes
+
+    def build_unsigned_xml(self, user_info: dict, sp_info: dict, request_id=None,
+                           authn_instant=None) -> bytes:
+        """The Response `build_response_xml` would sign, serialized unsigned
+        with the Assertion embedded — input for `sign_serialized` in another
+        process (bulk minting)."""
+        response, assertion = self._unsigned_response(user_info, sp_info, request_id,
+                                                      authn_instant)
+        response.append(assertion)
+        return etree.tostring(response)
+
+    def _unsigned_response(self, user_info, sp_info, request_id, authn_instant,
+                           session_index=None):
+        """(Response envelope, rendered Assertion) — not yet joined or signed."""
         now = datetime.utcnow()
         not_before = now - timedelta(minutes=5)
         not_after = now + timedelta(minutes=60)
@@ -97,7 +469,96 @@ class IdPHandler:
         acs_url = sp_info["acs_url"]
         audience = sp_info.get("entity_id") or ""
         assertion_id = _new_id()
-
+        response = self._response_envelope(issuer, acs_url, request_id, now, STATUS_SUCCESS)
+
+        assertion = self._assertion_template(
+            issuer, audience, acs_url, user_info, request_id,
+            issued_nameid_format(sp_info.get("nameid_format")),
+        ).render(user_info, assertion_id, now, not_before, not_after, request_id,
+                 authn_instant, session_index)
+        return response, assertion
+
+    def build_status_response(self, sp_info: dict, status: str, sub_status=None,
+                              request_id=None) -> str:
+        """Return a base64-encoded, signed assertion-less Response carrying a
+        failure status — e.g. Responder/NoPassive when an IsPassive request
+        arrives without a live IdP session."""
+        response = self._response_envelope(
+            config_manager.effective_entity_id(), sp_info["acs_url"], request_id,
+            datetime.utcnow(), status, sub_status,
+        )
+        return base64.b64encode(etree.tostring(self._sign(response))).decode("ascii")
+
+    def build_logout_request(self, destination, name_id, name_id_format=NAMEID_EMAIL,
+                             session_index=None, sign=True):
+        """(request ID, serialized LogoutRequest) asking the SP at
+        `destination` to end `name_id`'s session `session_index`. Pass
+        sign=False for HTTP-Redirect, which signs the query string instead
+        (see `redirect_query`)."""
+        now = datetime.utcnow()
+        request_id = _new_id()
+        logout = etree.Element(_q(SAMLP_NS, "LogoutRequest"), nsmap=NSMAP)
+        logout.set("ID", request_id)
+        logout.set("Version", "2.0")
+        logout.set("IssueInstant", _iso(now))
+        logout.set("Destination", destination)
+        logout.set("NotOnOrAfter", _iso(now + timedelta(minutes=5)))
+        etree.SubElement(logout, _q(SAML_NS, "Issuer")).text = config_manager.effective_entity_id()
+        nameid = etree.SubElement(logout, _q(SAML_NS, "NameID"))
+        nameid.set("Format", name_id_format or NAMEID_EMAIL)
+        nameid.text = name_id
+        if session_index:
+            etree.SubElement(logout, _q(SAMLP_NS, "SessionIndex")).text = session_index
+        return request_id, etree.tostring(self._sign(logout) if sign else logout)
+
+    def build_logout_response(self, destination, in_response_to, status=STATUS_SUCCESS,
+                              sub_status=None, sign=True) -> bytes:
+        """Serialized LogoutResponse to `in_response_to`, carrying `status`
+        (and optionally a second-level status such as PartialLogout)."""
+        response = etree.Element(_q(SAMLP_NS, "LogoutResponse"), nsmap=NSMAP)
+        response.set("ID", _new_id())
+        response.set("Version", "2.0")
+        response.set("IssueInstant", _iso(datetime.utcnow()))
+        if destination:
+            response.set("Destination", destination)
+        if in_response_to:
+            response.set("InResponseTo", in_response_to)
+        etree.SubElement(response, _q(SAML_NS, "Issuer")).text = config_manager.effective_entity_id()
+        status_el = etree.SubElement(response, _q(SAMLP_NS, "Status"))
+        code = etree.SubElement(status_el, _q(SAMLP_NS, "StatusCode"))
+        code.set("Value", status)
+        if sub_status:
+            etree.SubElement(code, _q(SAMLP_NS, "StatusCode")).set("Value", sub_status)
+        return etree.tostring(self._sign(response) if sign else response)
+
+    def redirect_query(self, param, xml_bytes, relay_state=None):
+        """`redirect_query` with the current signing material."""
+        return redirect_query(param, xml_bytes, self.material.current(), relay_state)
+
+    def build_artifact_response(self, request_id, response_xml=None) -> bytes:
+        """SOAP envelope carrying a signed ArtifactResponse to `request_id`.
+
+        `response_xml` is the parked (already signed) Response; None means the
+        artifact was unknown, expired or not the caller's — the ArtifactResponse
+        is then sent without a message, as SAML core 3.5 requires."""
+        now = datetime.utcnow()
+        art_response = etree.Element(_q(SAMLP_NS, "ArtifactResponse"), nsmap=NSMAP)
+        art_response.set("ID", _new_id())
+        art_response.set("Version", "2.0")
+        art_response.set("IssueInstant", _iso(now))
+        if request_id:
+            art_response.set("InResponseTo", request_id)
+        etree.SubElement(art_response, _q(SAML_NS, "Issuer")).text = config_manager.effective_entity_id()
+        status = etree.SubElement(art_response, _q(SAMLP_NS, "Status"))
+        etree.SubElement(status, _q(SAMLP_NS, "StatusCode")).set("Value", STATUS_SUCCESS)
+        if response_xml is not None:
+            art_response.append(parse_xml(response_xml))
+        envelope = etree.Element(_q(SOAP_NS, "Envelope"), nsmap={"soap": SOAP_NS})
+        etree.SubElement(envelope, _q(SOAP_NS, "Body")).append(self._sign(art_response))
+        return etree.tostring(envelope, xml_declaration=True, encoding="UTF-8")
+
+    def _response_envelope(self, issuer, acs_url, request_id, now, status, sub_status=None):
+        """samlp:Response with Issuer and Status — everything but the Assertion."""
         response = etree.Element(_q(SAMLP_NS, "Response"), nsmap=NSMAP)
         response.set("ID", _new_id())
         response.set("Version", "2.0")
@@ -108,25 +569,53 @@ class IdPHandler:
 
         etree.SubElement(response, _q(SAML_NS, "Issuer")).text = issuer
 
-        status = etree.SubElement(response, _q(SAMLP_NS, "Status"))
-        etree.SubElement(status, _q(SAMLP_NS, "StatusCode")).set("Value", STATUS_SUCCESS)
-
-        assertion = self._build_assertion(
-            user_info, issuer, audience, acs_url, assertion_id,
-            now, not_before, not_after, request_id,
-        )
-        # Sign the assertion, embed it, then sign the whole Response. Check
-        # Point SPs (SmartConsole/cpmws) validate the Response-level signature;
-        # signing both is the most broadly compatible. Exclusive C14N keeps the
-        # assertion signature valid after it's nested in the signed Response.
-        response.append(self._sign(assertion))
-        signed_response = self._sign(response)
-
-        xml_bytes = etree.tostring(signed_response, xml_declaration=False)
-        return base64.b64encode(xml_bytes).decode("ascii")
+        status_el = etree.SubElement(response, _q(SAMLP_NS, "Status"))
+        code = etree.SubElement(status_el, _q(SAMLP_NS, "StatusCode"))
+        code.set("Value", status)
+        if sub_status:
+            etree.SubElement(code, _q(SAMLP_NS, "StatusCode")).set("Value", sub_status)
+        return response
+
+    def _apply_signatures(self, response, assertion, scope):
+        """Sign the assertion, embed it, then sign the whole Response. Check
+        Point SPs (SmartConsole/cpmws) validate the Response-level signature;
+        signing both is the most broadly compatible. Exclusive C14N keeps the
+        assertion signature valid after it's nested in the signed Response.
+        An SP's signing_scope can drop either signature (one RSA op instead of
+        two) when it only validates the other."""
+        if scope in ("both", "assertion"):
+            assertion = self._sign(assertion)
+        response.append(assertion)
+        if scope in ("both", "response"):
+            response = self._sign(response)
+        return response
+
+    def sign_serialized(self, xml_bytes: bytes, scope: str) -> bytes:
+        """Sign a serialized, unsigned Response (Assertion already embedded)
+        and return the signed bytes. The signing-pool worker entry point."""
+        response = parse_xml(xml_bytes)
+        assertion = response.find(_q(SAML_NS, "Assertion"))
+        response.remove(assertion)
+        return etree.tostring(self._apply_signatures(response, assertion, scope),
+                              xml_declaration=False)
+
+    def _assertion_template(self, issuer, audience, acs_url, user_info, request_id,
+                            nameid_format=NAMEID_EMAIL):
+        """The compiled AssertionTemplate for this SP shape (built on first use)."""
+        attr_names = tuple(user_info.get("attributes") or ())
+        key = (issuer, audience, acs_url, attr_names, bool(request_id), nameid_format)
+        template = self._templates.get(key)
+        if template is None:
+            template = AssertionTemplate(self._build_assertion, *key)
+            with self._templates_lock:
+                while len(self._templates) >= self.TEMPLATE_CACHE_SIZE:
+                    self._templates.pop(next(iter(self._templates)))
+                self._templates[key] = template
+        return template
 
     def _build_assertion(self, user_info, issuer, audience, acs_url, assertion_id,
-                         now, not_before, not_after, request_id):
+                         now, not_before, not_after, request_id, authn_instant=None,
+                         nameid_format=NAMEID_EMAIL):
         assertion = etree.Element(_q(SAML_NS, "Assertion"), nsmap={"saml": SAML_NS})
         assertion.set("ID", assertion_id)
         assertion.set("Version", "2.0")
@@ -138,7 +627,7 @@ class IdPHandler:
         # Subject + bearer SubjectConfirmation bound to this request and ACS.
         subject = etree.SubElement(assertion, _q(SAML_NS, "Subject"))
         nameid = etree.SubElement(subject, _q(SAML_NS, "NameID"))
-        nameid.set("Format", NAMEID_EMAIL)
+        nameid.set("Format", nameid_format)
         nameid.text = user_info["email"]
         subj_conf = etree.SubElement(subject, _q(SAML_NS, "SubjectConfirmation"))
         subj_conf.set("Method", "urn:oasis:names:tc:SAML:2.0:cm:bearer")
@@ -158,7 +647,7 @@ class IdPHandler:
 
         # AuthnStatement.
         authn = etree.SubElement(assertion, _q(SAML_NS, "AuthnStatement"))
-        authn.set("AuthnInstant", _iso(now))
+        authn.set("AuthnInstant", _iso(authn_instant or now))
         authn.set("SessionIndex", assertion_id)
         authn_ctx = etree.SubElement(authn, _q(SAML_NS, "AuthnContext"))
         etree.SubElement(authn_ctx, _q(SAML_NS, "AuthnContextClassRef")).text = AUTHN_CTX_PASSWORD
@@ -176,37 +665,57 @@ class IdPHandler:
         return assertion
 
     def _sign(self, element):
-        """Enveloped RSA-SHA256 / exclusive-C14N signature over `element`,
-        referencing its own ID. Repositions ds:Signature to directly follow
-        Issuer — the SAML schema requires Signature immediately after Issuer
-        for both Assertion and Response."""
-        signer = XMLSigner(
-            method=methods.enveloped,
-            signature_algorithm="rsa-sha256",
-            digest_algorithm="sha256",
-            c14n_algorithm="http://www.w3.org/2001/10/xml-exc-c14n#",
-        )
-        signed = signer.sign(element, key=self.key, cert=self.cert,
-                             reference_uri=element.get("ID"))
-        sig = signed.find(_q(DS_NS, "Signature"))
-        if sig is not None:
-            signed.remove(sig)
-            signed.insert(1, sig)  # index 0 is Issuer
-        return signed
-
-    def verify_signature(self, xml_bytes) -> bool:
+        """Enveloped RSA-SHA256 (or ECDSA, per the key) / exclusive-C14N
+        signature over `element`, referencing its own ID. Repositions
+        ds:Signature to directly follow Issuer — the SAML schema requires
+        Signature immediately after Issuer for both Assertion and Response."""
+        return sign_enveloped(element, self.material.current(), position=1)  # index 0 is Issuer
+
+    def verify_signature(self, xml_bytes, root=None) -> bool:
         """True if the assertion in a decoded Response is validly signed by our
-        own certificate. Used by the built-in SAML test viewer."""
-        from signxml import XMLVerifier
+        own certificate — directly, or (for a "response"-scoped SP) through
+        the enclosing Response signature. Used by the built-in SAML test viewer.
+
+        Pass `root` if the caller already parsed `xml_bytes`. The result is
+        cached per (assertion ID, document digest) for the assertion's
+        validity window, so a resubmitted or refreshed Response skips the
+        crypto; a changed signing cert invalidates every cached result."""
         try:
-            parser = etree.XMLParser(resolve_entities=False, no_network=True,
-                                     dtd_validation=False, load_dtd=False)
-            root = etree.fromstring(xml_bytes, parser=parser)
+            if root is None:
+                root = parse_xml(xml_bytes)
             assertion = root.find(_q(SAML_NS, "Assertion"))
             if assertion is None:
                 return False
-            cert = self.cert.decode("ascii") if isinstance(self.cert, bytes) else self.cert
-            XMLVerifier().verify(assertion, x509_cert=cert)
-            return True
+            material = self.material.current()
+            key = (assertion.get("ID"), hashlib.sha256(xml_bytes).hexdigest())
+            now = datetime.utcnow()
+            cached = self._verified.get(key)
+            if cached is not None:
+                verified, expires, stamp = cached
+                if expires > now and stamp == material.stamp:
+                    return verified
+
+            signed = assertion if assertion.find(_q(DS_NS, "Signature")) is not None else root
+            try:
+                XMLVerifier().verify(signed, x509_cert=material.cert_x509)
+                verified = True
+            except Exception:
+                verified = False
+
+            expires = _not_on_or_after(assertion)
+            if expires is not None and expires > now:
+                with self._verified_lock:
+                    for k in [k for k, v in self._verified.items() if v[1] <= now]:
+                        del self._verified[k]
+                    while len(self._verified) >= self.VERIFY_CACHE_SIZE:
+                        self._verified.pop(next(iter(self._verified)))
+                    self._verified[key] = (verified, expires, material.stamp)
+            return verified
         except Exception:
             return False
+
+
+def _not_on_or_after(assertion):
+    """The assertion's Conditions/@NotOnOrAfter as a naive UTC datetime, or None."""
+    conditions = assertion.find(_q(SAML_NS, "Conditions"))
+    return parse_instant(conditions.get("NotOnOrAfter")) if conditions is not None else None
@@ -0,0 +1,216 @@
+"""Optional process pool for SAML Response signing.
+
+RSA signing holds the request thread for the whole sign step, so during a
+login storm the web server's thread count — not the CPU — becomes the
+bottleneck. With SIGNING_POOL_SIZE > 0, `IdPHandler.build_response`
+serializes the unsigned Response and hands it to a small process pool owned
+by the current gunicorn worker; the pool processes load the signing key once
+(their own SigningMaterial) and return the signed bytes.
+
+Offloading only helps if the worker can take other requests while one waits
+on the pool, so entrypoint.py runs gunicorn with gthread workers
+(GUNICORN_THREADS threads each) whenever the pool is on. A sync worker has a
+single request in flight and would simply block in `future.result()`. The
+pool is per gunicorn worker: GUNICORN_WORKERS x SIGNING_POOL_SIZE signing
+processes in all.
+
+Backpressure: at most SIGNING_POOL_MAX_QUEUE responses may be queued or
+signing per worker. Past that, `sign()` raises SigningPoolBusy immediately and
+/login answers 503 + Retry-After rather than piling requests up behind the pool.
+A job that times out still counts against the cap until its pool process
+actually finishes it, so a stuck pool sheds load instead of queueing more.
+
+The pool is created lazily on first use — i.e. inside the gunicorn worker,
+after gunicorn has forked it — with the "fork" start method. ("spawn" would
+re-import the main module in every pool process, which under `python run.py`
+means a full create_app().) A pool whose process died (BrokenProcessPool) is
+replaced on the next call. Pool processes only ever run `_sign_in_worker`;
+they never touch the DB connections or sockets they inherit.
+
+Caveat: under gthread the pool is forked from a multithreaded process. A
+lock another thread holds at that instant (logging, the allocator, an SQLite
+connection) stays locked forever in the child, so a pool process can hang
+on its first use. `_sign_in_worker` avoids logging and the DB to keep that
+window small. If it bites anyway, the job times out (SigningPoolTimeout,
+answered like SigningPoolBusy) instead of hanging the request. The
+"forkserver" start method removes the risk, but each pool process then
+imports the app modules afresh. `stats()` reports
+queue wait (submit → pool process picks it up) separately from sign time.
+"""
+import multiprocessing
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+from app.utils.config_manager import config_manager
+from app.utils.logger_main import logger
+
+
+class SigningPoolBusy(Exception):
+    """The signing pool's queue is full — the caller should shed the request."""
+
+
+class SigningPoolTimeout(SigningPoolBusy):
+    """The pool didn't return a signature within SIGNING_POOL_TIMEOUT. Shed
+    like SigningPoolBusy; the job keeps its slot until it finishes."""
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_in_flight = 0
+_metrics = {
+    "submitted": 0,
+    "completed": 0,
+    "rejected": 0,
+    "failed": 0,
+    "timed_out": 0,
+    "pool_restarts": 0,
+    "queue_wait_total": 0.0,
+    "queue_wait_max": 0.0,
+    "sign_time_total": 0.0,
+    "sign_time_max": 0.0,
+}
+
+# Per pool process: the IdPHandler (and so the parsed key) is built once.
+_worker_handler = None
+
+
+def _sign_in_worker(xml_bytes, scope, submitted_at):
+    """Runs in a pool process. Returns (signed_bytes, queue_wait, sign_time)."""
+    global _worker_handler
+    started = time.time()
+    if _worker_handler is None:
+        from app.utils.saml import IdPHandler
+        _worker_handler = IdPHandler()
+    signed = _worker_handler.sign_serialized(xml_bytes, scope)
+    return signed, max(0.0, started - submitted_at), time.time() - started
+
+
+def enabled() -> bool:
+    return config_manager.SIGNING_POOL_SIZE > 0
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(
+                    max_workers=config_manager.SIGNING_POOL_SIZE,
+                    mp_context=multiprocessing.get_context("fork"),
+                )
+                logger.info("SAML signing pool started: %d process(es), max queue %d",
+                            config_manager.SIGNING_POOL_SIZE,
+                            config_manager.SIGNING_POOL_MAX_QUEUE)
+    return _pool
+
+
+def _release(_future=None):
+    global _in_flight
+    with _pool_lock:
+        _in_flight -= 1
+
+
+def _discard_pool(broken):
+    """Drop `broken` so the next call forks a fresh pool."""
+    global _pool
+    with _pool_lock:
+        if _pool is not broken:
+            return  # another thread already replaced it
+        _pool = None
+        _metrics["pool_restarts"] += 1
+    logger.warning("SAML signing pool broke (a pool process died); starting a new one")
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def sign(xml_bytes: bytes, scope: str) -> bytes:
+    """Sign a serialized Response in the pool and wait for the result.
+
+    Raises SigningPoolBusy when SIGNING_POOL_MAX_QUEUE requests are already in
+    flight, and SigningPoolTimeout (a SigningPoolBusy) when the signature
+    doesn't arrive within SIGNING_POOL_TIMEOUT. Any other pool failure propagates to the caller like an inline signing
+    error would."""
+    global _in_flight
+    with _pool_lock:
+        if _in_flight >= config_manager.SIGNING_POOL_MAX_QUEUE:
+            _metrics["rejected"] += 1
+            raise SigningPoolBusy("SAML signing queue is full")
+        _in_flight += 1
+        _metrics["submitted"] += 1
+    pool = future = None
+    try:
+        pool = _get_pool()
+        future = pool.submit(_sign_in_worker, xml_bytes, scope, time.time())
+        signed, waited, took = future.result(timeout=config_manager.SIGNING_POOL_TIMEOUT)
+    except FutureTimeout:
+        with _pool_lock:
+            _metrics["timed_out"] += 1
+        raise SigningPoolTimeout(
+            f"no signature within {config_manager.SIGNING_POOL_TIMEOUT}s") from None
+    except Exception as e:
+        with _pool_lock:
+            _metrics["failed"] += 1
+        if isinstance(e, BrokenProcessPool) and pool is not None:
+            _discard_pool(pool)
+        raise
+    finally:
+        if future is None or future.done():
+            _release()
+        else:
+            # Timed out: the job still occupies a pool process, so it keeps
+            # its slot until the process is done with it.
+            future.add_done_callback(_release)
+    with _pool_lock:
+        _metrics["completed"] += 1
+        _metrics["queue_wait_total"] += waited
+        _metrics["queue_wait_max"] = max(_metrics["queue_wait_max"], waited)
+        _metrics["sign_time_total"] += took
+        _metrics["sign_time_max"] = max(_metrics["sign_time_max"], took)
+    return signed
+
+
+def sign_many(jobs, processes):
+    """Sign an iterable of (xml_bytes, scope) on a dedicated pool of
+    `processes` processes, yielding the signed bytes in input order.
+
+    For bulk work (admin assertion minting), separate from the per-worker
+    login pool and its queue cap. At most 4 x `processes` documents are in
+    flight, so a long `jobs` stream is consumed — and results yielded — as
+    signing keeps up rather than all buffered up front."""
+    window = 4 * processes
+    with ProcessPoolExecutor(max_workers=processes,
+                             mp_context=multiprocessing.get_context("fork")) as pool:
+        pending = deque()
+        for xml_bytes, scope in jobs:
+            pending.append(pool.submit(_sign_in_worker, xml_bytes, scope, time.time()))
+            if len(pending) >= window:
+                yield pending.popleft().result()[0]
+        while pending:
+            yield pending.popleft().result()[0]
+
+
+def stats() -> dict:
+    """Per-worker pool metrics (seconds) for the admin API."""
+    with _pool_lock:
+        m = dict(_metrics)
+        in_flight = _in_flight
+    done = m["completed"] or 1
+    return {
+        "enabled": enabled(),
+        "pool_size": config_manager.SIGNING_POOL_SIZE,
+        "max_queue": config_manager.SIGNING_POOL_MAX_QUEUE,
+        "in_flight": in_flight,
+        "submitted": m["submitted"],
+        "completed": m["completed"],
+        "rejected": m["rejected"],
+        "failed": m["failed"],
+        "timed_out": m["timed_out"],
+        "pool_restarts": m["pool_restarts"],
+        "queue_wait_avg": m["queue_wait_total"] / done,
+        "queue_wait_max": m["queue_wait_max"],
+        "sign_time_avg": m["sign_time_total"] / done,
+        "sign_time_max": m["sign_time_max"],
+    }
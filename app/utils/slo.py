@@ -0,0 +1,236 @@
+"""SAML Single Logout: session participants and the LogoutRequest fan-out.
+
+Every assertion /login issues inside an IdP login session is recorded in the
+`saml_session_participant` table as (IdP session, SP, NameID, SessionIndex),
+so a logout knows which SPs to tell. The IdP session ID lives in the Flask
+session (`idp_sid`). The SessionIndex an SP receives is derived from it
+(`session_index`), so it stays stable across re-authentication and the SSO
+path needs no lookup to fill it in.
+
+A logout, whether SP-initiated at /slo or IdP-initiated, notifies the other
+participants in parallel instead of through a browser redirect chain. The
+LogoutRequests are built and signed in the request thread, then sent from
+a shared pool of at most SLO_CONCURRENCY threads. Each SP gets SLO_TIMEOUT
+seconds. A slow or unreachable SP costs only its own timeout, and it is
+reported as a partial logout.
+"""
+import base64
+import hashlib
+import threading
+import time
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+
+import httpx
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.utils.config_manager import config_manager
+from app.utils.logger_main import logger
+from app.utils.models import db, SessionParticipant
+from app.utils.saml import (NAMEID_EMAIL, SAMLP_NS, SOAP_NS, STATUS_SUCCESS, IdPHandler,
+                            parse_xml)
+from app.utils.sp_registry import sp_registry
+
+PURGE_INTERVAL = 60.0
+# Participants outlive the IdP session lifetime by this floor, so a logout
+# shortly after a session lapsed still reaches its SPs.
+MIN_PARTICIPANT_TTL = timedelta(hours=1)
+
+# status: "ok" | "failed" | "timeout" | "skipped" (no SingleLogoutService).
+LogoutResult = namedtuple("LogoutResult", "sp name binding status detail ms")
+# A LogoutRequest ready to send: everything _deliver needs, no app context.
+_Outbound = namedtuple("_Outbound", "sp name binding method url content headers")
+
+_handler = None
+_pool = None
+_client = None
+_lock = threading.Lock()
+_next_purge = 0.0
+
+
+def new_session_id():
+    return uuid.uuid4().hex
+
+
+def session_index(sid, sp_id):
+    """The SessionIndex an SP is sent for IdP session `sid`."""
+    return "_" + hashlib.sha256(f"{sid}:{sp_id}".encode("ascii")).hexdigest()[:32]
+
+
+def record_participant(sid, user_id, sp, name_id, name_id_format=NAMEID_EMAIL):
+    """Note that `sp` (an SPRecord) holds a session for `name_id` under IdP
+    session `sid`. One upsert per assertion."""
+    now = datetime.utcnow()
+    table = SessionParticipant.__table__
+    with db.engine.begin() as conn:
+        conn.execute(
+            insert(table).values(
+                session_id=sid, user_id=user_id, sp_id=sp.id, sp_entity_id=sp.entity_id,
+                name_id=name_id, name_id_format=name_id_format,
+                session_index=session_index(sid, sp.id), created_at=now, updated_at=now,
+            ).on_conflict_do_update(
+                index_elements=[table.c.session_id, table.c.sp_id],
+                set_={"name_id": name_id, "name_id_format": name_id_format, "updated_at": now},
+            )
+        )
+    _maybe_purge()
+
+
+def session_for(sp_entity_id, name_id, session_indexes=()):
+    """The IdP session in which `sp_entity_id` was sent `name_id` (and one
+    of `session_indexes`, if the LogoutRequest names any), or None."""
+    table = SessionParticipant.__table__
+    query = select(table.c.session_id).where(table.c.sp_entity_id == sp_entity_id,
+                                             table.c.name_id == name_id)
+    if session_indexes:
+        query = query.where(table.c.session_index.in_(session_indexes))
+    with db.engine.connect() as conn:
+        return conn.execute(query.order_by(table.c.updated_at.desc()).limit(1)).scalar()
+
+
+def participants(sid):
+    table = SessionParticipant.__table__
+    with db.engine.connect() as conn:
+        return conn.execute(select(table).where(table.c.session_id == sid)).fetchall()
+
+
+def logout(sid, exclude_sp_id=None):
+    """End IdP session `sid`: forget its participants and send each one with
+    a SingleLogoutService, except `exclude_sp_id` (the SP that asked), a
+    LogoutRequest. Returns a LogoutResult per participant."""
+    rows = participants(sid)
+    with db.engine.begin() as conn:
+        table = SessionParticipant.__table__
+        conn.execute(delete(table).where(table.c.session_id == sid))
+
+    results, outbound = [], []
+    for row in rows:
+        if row.sp_id == exclude_sp_id:
+            continue
+        sp = sp_registry.get(row.sp_id)
+        if sp is None or not sp.slo_url:
+            results.append(LogoutResult(row.sp_entity_id, sp.name if sp else None, None,
+                                        "skipped", "no SingleLogoutService", 0))
+            continue
+        outbound.append(_prepare(sp, row))
+    return results + fan_out(outbound)
+
+
+def _prepare(sp, row):
+    """Build and sign the LogoutRequest for one participant. Runs in the
+    request thread: the IdP entity ID may come from the request host."""
+    handler = _saml_handler()
+    binding = sp.slo_binding
+    sign = binding != "redirect"  # Redirect signs the query string instead
+    _, xml = handler.build_logout_request(sp.slo_url, row.name_id, row.name_id_format,
+                                          row.session_index, sign=sign)
+    if binding == "soap":
+        body = (f'<soap:Envelope xmlns:soap="{SOAP_NS}"><soap:Body>'.encode()
+                + xml + b"</soap:Body></soap:Envelope>")
+        return _Outbound(sp.entity_id, sp.name, binding, "POST", sp.slo_url, body,
+                         {"Content-Type": "text/xml; charset=utf-8", "SOAPAction": ""})
+    if binding == "post":
+        form = urlencode({"SAMLRequest": base64.b64encode(xml).decode("ascii")})
+        return _Outbound(sp.entity_id, sp.name, binding, "POST", sp.slo_url, form,
+                         {"Content-Type": "application/x-www-form-urlencoded"})
+    url = sp.slo_url + ("&" if "?" in sp.slo_url else "?") + handler.redirect_query("SAMLRequest", xml)
+    return _Outbound(sp.entity_id, sp.name, binding, "GET", url, None, {})
+
+
+def fan_out(outbound):
+    """Deliver prepared LogoutRequests concurrently; one LogoutResult each.
+    Bounded overall by the number of pool rounds times SLO_TIMEOUT."""
+    if not outbound:
+        return []
+    timeout = config_manager.SLO_TIMEOUT
+    pool = _executor()
+    futures = {pool.submit(_deliver, o, timeout): o for o in outbound}
+    rounds = -(-len(outbound) // max(1, config_manager.SLO_CONCURRENCY))
+    done, _ = wait(futures, timeout=rounds * timeout + 1)
+    results = []
+    for future, o in futures.items():
+        if future in done:
+            results.append(future.result())
+        else:
+            future.cancel()
+            results.append(LogoutResult(o.sp, o.name, o.binding, "timeout",
+                                        f"no answer within {timeout:g}s", int(timeout * 1000)))
+    return results
+
+
+def _deliver(o, timeout):
+    started = time.perf_counter()
+
+    def result(status, detail):
+        return LogoutResult(o.sp, o.name, o.binding, status, detail,
+                            int((time.perf_counter() - started) * 1000))
+    try:
+        response = _http().request(o.method, o.url, content=o.content, headers=o.headers,
+                                   timeout=timeout)
+    except httpx.TimeoutException:
+        return result("timeout", f"no answer within {timeout:g}s")
+    except httpx.HTTPError as e:
+        return result("failed", str(e) or type(e).__name__)
+    if o.binding != "soap":
+        # Front-channel binding: the SP would normally redirect the browser
+        # on; any non-error answer means it took the request.
+        if response.status_code < 400:
+            return result("ok", f"HTTP {response.status_code}")
+        return result("failed", f"HTTP {response.status_code}")
+    try:
+        envelope = parse_xml(response.content)
+        code = envelope.find(f".//{{{SAMLP_NS}}}LogoutResponse/{{{SAMLP_NS}}}Status/{{{SAMLP_NS}}}StatusCode")
+    except Exception:
+        code = None
+    if code is None:
+        return result("failed", f"HTTP {response.status_code}, no LogoutResponse")
+    if code.get("Value") != STATUS_SUCCESS:
+        return result("failed", code.get("Value"))
+    return result("ok", "Success")
+
+
+def _saml_handler():
+    global _handler
+    if _handler is None:
+        _handler = IdPHandler()
+    return _handler
+
+
+def _executor():
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=max(1, config_manager.SLO_CONCURRENCY),
+                                       thread_name_prefix="slo")
+        return _pool
+
+
+def _http():
+    global _client
+    with _lock:
+        if _client is None:
+            _client = httpx.Client(follow_redirects=False)
+        return _client
+
+
+def _maybe_purge():
+    """Drop participants of sessions that ended long ago without a logout,
+    at most once every PURGE_INTERVAL seconds per process."""
+    global _next_purge
+    mono = time.monotonic()
+    with _lock:
+        if mono < _next_purge:
+            return
+        _next_purge = mono + PURGE_INTERVAL
+    ttl = max(timedelta(minutes=config_manager.IDP_SESSION_LIFETIME), MIN_PARTICIPANT_TTL)
+    table = SessionParticipant.__table__
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(delete(table).where(table.c.updated_at < datetime.utcnow() - ttl))
+    except SQLAlchemyError:
+        logger.warning("Session participant purge failed", exc_info=True)
@@ -0,0 +1,371 @@
+"""Reading Service Provider SAML metadata (an md:EntityDescriptor).
+
+Extracts what an SP record needs from the SP's metadata document: entity ID,
+the ACS and SingleLogoutService endpoints with their bindings, NameID formats, the
+AuthnRequestsSigned / WantAssertionsSigned flags, the signing certificates,
+the RequestedAttributes and the cacheDuration / validUntil refresh hints. Parsed with the shared
+hardened parser — metadata is untrusted input like any AuthnRequest.
+
+Parsed documents are cached by content digest (`parsed_metadata`), so
+re-reading an unchanged document — a refresh whose server ignores
+conditional GETs — costs a hash, not a parse. `fetch_metadata` does the
+conditional GET (ETag / Last-Modified) and `refresh_sp` applies a changed
+document to the SP row, for the admin import / "refresh now" and the
+background refresher (app.services.metadata_refresher).
+"""
+import hashlib
+import re
+import threading
+from datetime import datetime, timedelta
+
+import httpx
+
+from app.utils.activity import record
+from app.utils.config_manager import config_manager
+from app.utils.logger_main import logger
+from app.utils.models import (DEFAULT_SLO_BINDING, RESPONSE_BINDINGS, SLO_BINDINGS, db,
+                              default_signing_scope)
+from app.utils.request_signing import invalidate_sp_key, normalize_cert
+from app.utils.saml import DS_NS, NAMEID_FORMATS, parse_instant, parse_xml
+from app.utils.sp_registry import sp_registry
+
+MD_NS = "urn:oasis:names:tc:SAML:2.0:metadata"
+BINDING_PREFIX = "urn:oasis:names:tc:SAML:2.0:bindings:"
+# Real SP metadata is a few KB; refuse anything absurd before parsing it.
+MAX_METADATA_BYTES = 1024 * 1024
+PARSED_CACHE_SIZE = 64
+# User field for a RequestedAttribute, by its lower-cased Name or FriendlyName
+# (a claim URI matches on its last path segment).
+REQUESTED_ATTRIBUTE_FIELDS = {
+    "email": "email", "emailaddress": "email", "mail": "email",
+    "urn:oid:0.9.2342.19200300.100.1.3": "email",
+    "givenname": "first_name", "firstname": "first_name", "first_name": "first_name",
+    "urn:oid:2.5.4.42": "first_name",
+    "surname": "last_name", "sn": "last_name", "lastname": "last_name",
+    "last_name": "last_name", "urn:oid:2.5.4.4": "last_name",
+    "uid": "username", "username": "username", "urn:oid:0.9.2342.19200300.100.1.1": "username",
+    "userid": "user_id", "user_id": "user_id",
+    "groups": "group_names", "group": "group_names", "memberof": "group_names",
+}
+# Import default when the metadata requests nothing we can map.
+DEFAULT_ATTR_MAP = [{"claim": "emailaddress", "value": "email"}]
+
+_DURATION = re.compile(
+    r"^P(?:(?P<days>\d+(?:\.\d+)?)D)?"
+    r"(?:T(?:(?P<hours>\d+(?:\.\d+)?)H)?(?:(?P<minutes>\d+(?:\.\d+)?)M)?"
+    r"(?:(?P<seconds>\d+(?:\.\d+)?)S)?)?$"
+)
+
+
+class SPMetadataError(ValueError):
+    """Metadata that isn't a usable SP EntityDescriptor, or can't be fetched."""
+
+
+def _flag(value):
+    """True / False for an xs:boolean attribute, None if it's absent."""
+    if value is None:
+        return None
+    return value in ("true", "1")
+
+
+def parse_duration(value):
+    """Seconds in an xs:duration like "PT6H" or "P1DT30M" (no years/months),
+    or None if absent or not understood."""
+    value = (value or "").strip()
+    match = _DURATION.match(value)
+    if not match or value in ("P", "PT") or value.endswith("T"):
+        return None
+    parts = {k: float(v) for k, v in match.groupdict().items() if v}
+    return timedelta(**parts).total_seconds()
+
+
+def parse_sp_metadata(xml_bytes):
+    """The SP's metadata as a dict:
+
+    entity_id, acs (list of {"binding", "location", "index", "is_default"},
+    default first, then by index), slo (list of {"binding", "location"}),
+    nameid_formats, requested_attributes (list of {"name", "friendly_name"}),
+    authn_requests_signed,
+    want_assertions_signed (None if unstated), signing_certs (PEM list —
+    several during a key rollover), cache_duration (seconds or None) and
+    valid_until (naive UTC datetime or None). Raises SPMetadataError."""
+    try:
+        root = parse_xml(xml_bytes)
+    except Exception as e:
+        raise SPMetadataError(f"not well-formed XML: {e}") from None
+    outer = root
+    if root.tag == f"{{{MD_NS}}}EntitiesDescriptor":
+        root = root.find(f"{{{MD_NS}}}EntityDescriptor")
+    if root is None or root.tag != f"{{{MD_NS}}}EntityDescriptor":
+        raise SPMetadataError("no md:EntityDescriptor")
+    if not root.get("entityID"):
+        raise SPMetadataError("EntityDescriptor has no entityID")
+    descriptor = root.find(f"{{{MD_NS}}}SPSSODescriptor")
+    if descriptor is None:
+        raise SPMetadataError("no md:SPSSODescriptor")
+
+    acs = []
+    for el in descriptor.findall(f"{{{MD_NS}}}AssertionConsumerService"):
+        index = el.get("index") or ""
+        acs.append({
+            "binding": el.get("Binding"),
+            "location": el.get("Location"),
+            "index": int(index) if index.isdigit() else 0,
+            "is_default": bool(_flag(el.get("isDefault"))),
+        })
+    acs.sort(key=lambda e: (not e["is_default"], e["index"]))
+    slo = [{"binding": el.get("Binding"), "location": el.get("Location")}
+           for el in descriptor.findall(f"{{{MD_NS}}}SingleLogoutService")]
+    requested = [{"name": el.get("Name"), "friendly_name": el.get("FriendlyName")}
+                 for el in descriptor.iterfind(
+                     f"{{{MD_NS}}}AttributeConsumingService/{{{MD_NS}}}RequestedAttribute")
+                 if el.get("Name")]
+
+    signing_certs = []
+    for kd in descriptor.findall(f"{{{MD_NS}}}KeyDescriptor"):
+        if kd.get("use") not in (None, "signing"):
+            continue
+        for cert_el in kd.iterfind(f"{{{DS_NS}}}KeyInfo/{{{DS_NS}}}X509Data/{{{DS_NS}}}X509Certificate"):
+            if not cert_el.text:
+                continue
+            try:
+                pem = normalize_cert(cert_el.text)
+            except ValueError as e:
+                raise SPMetadataError(f"signing certificate: {e}") from None
+            if pem not in signing_certs:
+                signing_certs.append(pem)
+
+    # The entity's own cacheDuration / validUntil win over an aggregate's.
+    durations = [parse_duration(el.get("cacheDuration")) for el in (root, outer)]
+    instants = [parse_instant(el.get("validUntil")) for el in (root, outer)]
+    return {
+        "entity_id": root.get("entityID"),
+        "acs": acs,
+        "slo": slo,
+        "nameid_formats": [el.text.strip() for el in descriptor.findall(f"{{{MD_NS}}}NameIDFormat")
+                           if el.text and el.text.strip()],
+        "requested_attributes": requested,
+        "authn_requests_signed": bool(_flag(descriptor.get("AuthnRequestsSigned"))),
+        "want_assertions_signed": _flag(descriptor.get("WantAssertionsSigned")),
+        "signing_certs": signing_certs,
+        "cache_duration": next((d for d in durations if d is not None), None),
+        "valid_until": next((t for t in instants if t is not None), None),
+    }
+
+
+def metadata_digest(xml_bytes):
+    return hashlib.sha256(xml_bytes).hexdigest()
+
+
+_parsed = {}   # sha256 of the document -> parse_sp_metadata() result
+_parsed_lock = threading.Lock()
+
+
+def parsed_metadata(xml_bytes, digest=None):
+    """`parse_sp_metadata(xml_bytes)`, cached by content digest. Treat the
+    result as read-only — it's shared."""
+    digest = digest or metadata_digest(xml_bytes)
+    meta = _parsed.get(digest)
+    if meta is None:
+        meta = parse_sp_metadata(xml_bytes)
+        with _parsed_lock:
+            while len(_parsed) >= PARSED_CACHE_SIZE:
+                _parsed.pop(next(iter(_parsed)))
+            _parsed[digest] = meta
+    return meta
+
+
+def choose_acs(meta, response_binding=None):
+    """(location, response_binding key) — the ACS endpoint to send Responses
+    to. Prefers `response_binding` ("post" / "artifact") if the SP offers it,
+    then HTTP-POST, then HTTP-Artifact. Raises SPMetadataError if the SP has
+    no ACS with a binding we can answer."""
+    order = [response_binding] if response_binding in RESPONSE_BINDINGS else []
+    order += [b for b in ("post", "artifact") if b not in order]
+    for key in order:
+        uri = BINDING_PREFIX + RESPONSE_BINDINGS[key]
+        for endpoint in meta["acs"]:
+            if endpoint["binding"] == uri and endpoint["location"]:
+                return endpoint["location"], key
+    raise SPMetadataError("no HTTP-POST or HTTP-Artifact AssertionConsumerService")
+
+
+def choose_slo(meta):
+    """(location, SLO binding key) of the SingleLogoutService to send
+    LogoutRequests to — SOAP (back channel) first, then HTTP-POST, then
+    HTTP-Redirect — or (None, default binding) if the SP has none."""
+    for key in ("soap", "post", "redirect"):
+        uri = BINDING_PREFIX + SLO_BINDINGS[key]
+        for endpoint in meta["slo"]:
+            if endpoint["binding"] == uri and endpoint["location"]:
+                return endpoint["location"], key
+    return None, DEFAULT_SLO_BINDING
+
+
+def choose_nameid_format(meta):
+    """The NameID Format to issue: the SP's first listed format the IdP can
+    produce (NAMEID_FORMATS), or None — i.e. emailAddress — if it lists none.
+    An SP that lists only formats the IdP can't issue (persistent, transient,
+    ...) also gets None, with a warning: its NameID will still be the email."""
+    formats = meta["nameid_formats"]
+    chosen = next((f for f in formats if f in NAMEID_FORMATS), None)
+    if formats and chosen is None:
+        logger.warning("SP %s accepts only unsupported NameID formats %s; sending emailAddress",
+                       meta["entity_id"], ", ".join(formats))
+    return chosen
+
+
+def requested_attr_map(meta):
+    """An attr_map built from the SP's RequestedAttributes: each one whose Name
+    or FriendlyName is a known alias (REQUESTED_ATTRIBUTE_FIELDS) is mapped,
+    under the Name the SP asked for. DEFAULT_ATTR_MAP if none is."""
+    attr_map = []
+    for attr in meta["requested_attributes"]:
+        for label in (attr["name"], attr["friendly_name"]):
+            label = (label or "").strip().lower()
+            field = (REQUESTED_ATTRIBUTE_FIELDS.get(label)
+                     or REQUESTED_ATTRIBUTE_FIELDS.get(label.rstrip("/").rsplit("/", 1)[-1]))
+            if field:
+                attr_map.append({"claim": attr["name"], "value": field})
+                break
+    return attr_map or [dict(m) for m in DEFAULT_ATTR_MAP]
+
+
+def sp_fields(meta, response_binding=None):
+    """ServiceProvider column values the metadata determines — the ones a
+    refresh keeps in sync. `response_binding` is the SP's current choice."""
+    acs_url, binding = choose_acs(meta, response_binding)
+    slo_url, slo_binding = choose_slo(meta)
+    return {
+        "entity_id": meta["entity_id"],
+        "acs_url": acs_url,
+        "response_binding": binding,
+        "slo_url": slo_url,
+        "slo_binding": slo_binding,
+        "signing_cert": "".join(meta["signing_certs"]) or None,
+        "authn_requests_signed": meta["authn_requests_signed"],
+        "nameid_format": choose_nameid_format(meta),
+    }
+
+
+def import_fields(meta):
+    """Column values for a new SP created from metadata: `sp_fields` plus
+    the signing scope WantAssertionsSigned implies and the claim mapping its
+    RequestedAttributes imply. The mapping is only set on import — a refresh
+    never overwrites the admin's edits."""
+    return {**sp_fields(meta),
+            "signing_scope": default_signing_scope(meta["want_assertions_signed"]),
+            "attr_map": requested_attr_map(meta)}
+
+
+def fetch_metadata(url, etag=None, last_modified=None, timeout=10.0):
+    """Conditional GET of SP metadata. Returns (body, etag, last_modified);
+    body is None on 304 Not Modified. Raises SPMetadataError on transport
+    errors, non-200 statuses and oversized documents."""
+    headers = {"Accept": "application/samlmetadata+xml, application/xml, text/xml"}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    try:
+        with httpx.stream("GET", url, headers=headers, timeout=timeout,
+                          follow_redirects=True) as resp:
+            if resp.status_code == 304:
+                return None, etag, last_modified
+            if resp.status_code != 200:
+                raise SPMetadataError(f"HTTP {resp.status_code} from {url}")
+            body = bytearray()
+            for chunk in resp.iter_bytes():
+                body += chunk
+                if len(body) > MAX_METADATA_BYTES:
+                    raise SPMetadataError(f"metadata at {url} exceeds {MAX_METADATA_BYTES} bytes")
+            return bytes(body), resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+    except httpx.HTTPError as e:
+        raise SPMetadataError(f"fetching {url}: {e}") from None
+
+
+# ------------------------------------------------------------------ refresh
+# HTTP validators and refresh interval per SP id, as of the last fetch. The
+# DB only holds the validators of the last document *applied*, so keeping
+# these in memory lets a 200-but-identical response update them without a
+# write.
+_sources = {}
+_sources_lock = threading.Lock()
+
+
+def refresh_interval(meta=None):
+    """Seconds until an SP's metadata should be fetched again: its
+    cacheDuration (else SP_METADATA_REFRESH), brought forward to validUntil,
+    clamped to SP_METADATA_MIN_REFRESH..SP_METADATA_MAX_REFRESH."""
+    seconds = config_manager.SP_METADATA_REFRESH
+    if meta is not None:
+        if meta["cache_duration"] is not None:
+            seconds = meta["cache_duration"]
+        if meta["valid_until"] is not None:
+            seconds = min(seconds, (meta["valid_until"] - datetime.utcnow()).total_seconds())
+    return max(config_manager.SP_METADATA_MIN_REFRESH,
+               min(seconds, config_manager.SP_METADATA_MAX_REFRESH))
+
+
+def refresh_sp(sp, force=False):
+    """Re-fetch `sp`'s metadata (an ORM ServiceProvider with a metadata_url)
+    and apply it if it changed. Returns (outcome, seconds until the next
+    refresh); outcome is "updated", "unchanged" or "not-modified".
+
+    `force` skips the conditional headers. The SP row is written — and the
+    SP registry and key cache invalidated — only for "updated". Raises
+    SPMetadataError; the SP keeps its current values then."""
+    state = _sources.get(sp.id)
+    if state is None or state["url"] != sp.metadata_url:
+        state = {"url": sp.metadata_url, "etag": sp.metadata_etag,
+                 "last_modified": sp.metadata_last_modified, "interval": None}
+    body, etag, last_modified = fetch_metadata(
+        sp.metadata_url,
+        etag=None if force else state["etag"],
+        last_modified=None if force else state["last_modified"],
+        timeout=config_manager.SP_METADATA_TIMEOUT,
+    )
+    if body is None:
+        outcome = "not-modified"
+    else:
+        digest = metadata_digest(body)
+        meta = parsed_metadata(body, digest)
+        state["interval"] = refresh_interval(meta)
+        if digest == sp.metadata_digest:
+            outcome = "unchanged"
+        else:
+            _apply(sp, meta, digest, etag, last_modified)
+            outcome = "updated"
+        state["etag"], state["last_modified"] = etag, last_modified
+    with _sources_lock:
+        _sources[sp.id] = state
+    return outcome, state["interval"] or refresh_interval()
+
+
+def _apply(sp, meta, digest, etag, last_modified):
+    if meta["entity_id"] != sp.entity_id:
+        raise SPMetadataError(
+            f"metadata is for {meta['entity_id']!r}, not {sp.entity_id!r}")
+    fields = sp_fields(meta, sp.response_binding)
+    changed = {k: v for k, v in fields.items() if getattr(sp, k) != v}
+    for k, v in changed.items():
+        setattr(sp, k, v)
+    sp.metadata_digest = digest
+    sp.metadata_etag = etag
+    sp.metadata_last_modified = last_modified
+    sp.metadata_updated_at = datetime.utcnow()
+    db.session.commit()
+    invalidate_sp_key(sp.id)
+    sp_registry.invalidate()
+    logger.info("SP metadata for %s updated from %s: %s", sp.entity_id, sp.metadata_url,
+                ", ".join(changed) or "no field changes")
+    record('service_provider', 'Refreshed SP metadata', target=sp.name or sp.entity_id,
+           detail={'url': sp.metadata_url,
+                   'changed': sorted(k for k in changed if k != 'signing_cert'),
+                   'signing_cert_changed': 'signing_cert' in changed})
+
+
+def forget_source(sp_id):
+    """Drop the cached validators for `sp_id` (SP deleted or URL changed)."""
+    with _sources_lock:
+        _sources.pop(sp_id, None)
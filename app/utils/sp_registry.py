@@ -0,0 +1,87 @@
+"""In-process ServiceProvider registry for the SSO hot path.
+
+/sso resolves the requesting SP by entity ID and /login re-resolves it by
+primary key; with a handful of SPs that rarely change, an ORM round trip per
+SSO is pure overhead. The registry loads every SP once into two dicts (by
+entity ID and by pk) of immutable `SPRecord` snapshots — plain values, safe to
+hand across requests and threads, unlike ORM instances bound to a session.
+
+Cross-process invalidation: every write to the service_provider table (admin
+create / edit / delete, startup seeding) calls `invalidate()`, which atomically
+replaces a small version file on the data volume. Each process stats that file
+on lookup and reloads when its (inode, mtime, size) differs from the one it
+loaded against — so all gunicorn workers and the AAA runner see an edit on
+their next lookup, at the cost of one stat() call.
+"""
+import threading
+from collections import namedtuple
+
+from app.utils.path_config import BASE_DIR
+from app.utils.version_file import bump_version, version_stamp
+
+VERSION_FILE = BASE_DIR / "data" / ".sp-registry-version"
+
+SPRecord = namedtuple(
+    "SPRecord",
+    "id entity_id acs_url name description attr_map signing_scope response_binding "
+    "signing_cert authn_requests_signed slo_url slo_binding nameid_format",
+)
+
+
+class SPRegistry:
+    def __init__(self, version_file=VERSION_FILE):
+        self.version_file = version_file
+        self._by_entity_id = {}
+        self._by_id = {}
+        self._stamp = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _current(self):
+        stamp = version_stamp(self.version_file)
+        if not self._loaded or stamp != self._stamp:
+            with self._lock:
+                stamp = version_stamp(self.version_file)
+                if not self._loaded or stamp != self._stamp:
+                    self._load(stamp)
+        return self
+
+    def _load(self, stamp):
+        """Snapshot the table. `stamp` is read BEFORE the query, so a write
+        that lands mid-load bumps the file past it and triggers another load."""
+        from app.utils.models import ServiceProvider
+        by_id = {}
+        for sp in ServiceProvider.query.all():
+            by_id[sp.id] = SPRecord(
+                id=sp.id, entity_id=sp.entity_id, acs_url=sp.acs_url,
+                name=sp.name, description=sp.description,
+                attr_map=list(sp.attr_map or []), signing_scope=sp.signing_scope,
+                response_binding=sp.response_binding,
+                signing_cert=sp.signing_cert, authn_requests_signed=bool(sp.authn_requests_signed),
+                slo_url=sp.slo_url, slo_binding=sp.slo_binding,
+                nameid_format=sp.nameid_format,
+            )
+        self._by_id = by_id
+        self._by_entity_id = {r.entity_id: r for r in by_id.values()}
+        self._stamp = stamp
+        self._loaded = True
+
+    def by_entity_id(self, entity_id):
+        """The SPRecord registered under `entity_id`, or None."""
+        return self._current()._by_entity_id.get(entity_id)
+
+    def get(self, sp_id):
+        """The SPRecord with primary key `sp_id`, or None."""
+        return self._current()._by_id.get(sp_id)
+
+    def all(self):
+        return list(self._current()._by_id.values())
+
+    def invalidate(self):
+        """Mark every process's snapshot stale. Call after committing any
+        change to the service_provider table."""
+        self._loaded = False
+        bump_version(self.version_file, "SP registry")
+
+
+sp_registry = SPRegistry()
@@ -0,0 +1,42 @@
+"""Change stamps on files, for caches shared across processes.
+
+A process keeps a snapshot (the SP registry, the AAA directory, the IdP
+signing key) together with the stamp of the file it was built from, and
+rebuilds it when a stat() shows a different stamp. `bump_version` is the
+writer's side: it replaces a small version file so every process's next
+stat() differs.
+"""
+import os
+import time
+
+from app.utils.logger_main import logger
+
+
+def file_stamp(path):
+    """(inode, mtime_ns, size) — changes whenever the file is replaced or
+    rewritten in place, e.g. a cert rotated on the saml_idp_certs volume.
+    Raises OSError if the file is missing."""
+    st = os.stat(path)
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def version_stamp(path):
+    """file_stamp of a version file, or None before its first bump."""
+    try:
+        return file_stamp(path)
+    except OSError:
+        return None
+
+
+def bump_version(path, what):
+    """Replace version file `path` (a new inode, so every stamp differs).
+    On a read-only data volume only this process notices the change; the
+    others keep their snapshot until restart. `what` names the cache in the
+    warning logged then."""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w") as f:
+            f.write(f"{time.time_ns()}\n")
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.warning("Could not bump %s version %s: %s", what, path, e)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""Per-key-type SAML signing throughput.
+
+Generates a throwaway self-signed cert for each supported IDP_KEY_TYPE
+(RSA-2048/3072, ECDSA P-256/P-384), then mints complete signed Responses
+through `IdPHandler.build_response` for each signing scope and reports
+responses/sec — the number to compare when choosing a key type per
+deployment. Each IdPHandler is built on a SigningMaterial for the generated
+files, and the signing pool is forced off (its processes would load the real
+key), so nothing under app/certs is read or written.
+
+    python bench/signing_keys.py              # ~2 s per key type / scope
+    python bench/signing_keys.py --seconds 5 --json
+"""
+import argparse
+import datetime
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from cryptography import x509  # noqa: E402
+from cryptography.hazmat.primitives import hashes, serialization  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric import ec, rsa  # noqa: E402
+from cryptography.x509.oid import NameOID  # noqa: E402
+
+from app.utils.config_manager import config_manager  # noqa: E402
+from app.utils.saml import IdPHandler, SigningMaterial  # noqa: E402
+
+KEY_TYPES = {
+    "rsa-2048": lambda: rsa.generate_private_key(public_exponent=65537, key_size=2048),
+    "rsa-3072": lambda: rsa.generate_private_key(public_exponent=65537, key_size=3072),
+    "ec-p256": lambda: ec.generate_private_key(ec.SECP256R1()),
+    "ec-p384": lambda: ec.generate_private_key(ec.SECP384R1()),
+}
+SCOPES = ("both", "assertion", "response")
+
+USER = {
+    "email": "demo.user@cpdemo.ca",
+    "attributes": {
+        "email": ["demo.user@cpdemo.ca"],
+        "firstName": ["Demo"],
+        "lastName": ["User"],
+        "groups": [f"group-{i}" for i in range(10)],
+    },
+}
+SP = {"entity_id": "urn:bench:sp", "acs_url": "https://sp.example/acs"}
+
+
+def write_material(key_type, directory):
+    """Generate a key + self-signed cert; return (cert_path, key_path)."""
+    key = KEY_TYPES[key_type]()
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "bench.idp")])
+    now = datetime.datetime.utcnow()
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name).issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+    cert_path = Path(directory) / f"{key_type}-cert.pem"
+    key_path = Path(directory) / f"{key_type}-key.pem"
+    cert_path.write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+    key_path.write_bytes(key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ))
+    return cert_path, key_path
+
+
+def run(key_type, scope, seconds, directory):
+    handler = IdPHandler(SigningMaterial(*write_material(key_type, directory)))
+    sp = {**SP, "signing_scope": scope}
+    handler.build_response(USER, sp, request_id="_warmup")
+    count, start = 0, time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        handler.build_response(USER, sp, request_id="_bench")
+        count += 1
+    elapsed = time.perf_counter() - start
+    return {
+        "key_type": key_type,
+        "algorithm": handler.material.signature_algorithm,
+        "scope": scope,
+        "responses": count,
+        "ops_per_sec": round(count / elapsed, 1),
+        "ms_per_op": round(1000 * elapsed / count, 3),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--seconds", type=float, default=2.0, help="time per key type / scope")
+    ap.add_argument("--key-type", choices=sorted(KEY_TYPES), action="append",
+                    help="limit to these key types (repeatable)")
+    ap.add_argument("--json", action="store_true", help="emit JSON instead of a table")
+    args = ap.parse_args()
+
+    config_manager.SIGNING_POOL_SIZE = 0  # sign in this process, with the bench key
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for key_type in args.key_type or KEY_TYPES:
+            for scope in SCOPES:
+                results.append(run(key_type, scope, args.seconds, tmp))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'key type':<10} {'algorithm':<14} {'scope':<10} {'resp/s':>9} {'ms/resp':>9}")
+    for r in results:
+        print(f"{r['key_type']:<10} {r['algorithm']:<14} {r['scope']:<10} "
+              f"{r['ops_per_sec']:>9} {r['ms_per_op']:>9}")
+
+
+if __name__ == "__main__":
+    main()
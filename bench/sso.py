@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""SSO hot-path benchmarks — ops/sec and p50/p99 latency per case.
+
+Covers AuthnRequest parsing, assertion building (reference builder and
+compiled template), signing, loopback verification, metadata rendering, and
+the full /sso -> /login round trip through the Flask test client, with
+fixtures of 0, 10 and 100 group claims. Results are JSON so they can be
+diffed release to release:
+
+    python bench/sso.py --json > bench-$(git describe --always).json
+    python bench/sso.py --seconds 0.5 --case sign --case verify
+    python bench/sso.py --check
+
+Before timing anything, the compiled AssertionTemplate is checked against the
+reference builder (`_build_assertion`): both must serialize to the same bytes
+for every combination of group count, attribute set, audience, InResponseTo,
+AuthnInstant and NameID Format. `--check` runs only that;
+tests/test_assertion_template.py asserts the same under pytest.
+
+The app runs against a throwaway data directory: its own SQLite database
+(default users + a bench SP and users with 0/10/100 groups), version files,
+SCIM bootstrap token and app.log, and a random Flask secret key unless
+SECRET_KEY is set, so nothing under data/ or logs/ is read or written. Signing
+uses the IdP key in app/certs (generated on first boot) — compare key types
+with bench/signing_keys.py.
+"""
+import argparse
+import base64
+import copy
+import json
+import os
+import platform
+import secrets
+import sys
+import tempfile
+import time
+import zlib
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+GROUP_COUNTS = (0, 10, 100)
+BENCH_SP = "urn:bench:sso"
+BASE_URL = "https://idp.bench"
+PASSWORD = "Bench-pass-2026"
+ATTR_MAP = [
+    {"claim": "email", "value": "email"},
+    {"claim": "firstName", "value": "first_name"},
+    {"claim": "lastName", "value": "last_name"},
+    {"claim": "groups", "value": "group_names"},
+]
+SELECTED = None  # --case filters; None runs everything
+
+
+def authn_request(force_authn=False):
+    """A realistic SP AuthnRequest (what SmartConsole / a gateway sends)."""
+    now = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+    force = ' ForceAuthn="true"' if force_authn else ""
+    return (
+        '<samlp:AuthnRequest xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol" '
+        'xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion" '
+        f'ID="_bench{time.perf_counter_ns()}" Version="2.0" IssueInstant="{now}"{force} '
+        f'Destination="{BASE_URL}/sso" '
+        'ProtocolBinding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST" '
+        'AssertionConsumerServiceURL="https://sp.bench/saml/acs">'
+        f'<saml:Issuer>{BENCH_SP}</saml:Issuer>'
+        '<samlp:NameIDPolicy Format="urn:oasis:names:tc:SAML:1.1:nameid-format:emailAddress" '
+        'AllowCreate="true"/>'
+        '<samlp:RequestedAuthnContext Comparison="exact">'
+        '<saml:AuthnContextClassRef>'
+        'urn:oasis:names:tc:SAML:2.0:ac:classes:PasswordProtectedTransport'
+        '</saml:AuthnContextClassRef></samlp:RequestedAuthnContext>'
+        '</samlp:AuthnRequest>'
+    ).encode()
+
+
+def redirect_encoded(xml):
+    deflater = zlib.compressobj(9, zlib.DEFLATED, -15)
+    return base64.b64encode(deflater.compress(xml) + deflater.flush()).decode()
+
+
+def user_info(groups):
+    return {
+        "email": "bench.user@cpdemo.ca",
+        "attributes": {
+            "email": ["bench.user@cpdemo.ca"],
+            "firstName": ["Bench"],
+            "lastName": ["User"],
+            "groups": [f"bench-group-{i}" for i in range(groups)],
+        },
+    }
+
+
+def measure(name, fn, seconds, setup=None, **params):
+    """Call fn (with setup()'s result, if given) for ~`seconds` after a short
+    warm-up; only the fn call is timed. None if the case is filtered out."""
+    if SELECTED and not any(c in name for c in SELECTED):
+        return None
+    for _ in range(3):
+        fn(setup()) if setup else fn()
+    samples = []
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline or len(samples) < 5:
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        fn(arg) if setup else fn()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    total = sum(samples)
+
+    def pct(p):
+        return samples[min(len(samples) - 1, int(p / 100 * len(samples)))] * 1000
+
+    return {
+        "case": name,
+        **params,
+        "ops": len(samples),
+        "ops_per_sec": round(len(samples) / total, 1),
+        "p50_ms": round(pct(50), 3),
+        "p99_ms": round(pct(99), 3),
+    }
+
+
+def make_app(data_dir):
+    """The app on a throwaway data directory, seeded with the bench SP and
+    users. Everything create_app and the bench write — the DB, its markers and
+    lock file, the SP registry / AAA directory version files, the SCIM
+    bootstrap token, app.log — lands in `data_dir`. Must run before anything
+    imports `app`: the log directory and secret key are fixed at import."""
+    data_dir = Path(data_dir)
+    os.environ["IDP_LOGS_DIR"] = str(data_dir / "logs")
+    os.environ.setdefault("SECRET_KEY", secrets.token_urlsafe(48))  # not data/.secret-key
+    import app as app_pkg
+    from app.routes.scim import bootstrap
+    from app.utils.aaa_directory import aaa_directory
+    from app.utils.sp_registry import sp_registry
+    app_pkg.PERSIST_DIR = data_dir
+    app_pkg.DB_FILE = data_dir / "bench.db"
+    app_pkg.LEGACY_DB_FILE = data_dir / "legacy.db"  # never migrate ./app.db in
+    sp_registry.version_file = data_dir / ".sp-registry-version"
+    aaa_directory.version_file = data_dir / ".aaa-directory-version"
+    bootstrap.BOOTSTRAP_TOKEN_FILE = data_dir / ".scim-bootstrap-token"
+    app = app_pkg.create_app()
+    app.config["WTF_CSRF_ENABLED"] = False
+    from app.utils.extensions import limiter
+    limiter.enabled = False  # the round trip logs in far more than 30/min
+
+    from app.utils.models import db, ServiceProvider
+    from app.utils.models_scim import ScimGroup, ScimGroupMember
+    from app.utils.sp_registry import sp_registry
+    from app.utils.user_manager import UserManager
+    with app.app_context():
+        db.session.add(ServiceProvider(name="Bench SP", entity_id=BENCH_SP,
+                                       acs_url="https://sp.bench/saml/acs", attr_map=ATTR_MAP))
+        groups = [ScimGroup(display_name=f"bench-group-{i}") for i in range(max(GROUP_COUNTS))]
+        db.session.add_all(groups)
+        db.session.commit()
+        sp_registry.invalidate()
+        for n in GROUP_COUNTS:
+            user = UserManager.create_user(f"bench{n}", PASSWORD, f"bench{n}@cpdemo.ca")
+            db.session.add_all(ScimGroupMember(group_pk=g.id, user_id=user.id) for g in groups[:n])
+        db.session.commit()
+    return app
+
+
+def check_template_equivalence(handler):
+    """Assert that AssertionTemplate.render and _build_assertion agree, byte
+    for byte as serialized, across the claim / request shapes the IdP
+    produces. Returns the number of combinations checked."""
+    from itertools import product
+    from lxml import etree
+    from app.utils.saml import NAMEID_FORMATS
+
+    def serialized(el):
+        return etree.tostring(el)
+
+    attribute_sets = [
+        {},
+        {"email": ["bench.user@cpdemo.ca"]},
+        {"email": ["bench.user@cpdemo.ca"], "firstName": ["Bench"], "lastName": [],
+         "userId": ["0c5e-\u00e9t\u00e9"], "odd & <name>": ["a&b", "<c>", 42]},
+    ]
+    now = datetime(2026, 5, 1, 12, 0, 0)
+    times = (now, now - timedelta(minutes=5), now + timedelta(hours=1))
+    checked = 0
+    for groups, attrs, audience, request_id, authn_instant, nameid_format in product(
+            GROUP_COUNTS, attribute_sets, (BENCH_SP, ""), (None, "_r1"),
+            (None, now - timedelta(minutes=30)), NAMEID_FORMATS):
+        attributes = dict(attrs)
+        if groups or not attrs:
+            attributes["groups"] = [f"bench-group-{i}" for i in range(groups)]
+        info = {"email": "bench.user@cpdemo.ca", "attributes": attributes}
+        reference = handler._build_assertion(
+            info, BASE_URL, audience, "https://sp.bench/saml/acs", "_a1", *times, request_id,
+            authn_instant, nameid_format=nameid_format)
+        # Render twice: the second copy comes from the cached skeleton.
+        for _ in range(2):
+            rendered = handler._assertion_template(
+                BASE_URL, audience, "https://sp.bench/saml/acs", info, request_id, nameid_format,
+            ).render(info, "_a1", *times, request_id, authn_instant)
+            if serialized(rendered) != serialized(reference):
+                raise AssertionError(
+                    f"AssertionTemplate differs from _build_assertion (groups={groups}, "
+                    f"attributes={sorted(attributes)}, audience={audience!r}, "
+                    f"request_id={request_id!r}, nameid_format={nameid_format}):\n"
+                    f"{serialized(reference).decode()}\n{serialized(rendered).decode()}")
+        checked += 1
+    return checked
+
+
+def handler_cases(app, seconds):
+    from lxml import etree
+    from app.routes import metadata
+    from app.utils.saml import IdPHandler, SAML_NS
+
+    handler = IdPHandler()
+    results = []
+    with app.test_request_context(base_url=BASE_URL):
+        xml = authn_request()
+        results.append(measure("parse_request", lambda: handler.parse_request(redirect_encoded(xml)),
+                               seconds, binding="redirect"))
+        posted = base64.b64encode(xml).decode()
+        results.append(measure("parse_request", lambda: handler.parse_request(posted),
+                               seconds, binding="post"))
+
+        now = datetime.utcnow()
+        times = (now, now - timedelta(minutes=5), now + timedelta(hours=1))
+        for groups in GROUP_COUNTS:
+            info = user_info(groups)
+            build_args = (info, BASE_URL, BENCH_SP, "https://sp.bench/saml/acs", "_a1", *times, "_r1")
+            results.append(measure("build_assertion",
+                                   lambda: handler._build_assertion(*build_args),
+                                   seconds, groups=groups))
+            results.append(measure(
+                "assertion_template",
+                lambda: handler._assertion_template(
+                    BASE_URL, BENCH_SP, "https://sp.bench/saml/acs", info, "_r1",
+                ).render(info, "_a1", *times, "_r1"),
+                seconds, groups=groups))
+
+            assertion = handler._build_assertion(*build_args)
+            results.append(measure("sign", handler._sign, seconds,
+                                   setup=lambda: copy.deepcopy(assertion), groups=groups))
+
+            sp_info = {"entity_id": BENCH_SP, "acs_url": "https://sp.bench/saml/acs"}
+            results.append(measure("build_response",
+                                   lambda: handler.build_response(info, sp_info, request_id="_r1"),
+                                   seconds, groups=groups))
+
+            signed = base64.b64decode(handler.build_response(info, sp_info, request_id="_r1"))
+            assert etree.fromstring(signed).find(f"{{{SAML_NS}}}Assertion") is not None
+            results.append(measure("verify_signature", handler.verify_signature, seconds,
+                                   setup=lambda: (handler._verified.clear(), signed)[1],
+                                   groups=groups, cached=False))
+            results.append(measure("verify_signature", lambda: handler.verify_signature(signed),
+                                   seconds, groups=groups, cached=True))
+
+        results.append(measure("get_metadata_xml", lambda _: metadata.get_metadata_xml(), seconds,
+                               setup=metadata._cache.clear, cached=False))
+        results.append(measure("get_metadata_xml", metadata.get_metadata_xml, seconds, cached=True))
+    return results
+
+
+def roundtrip_cases(app, seconds):
+    results = []
+    for groups in GROUP_COUNTS:
+        client = app.test_client()
+        login = {"username": f"bench{groups}", "password": PASSWORD}
+
+        def password_login():
+            # ForceAuthn: the IdP must show the form and check the password.
+            r = client.get("/sso", base_url=BASE_URL,
+                           query_string={"SAMLRequest": redirect_encoded(authn_request(True))})
+            assert r.status_code == 200, r.status_code
+            r = client.post("/login", base_url=BASE_URL, data=login)
+            assert r.status_code == 200 and b"SAMLResponse" in r.data, r.status_code
+
+        def session_sso():
+            # Live IdP session: /sso answers directly, no password hash.
+            r = client.get("/sso", base_url=BASE_URL,
+                           query_string={"SAMLRequest": redirect_encoded(authn_request())})
+            assert r.status_code == 200 and b"SAMLResponse" in r.data, r.status_code
+
+        results.append(measure("sso_login", password_login, seconds, groups=groups))
+        password_login()  # sso_session needs a live IdP session, even if sso_login is filtered out
+        results.append(measure("sso_session", session_sso, seconds, groups=groups))
+    return results
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--seconds", type=float, default=1.0, help="time per case")
+    ap.add_argument("--case", action="append",
+                    help="only cases whose name contains this (repeatable)")
+    ap.add_argument("--json", action="store_true", help="emit JSON instead of a table")
+    ap.add_argument("--check", action="store_true",
+                    help="only check AssertionTemplate against _build_assertion")
+    args = ap.parse_args()
+
+    global SELECTED
+    SELECTED = args.case
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = make_app(tmp)
+        from app.utils.saml import IdPHandler, signing_material
+        with app.test_request_context(base_url=BASE_URL):
+            checked = check_template_equivalence(IdPHandler())
+        if args.check:
+            print(f"AssertionTemplate matches _build_assertion in {checked} combinations")
+            return
+        results = handler_cases(app, args.seconds) + roundtrip_cases(app, args.seconds)
+    results = [r for r in results if r]
+    report = {
+        "meta": {
+            "timestamp": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "key_type": signing_material.current().key_type,
+            "seconds_per_case": args.seconds,
+        },
+        "results": results,
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{'case':<20} {'params':<24} {'ops/s':>10} {'p50 ms':>9} {'p99 ms':>9}")
+    for r in results:
+        params = " ".join(f"{k}={v}" for k, v in r.items()
+                          if k not in ("case", "ops", "ops_per_sec", "p50_ms", "p99_ms"))
+        print(f"{r['case']:<20} {params:<24} {r['ops_per_sec']:>10} {r['p50_ms']:>9} {r['p99_ms']:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,8 +10,19 @@ CERT_PATH = os.getenv("CERT_PATH", "app/certs/idp-cert.pem")
 KEY_PATH = os.getenv("KEY_PATH", "app/certs/idp-key.pem")
 IDP_HOST = os.getenv("IDP_HOST", "localhost")
 
-
-def generate_certificates():
+# Signing key generated on first boot. ECDSA signs far faster than RSA; the
+# IdP picks the matching XML-DSig algorithm from the key (rsa-sha256,
+# ecdsa-sha256, ecdsa-sha384). Only applies when no cert/key exists yet.
+KEY_TYPES = {
+    "rsa-2048": ["-newkey", "rsa:2048"],
+    "rsa-3072": ["-newkey", "rsa:3072"],
+    "ec-p256": ["-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:P-256"],
+    "ec-p384": ["-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:P-384"],
+}
+IDP_KEY_TYPE = os.getenv("IDP_KEY_TYPE", "rsa-2048").strip().lower()
+
+
+def generate_certificates(key_type=None):
     """Generate self-signed certificate if missing"""
     cert = Path(CERT_PATH)
     key = Path(KEY_PATH)
@@ -20,7 +31,12 @@ def generate_certificates():
         print("🔐 Certificate already exists, skipping generation.")
         return
 
-    print("🔐 Generating self-signed certificate...")
+    key_type = key_type or IDP_KEY_TYPE
+    if key_type not in KEY_TYPES:
+        print(f"⚠️  Unknown IDP_KEY_TYPE '{key_type}' — using rsa-2048.")
+        key_type = "rsa-2048"
+
+    print(f"🔐 Generating self-signed certificate ({key_type})...")
     cert.parent.mkdir(parents=True, exist_ok=True)
 
     subprocess.run(
@@ -28,8 +44,7 @@ def generate_certificates():
             "openssl",
             "req",
             "-x509",
-            "-newkey",
-            "rsa:2048",
+            *KEY_TYPES[key_type],
             "-nodes",
             "-keyout",
             str(key),
@@ -70,9 +85,15 @@ def run_server():
             host = os.getenv("IDP_HOST", "0.0.0.0")
             port = os.getenv("IDP_PORT", "5000")
             workers = os.getenv("GUNICORN_WORKERS", "2")
-            procs["web"] = _spawn(
-                ["gunicorn", "--bind", f"{host}:{port}", "--workers", workers,
-                 "--access-logfile", "-", "run:app"], "gunicorn web")
+            # With the SAML signing pool on, a worker must serve other requests
+            # while one waits on the pool: gthread, not the sync worker class.
+            pool_on = int(os.getenv("SIGNING_POOL_SIZE", "0") or 0) > 0
+            threads = int(os.getenv("GUNICORN_THREADS", "8" if pool_on else "1"))
+            cmd = ["gunicorn", "--bind", f"{host}:{port}", "--workers", workers,
+                   "--access-logfile", "-"]
+            if threads > 1:
+                cmd += ["--worker-class", "gthread", "--threads", str(threads)]
+            procs["web"] = _spawn(cmd + ["run:app"], "gunicorn web")
         except ImportError:
             print("⚠️  gunicorn not installed — using the Flask dev server.")
             procs["web"] = _spawn([sys.executable, "run.py"], "flask web")
@@ -0,0 +1,68 @@
+"""Shared fixtures. The app is built once per test session on a throwaway
+data directory (database, version files, SCIM bootstrap token, app.log) with
+a random secret key, so running the suite never touches data/ or logs/."""
+import os
+import secrets
+import tempfile
+from pathlib import Path
+
+import pytest
+
+_DATA_DIR = Path(tempfile.mkdtemp(prefix="idp-tests-"))
+# Both are fixed when `app` is first imported.
+os.environ["IDP_LOGS_DIR"] = str(_DATA_DIR / "logs")
+os.environ.setdefault("SECRET_KEY", secrets.token_urlsafe(48))
+
+DEMO_USER = "demo.user"
+DEMO_PASSWORD = "Cpwins!1@2026"
+
+
+@pytest.fixture(scope="session")
+def app():
+    import app as app_pkg
+    from app.routes.scim import bootstrap
+    from app.utils.aaa_directory import aaa_directory
+    from app.utils.extensions import limiter
+    from app.utils.sp_registry import sp_registry
+    app_pkg.PERSIST_DIR = _DATA_DIR
+    app_pkg.DB_FILE = _DATA_DIR / "test.db"
+    app_pkg.LEGACY_DB_FILE = _DATA_DIR / "legacy.db"
+    sp_registry.version_file = _DATA_DIR / ".sp-registry-version"
+    aaa_directory.version_file = _DATA_DIR / ".aaa-directory-version"
+    bootstrap.BOOTSTRAP_TOKEN_FILE = _DATA_DIR / ".scim-bootstrap-token"
+    app = app_pkg.create_app()
+    app.config["WTF_CSRF_ENABLED"] = False
+    limiter.enabled = False  # the tests log in far more than 30/min
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def admin_client(app):
+    client = app.test_client()
+    with client.session_transaction() as s:
+        s["admin_logged_in"] = True
+    return client
+
+
+@pytest.fixture
+def add_sp(app):
+    """Register a Service Provider: add_sp(entity_id, **columns) -> its id."""
+    from app.utils.models import ServiceProvider, db
+    from app.utils.sp_registry import sp_registry
+
+    def add(entity_id, **columns):
+        columns.setdefault("name", entity_id)
+        columns.setdefault("acs_url", "https://sp.example/acs")
+        columns.setdefault("attr_map", [])
+        with app.app_context():
+            sp = ServiceProvider(entity_id=entity_id, **columns)
+            db.session.add(sp)
+            db.session.commit()
+            sp_registry.invalidate()
+            return sp.id
+    return add
@@ -0,0 +1,2 @@
+"""Local stand-ins for the SP endpoints the IdP calls out to, for the tests
+and for lab use (`python -m tests.support.<module>`)."""
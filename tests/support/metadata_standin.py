@@ -0,0 +1,95 @@
+"""Local HTTP stand-in for an SP's metadata endpoint.
+
+Run as `python -m tests.support.metadata_standin sp-metadata.xml [--port 8099]`
+to serve a metadata file the way a real SP publishes it — with an ETag and
+Last-Modified, answering conditional GETs with 304 — so the admin import and
+the background refresher can be exercised in a lab without the SP. The file
+is re-read when it changes on disk; edit it to simulate a key rollover or a
+moved ACS. `--no-etag` publishes Last-Modified only. `MetadataStandIn` is the
+same server for the tests.
+"""
+import argparse
+import hashlib
+import os
+import threading
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MetadataStandIn:
+    """Serves one metadata file at every path. `hits` counts requests by
+    status (200 / 304); `conditions` lists the (If-None-Match,
+    If-Modified-Since) headers of each request. With etag=False only
+    Last-Modified is published, so clients must fall back to it."""
+
+    def __init__(self, path, host="127.0.0.1", port=0, etag=True):
+        self.path = path
+        self.etag = etag
+        self.hits = {200: 0, 304: 0}
+        self.conditions = []
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body, etag, last_modified = standin._current()
+                if_none_match = self.headers.get("If-None-Match")
+                if_modified_since = self.headers.get("If-Modified-Since")
+                standin.conditions.append((if_none_match, if_modified_since))
+                if ((standin.etag and if_none_match == etag)
+                        or (if_none_match is None and if_modified_since == last_modified)):
+                    standin.hits[304] += 1
+                    self.send_response(304)
+                    if standin.etag:
+                        self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                standin.hits[200] += 1
+                self.send_response(200)
+                self.send_header("Content-Type", "application/samlmetadata+xml")
+                self.send_header("Content-Length", str(len(body)))
+                if standin.etag:
+                    self.send_header("ETag", etag)
+                self.send_header("Last-Modified", last_modified)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.url = f"http://{host}:{self.server.server_address[1]}/metadata"
+
+    def _current(self):
+        with open(self.path, "rb") as f:
+            body = f.read()
+        mtime = os.stat(self.path).st_mtime
+        return (body, '"%s"' % hashlib.sha256(body).hexdigest()[:16],
+                formatdate(mtime, usegmt=True))
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True,
+                         name="metadata-standin").start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("file", help="SP metadata XML to serve")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8099)
+    ap.add_argument("--no-etag", action="store_true", help="publish Last-Modified only")
+    args = ap.parse_args(argv)
+    standin = MetadataStandIn(args.file, args.host, args.port, etag=not args.no_etag)
+    print(f"serving {args.file} at {standin.url}", flush=True)
+    try:
+        standin.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""Local HTTP stand-in for an SP's SingleLogoutService.
+
+Run it as `python -m tests.support.slo_standin [--port 8098] [--delay 0]` to
+give a lab SP a logout endpoint. It accepts LogoutRequests over SOAP (a
+LogoutResponse comes back in the HTTP answer), HTTP-POST (a form) and
+HTTP-Redirect (a query string), and logs each NameID / SessionIndex it
+receives. Use `--delay` to make it answer slowly, which exercises the IdP's
+per-SP SLO_TIMEOUT, and `--status` to make it refuse. `SLOStandIn` is the
+same server for the tests; `received` lists what it was sent.
+"""
+import argparse
+import base64
+import threading
+import time
+import uuid
+import zlib
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from lxml import etree
+
+SAML_NS = "urn:oasis:names:tc:SAML:2.0:assertion"
+SAMLP_NS = "urn:oasis:names:tc:SAML:2.0:protocol"
+SOAP_NS = "http://schemas.xmlsoap.org/soap/envelope/"
+STATUS_SUCCESS = "urn:oasis:names:tc:SAML:2.0:status:Success"
+
+_PARSER = etree.XMLParser(resolve_entities=False, no_network=True, load_dtd=False)
+
+
+def _logout_request(xml_bytes):
+    root = etree.fromstring(xml_bytes, parser=_PARSER)
+    if root.tag == f"{{{SOAP_NS}}}Envelope":
+        root = root.find(f"{{{SOAP_NS}}}Body/{{{SAMLP_NS}}}LogoutRequest")
+    if root is None or root.tag != f"{{{SAMLP_NS}}}LogoutRequest":
+        raise ValueError("no LogoutRequest")
+    name_id = root.find(f"{{{SAML_NS}}}NameID")
+    return {
+        "id": root.get("ID"),
+        "issuer": root.findtext(f"{{{SAML_NS}}}Issuer"),
+        "name_id": name_id.text if name_id is not None else None,
+        "session_indexes": [el.text for el in root.findall(f"{{{SAMLP_NS}}}SessionIndex")],
+        "signed": root.find("{http://www.w3.org/2000/09/xmldsig#}Signature") is not None,
+    }
+
+
+class SLOStandIn:
+    """A SingleLogoutService on every path. `received` collects one dict per
+    LogoutRequest (id, issuer, name_id, session_indexes, signed, binding)."""
+
+    def __init__(self, host="127.0.0.1", port=0, delay=0.0, status=STATUS_SUCCESS,
+                 entity_id="urn:slo-standin", log=None):
+        self.delay = delay
+        self.log = log
+        self.status = status
+        self.entity_id = entity_id
+        self.received = []
+        self._lock = threading.Lock()
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = parse_qs(urlsplit(self.path).query)
+                if "SAMLRequest" not in query:
+                    return self._answer(400, b"missing SAMLRequest")
+                xml = zlib.decompress(base64.b64decode(query["SAMLRequest"][0]), -15)
+                self._handle(xml, "redirect", query_signed="Signature" in query)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if self.headers.get("Content-Type", "").startswith("text/xml"):
+                    return self._handle(body, "soap")
+                form = parse_qs(body.decode("ascii", "replace"))
+                if "SAMLRequest" not in form:
+                    return self._answer(400, b"missing SAMLRequest")
+                self._handle(base64.b64decode(form["SAMLRequest"][0]), "post")
+
+            def _handle(self, xml, binding, query_signed=False):
+                try:
+                    message = _logout_request(xml)
+                except Exception as e:
+                    return self._answer(400, str(e).encode())
+                message["binding"] = binding
+                message["signed"] = message["signed"] or query_signed
+                with standin._lock:
+                    standin.received.append(message)
+                if standin.log:
+                    standin.log(message)
+                if standin.delay:
+                    time.sleep(standin.delay)
+                if binding == "soap":
+                    return self._answer(200, standin._soap_response(message["id"]), "text/xml")
+                ok = standin.status == STATUS_SUCCESS
+                self._answer(200 if ok else 500, b"logged out" if ok else b"logout refused")
+
+            def _answer(self, code, body, content_type="text/plain"):
+                try:
+                    self.send_response(code)
+                    self.send_header("Content-Type", content_type)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the IdP gave up waiting (SLO_TIMEOUT)
+
+            def log_message(self, fmt, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.url = f"http://{host}:{self.server.server_address[1]}/slo"
+
+    def _soap_response(self, in_response_to):
+        now = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        return (
+            f'<soap:Envelope xmlns:soap="{SOAP_NS}"><soap:Body>'
+            f'<samlp:LogoutResponse xmlns:samlp="{SAMLP_NS}" xmlns:saml="{SAML_NS}" '
+            f'ID="_{uuid.uuid4().hex}" Version="2.0" IssueInstant="{now}" '
+            f'InResponseTo="{in_response_to}"><saml:Issuer>{self.entity_id}</saml:Issuer>'
+            f'<samlp:Status><samlp:StatusCode Value="{self.status}"/></samlp:Status>'
+            f'</samlp:LogoutResponse></soap:Body></soap:Envelope>'
+        ).encode()
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True,
+                         name="slo-standin").start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8098)
+    ap.add_argument("--delay", type=float, default=0.0, help="seconds to wait before answering")
+    ap.add_argument("--status", default=STATUS_SUCCESS, help="LogoutResponse status to answer with")
+    args = ap.parse_args(argv)
+    standin = SLOStandIn(args.host, args.port, args.delay, args.status,
+                         log=lambda m: print(m, flush=True))
+    print(f"SingleLogoutService at {standin.url}", flush=True)
+    try:
+        standin.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
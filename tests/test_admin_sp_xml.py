@@ -0,0 +1,20 @@
+"""The SP metadata the admin portal generates advertises the NameID Format
+the IdP actually issues that SP."""
+import uuid
+
+import pytest
+
+EMAIL = "urn:oasis:names:tc:SAML:1.1:nameid-format:emailAddress"
+UNSPECIFIED = "urn:oasis:names:tc:SAML:1.1:nameid-format:unspecified"
+PERSISTENT = "urn:oasis:names:tc:SAML:2.0:nameid-format:persistent"
+
+
+@pytest.mark.parametrize("stored, issued", [
+    (None, EMAIL),
+    (UNSPECIFIED, UNSPECIFIED),
+    (PERSISTENT, EMAIL),  # not issuable: the IdP falls back to emailAddress
+])
+def test_sp_xml_advertises_the_issued_nameid_format(admin_client, add_sp, stored, issued):
+    sp_id = add_sp(f"urn:test:xml:{uuid.uuid4().hex[:8]}", nameid_format=stored)
+    xml = admin_client.get(f"/admin/api/service-providers/{sp_id}/xml").get_data(as_text=True)
+    assert f"<md:NameIDFormat>{issued}</md:NameIDFormat>" in xml
@@ -0,0 +1,62 @@
+"""The compiled AssertionTemplate must serialize to exactly the bytes the
+reference builder (`IdPHandler._build_assertion`) produces, for every SP and
+claim shape — the signature covers whatever the template emits."""
+from datetime import datetime, timedelta
+from itertools import product
+
+import pytest
+from lxml import etree
+
+from app.utils.saml import NAMEID_FORMATS, IdPHandler
+
+ISSUER = "https://idp.test"
+ACS_URL = "https://sp.test/saml/acs"
+NOW = datetime(2026, 5, 1, 12, 0, 0)
+TIMES = (NOW, NOW - timedelta(minutes=5), NOW + timedelta(hours=1))
+
+ATTRIBUTE_SETS = {
+    "none": {},
+    "email": {"email": ["test.user@cpdemo.ca"]},
+    "groups": {"email": ["test.user@cpdemo.ca"],
+               "groups": [f"group-{i}" for i in range(100)]},
+    "mixed": {"email": ["test.user@cpdemo.ca"], "firstName": ["Test"], "lastName": [],
+              "userId": ["0c5e-été"], "odd & <name>": ["a&b", "<c>", 42],
+              "groups": []},
+}
+
+
+@pytest.fixture(scope="module")
+def handler(app):
+    with app.app_context():
+        yield IdPHandler()
+
+
+@pytest.mark.parametrize(
+    "attributes, audience, request_id, authn_instant, nameid_format",
+    list(product(ATTRIBUTE_SETS, ("urn:test:sp", ""), (None, "_req1"),
+                 (None, NOW - timedelta(minutes=30)), NAMEID_FORMATS)))
+def test_template_matches_the_reference_builder(handler, attributes, audience, request_id,
+                                                authn_instant, nameid_format):
+    info = {"email": "test.user@cpdemo.ca", "attributes": ATTRIBUTE_SETS[attributes]}
+    reference = etree.tostring(handler._build_assertion(
+        info, ISSUER, audience, ACS_URL, "_a1", *TIMES, request_id, authn_instant,
+        nameid_format=nameid_format))
+    # The second render starts from the cached skeleton.
+    for _ in range(2):
+        template = handler._assertion_template(ISSUER, audience, ACS_URL, info, request_id,
+                                               nameid_format)
+        rendered = template.render(info, "_a1", *TIMES, request_id, authn_instant)
+        assert etree.tostring(rendered) == reference
+
+
+def test_template_is_shared_across_users(handler):
+    """Users of one SP shape share a skeleton; rendering one user must not
+    leak into the next."""
+    first = {"email": "a@cpdemo.ca", "attributes": {"groups": ["g1", "g2"]}}
+    second = {"email": "b@cpdemo.ca", "attributes": {"groups": []}}
+    template = handler._assertion_template(ISSUER, "urn:test:sp", ACS_URL, first, None)
+    assert handler._assertion_template(ISSUER, "urn:test:sp", ACS_URL, second, None) is template
+    template.render(first, "_a1", *TIMES, None)
+    rendered = template.render(second, "_a2", *TIMES, None)
+    assert etree.tostring(rendered) == etree.tostring(handler._build_assertion(
+        second, ISSUER, "urn:test:sp", ACS_URL, "_a2", *TIMES, None))
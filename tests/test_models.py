@@ -0,0 +1,12 @@
+import pytest
+
+from app.utils.models import DEFAULT_SIGNING_SCOPE, default_signing_scope
+
+
+@pytest.mark.parametrize("want_assertions_signed, scope", [
+    (True, "assertion"),
+    (False, "response"),
+    (None, DEFAULT_SIGNING_SCOPE),
+])
+def test_default_signing_scope_follows_want_assertions_signed(want_assertions_signed, scope):
+    assert default_signing_scope(want_assertions_signed) == scope
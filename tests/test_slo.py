@@ -0,0 +1,147 @@
+"""Single Logout fan-out: every other participant is notified in parallel,
+each within SLO_TIMEOUT, and one that is slow or refuses turns the answer to
+the initiating SP into a PartialLogout."""
+import base64
+import time
+import uuid
+import zlib
+from datetime import datetime
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+from tests.conftest import DEMO_PASSWORD, DEMO_USER
+from tests.support.slo_standin import SLOStandIn
+
+SLO_TIMEOUT = 0.5
+STATUS_RESPONDER = "urn:oasis:names:tc:SAML:2.0:status:Responder"
+
+
+def _deflate(xml):
+    deflater = zlib.compressobj(9, zlib.DEFLATED, -15)
+    return base64.b64encode(deflater.compress(xml.encode()) + deflater.flush()).decode()
+
+
+def _now():
+    return datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def authn_request(issuer):
+    return _deflate(
+        '<samlp:AuthnRequest xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol" '
+        'xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion" '
+        f'ID="_{uuid.uuid4().hex}" Version="2.0" IssueInstant="{_now()}">'
+        f'<saml:Issuer>{issuer}</saml:Issuer></samlp:AuthnRequest>')
+
+
+def logout_request(issuer, name_id, request_id):
+    return _deflate(
+        '<samlp:LogoutRequest xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol" '
+        'xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion" '
+        f'ID="{request_id}" Version="2.0" IssueInstant="{_now()}">'
+        f'<saml:Issuer>{issuer}</saml:Issuer><saml:NameID>{name_id}</saml:NameID>'
+        '</samlp:LogoutRequest>')
+
+
+@pytest.fixture
+def standins():
+    """Three SingleLogoutServices: one answers at once, one after twice
+    SLO_TIMEOUT, one refuses the logout."""
+    running = {
+        "ok": SLOStandIn().start(),
+        "slow": SLOStandIn(delay=SLO_TIMEOUT * 2).start(),
+        "refuses": SLOStandIn(status=STATUS_RESPONDER).start(),
+    }
+    yield running
+    for standin in running.values():
+        standin.stop()
+
+
+@pytest.fixture
+def slo_timeout(monkeypatch):
+    from app.utils.config_manager import config_manager
+    monkeypatch.setattr(config_manager, "SLO_TIMEOUT", SLO_TIMEOUT)
+
+
+def sign_in_everywhere(client, entity_ids):
+    """Log the demo user in at the first SP, then SSO to the rest on the
+    IdP session. Returns the user's email (the NameID sent)."""
+    client.get("/sso", query_string={"SAMLRequest": authn_request(entity_ids[0])})
+    r = client.post("/login", data={"username": DEMO_USER, "password": DEMO_PASSWORD})
+    assert b"SAMLResponse" in r.data
+    for entity_id in entity_ids[1:]:
+        r = client.get("/sso", query_string={"SAMLRequest": authn_request(entity_id)})
+        assert b"SAMLResponse" in r.data
+    from app.utils.models import User
+    with client.application.app_context():
+        return User.query.filter_by(username=DEMO_USER).one().email
+
+
+def test_sp_initiated_logout_is_partial_when_a_participant_fails(
+        client, add_sp, standins, slo_timeout):
+    prefix = f"urn:test:slo:{uuid.uuid4().hex[:8]}"
+    add_sp(f"{prefix}:init", slo_url="https://init.example/slo", slo_binding="redirect")
+    add_sp(f"{prefix}:ok", slo_url=standins["ok"].url, slo_binding="soap")
+    add_sp(f"{prefix}:slow", slo_url=standins["slow"].url, slo_binding="post")
+    add_sp(f"{prefix}:refuses", slo_url=standins["refuses"].url, slo_binding="soap")
+    email = sign_in_everywhere(client, [f"{prefix}:{n}" for n in ("init", "ok", "slow", "refuses")])
+
+    started = time.perf_counter()
+    r = client.get("/slo", query_string={
+        "SAMLRequest": logout_request(f"{prefix}:init", email, "_lr1"), "RelayState": "rs"})
+    elapsed = time.perf_counter() - started
+
+    # The slow SP costs its own timeout, not its delay.
+    assert elapsed < SLO_TIMEOUT * 2
+    assert r.status_code == 302
+    location = urlsplit(r.headers["Location"])
+    assert location.netloc == "init.example"
+    query = parse_qs(location.query)
+    response = zlib.decompress(base64.b64decode(query["SAMLResponse"][0]), -15).decode()
+    assert 'InResponseTo="_lr1"' in response
+    assert "status:PartialLogout" in response
+    assert query["RelayState"] == ["rs"]
+
+    for name, binding in (("ok", "soap"), ("slow", "post"), ("refuses", "soap")):
+        received = standins[name].received
+        assert [m["binding"] for m in received] == [binding]
+        assert received[0]["name_id"] == email and received[0]["signed"]
+    # The IdP session is over: the next AuthnRequest asks for a password.
+    r = client.get("/sso", query_string={"SAMLRequest": authn_request(f"{prefix}:ok")})
+    assert b'name="password"' in r.data
+
+
+def test_logout_reports_each_participant(app, client, add_sp, standins, slo_timeout):
+    prefix = f"urn:test:slo:{uuid.uuid4().hex[:8]}"
+    add_sp(f"{prefix}:ok", slo_url=standins["ok"].url, slo_binding="soap")
+    add_sp(f"{prefix}:slow", slo_url=standins["slow"].url, slo_binding="redirect")
+    add_sp(f"{prefix}:refuses", slo_url=standins["refuses"].url, slo_binding="soap")
+    add_sp(f"{prefix}:no-slo")
+    sign_in_everywhere(client, [f"{prefix}:{n}" for n in ("ok", "slow", "refuses", "no-slo")])
+
+    from app.utils import slo
+    from app.utils.models import SessionParticipant
+    with app.test_request_context():
+        sid = SessionParticipant.query.filter_by(sp_entity_id=f"{prefix}:ok").one().session_id
+        results = {r.sp.rsplit(":", 1)[1]: r for r in slo.logout(sid)}
+        assert slo.participants(sid) == []
+
+    assert {name: r.status for name, r in results.items()} == {
+        "ok": "ok", "slow": "timeout", "refuses": "failed", "no-slo": "skipped"}
+    assert results["refuses"].detail == STATUS_RESPONDER
+    assert results["slow"].ms <= SLO_TIMEOUT * 1000 * 1.5
+
+
+def test_sp_initiated_logout_succeeds_when_every_participant_does(
+        client, add_sp, standins, slo_timeout):
+    prefix = f"urn:test:slo:{uuid.uuid4().hex[:8]}"
+    add_sp(f"{prefix}:init", slo_url="https://init.example/slo", slo_binding="redirect")
+    add_sp(f"{prefix}:ok", slo_url=standins["ok"].url, slo_binding="soap")
+    email = sign_in_everywhere(client, [f"{prefix}:init", f"{prefix}:ok"])
+
+    r = client.get("/slo", query_string={
+        "SAMLRequest": logout_request(f"{prefix}:init", email, "_lr2")})
+    query = parse_qs(urlsplit(r.headers["Location"]).query)
+    response = zlib.decompress(base64.b64decode(query["SAMLResponse"][0]), -15).decode()
+    assert "status:Success" in response and "PartialLogout" not in response
+    assert len(standins["ok"].received) == 1
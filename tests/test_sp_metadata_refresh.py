@@ -0,0 +1,208 @@
+"""SP metadata from a URL: the admin import, the refresher's schedule, and the
+conditional GETs (ETag / If-Modified-Since) it sends to the SP."""
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from sqlalchemy import event
+
+from tests.support.metadata_standin import MetadataStandIn
+
+
+def _cert():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "sp")])
+    now = datetime.utcnow()
+    cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name)
+            .public_key(key.public_key()).serial_number(1)
+            .not_valid_before(now).not_valid_after(now + timedelta(days=1))
+            .sign(key, hashes.SHA256()))
+    pem = cert.public_bytes(serialization.Encoding.PEM).decode()
+    return "".join(line for line in pem.splitlines() if "-----" not in line)
+
+
+CERT_A, CERT_B = _cert(), _cert()
+
+
+def metadata(entity_id, acs_url, certs=(CERT_A,), cache_duration="PT1H"):
+    keys = "".join(
+        '<md:KeyDescriptor use="signing"><ds:KeyInfo><ds:X509Data>'
+        f'<ds:X509Certificate>{c}</ds:X509Certificate>'
+        '</ds:X509Data></ds:KeyInfo></md:KeyDescriptor>' for c in certs)
+    return (
+        '<md:EntityDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata" '
+        'xmlns:ds="http://www.w3.org/2000/09/xmldsig#" '
+        f'entityID="{entity_id}" cacheDuration="{cache_duration}">'
+        '<md:SPSSODescriptor AuthnRequestsSigned="true" WantAssertionsSigned="false" '
+        'protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">'
+        f'{keys}'
+        '<md:AssertionConsumerService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST" '
+        f'Location="{acs_url}" index="0"/>'
+        '</md:SPSSODescriptor></md:EntityDescriptor>'
+    )
+
+
+@pytest.fixture
+def published(tmp_path):
+    """publish(entity_id, acs_url, etag=True) -> a running MetadataStandIn
+    serving that SP's metadata from a file the test can rewrite."""
+    standins = []
+
+    def publish(entity_id, acs_url, etag=True):
+        path = tmp_path / f"{len(standins)}.xml"
+        path.write_text(metadata(entity_id, acs_url))
+        standin = MetadataStandIn(str(path), etag=etag).start()
+        standins.append(standin)
+        return standin
+    yield publish
+    for standin in standins:
+        standin.stop()
+
+
+def republish(standin, text):
+    """Rewrite the served file and move its mtime on, so Last-Modified changes
+    even within the same second."""
+    stat = os.stat(standin.path)
+    with open(standin.path, "w") as f:
+        f.write(text)
+    os.utime(standin.path, (stat.st_atime, stat.st_mtime + 60))
+
+
+def import_from(admin_client, app, url):
+    r = admin_client.post("/admin/service-providers/import",
+                          data={"metadata_url": url, "auto_refresh": "on"})
+    assert r.status_code == 302
+    from app.utils.models import ServiceProvider
+    with app.app_context():
+        return ServiceProvider.query.filter_by(metadata_url=url).one().id
+
+
+@pytest.fixture
+def sp_writes(app):
+    """SQL UPDATE / INSERT statements against service_provider, as run."""
+    from app.utils.models import db
+    statements = []
+
+    def listen(conn, cursor, statement, *args):
+        if (statement.lstrip().upper().startswith(("UPDATE", "INSERT"))
+                and "service_provider" in statement):
+            statements.append(statement)
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", listen)
+    yield statements
+    event.remove(engine, "before_cursor_execute", listen)
+
+
+def test_url_import_keeps_the_validators(app, admin_client, published):
+    standin = published("urn:test:md:import", "https://sp.example/acs")
+    sp_id = import_from(admin_client, app, standin.url)
+
+    from app.utils.models import ServiceProvider
+    from app.utils.sp_registry import sp_registry
+    with app.app_context():
+        sp = ServiceProvider.query.get(sp_id)
+        assert sp.entity_id == "urn:test:md:import"
+        assert sp.acs_url == "https://sp.example/acs"
+        assert sp.authn_requests_signed and sp.signing_cert.count("BEGIN") == 1
+        assert sp.signing_scope == "response"  # WantAssertionsSigned="false"
+        assert sp.metadata_etag and sp.metadata_last_modified
+        assert sp_registry.by_entity_id("urn:test:md:import") is not None
+    assert standin.hits == {200: 1, 304: 0}
+    assert standin.conditions == [(None, None)]
+
+
+def test_unchanged_metadata_is_a_304_and_no_write(app, admin_client, published, sp_writes):
+    standin = published("urn:test:md:etag", "https://sp.example/acs")
+    sp_id = import_from(admin_client, app, standin.url)
+
+    from app.utils.models import ServiceProvider
+    from app.utils.sp_metadata import refresh_sp
+    with app.app_context():
+        sp = ServiceProvider.query.get(sp_id)
+        del sp_writes[:]
+        assert refresh_sp(sp)[0] == "not-modified"
+        assert standin.conditions[-1] == (sp.metadata_etag, sp.metadata_last_modified)
+        assert standin.hits[304] == 1
+        # Forced: a full 200, but the digest matches, so still no write.
+        assert refresh_sp(sp, force=True)[0] == "unchanged"
+        assert standin.conditions[-1] == (None, None)
+    assert sp_writes == []
+
+
+def test_changed_metadata_is_applied(app, admin_client, published):
+    standin = published("urn:test:md:rollover", "https://sp.example/acs")
+    sp_id = import_from(admin_client, app, standin.url)
+    republish(standin, metadata("urn:test:md:rollover", "https://sp.example/acs2",
+                                certs=(CERT_A, CERT_B)))
+
+    from app.utils.models import ServiceProvider
+    from app.utils.sp_metadata import refresh_sp
+    from app.utils.sp_registry import sp_registry
+    with app.app_context():
+        sp = ServiceProvider.query.get(sp_id)
+        old_etag = sp.metadata_etag
+        assert refresh_sp(sp)[0] == "updated"
+        assert sp.metadata_etag != old_etag
+        assert sp.signing_cert.count("BEGIN") == 2
+        # The next conditional GET uses the new validators.
+        assert refresh_sp(sp)[0] == "not-modified"
+        assert standin.conditions[-1][0] == sp.metadata_etag
+        assert sp_registry.by_entity_id("urn:test:md:rollover").acs_url == "https://sp.example/acs2"
+
+
+def test_if_modified_since_without_an_etag(app, admin_client, published):
+    standin = published("urn:test:md:lastmod", "https://sp.example/acs", etag=False)
+    sp_id = import_from(admin_client, app, standin.url)
+
+    from app.utils.models import ServiceProvider
+    from app.utils.sp_metadata import refresh_sp
+    with app.app_context():
+        sp = ServiceProvider.query.get(sp_id)
+        assert sp.metadata_etag is None and sp.metadata_last_modified
+        assert refresh_sp(sp)[0] == "not-modified"
+        assert standin.conditions[-1] == (None, sp.metadata_last_modified)
+
+        republish(standin, metadata("urn:test:md:lastmod", "https://sp.example/moved"))
+        assert refresh_sp(sp)[0] == "updated"
+        assert sp.acs_url == "https://sp.example/moved"
+
+
+def test_metadata_for_another_entity_is_refused(app, admin_client, published):
+    standin = published("urn:test:md:entity", "https://sp.example/acs")
+    sp_id = import_from(admin_client, app, standin.url)
+    republish(standin, metadata("urn:test:md:someone-else", "https://evil.example/acs"))
+
+    from app.utils.models import ServiceProvider, db
+    from app.utils.sp_metadata import SPMetadataError, refresh_sp
+    with app.app_context():
+        with pytest.raises(SPMetadataError):
+            refresh_sp(ServiceProvider.query.get(sp_id))
+        db.session.rollback()
+        assert ServiceProvider.query.get(sp_id).acs_url == "https://sp.example/acs"
+
+
+def test_refresher_fetches_each_sp_when_due(app, admin_client, published):
+    from app.services import metadata_refresher
+    from app.utils.models import ServiceProvider
+    from app.utils.sp_metadata import refresh_interval
+    standin = published("urn:test:md:schedule", "https://sp.example/acs")
+    sp_id = import_from(admin_client, app, standin.url)
+
+    with app.app_context():
+        sps = ServiceProvider.query.filter(ServiceProvider.metadata_url.isnot(None)).count()
+        start = 10 ** 9
+        metadata_refresher.run_once(now=start)
+        # Every SP is first due within the startup stagger.
+        due = start + sps * metadata_refresher.STARTUP_STAGGER_SECONDS
+        assert metadata_refresher.run_once(now=due)[sp_id] == "not-modified"
+        assert sp_id not in metadata_refresher.run_once(now=due + 1)
+        # A 304 carries no cacheDuration, so the default interval applies.
+        interval = refresh_interval()
+        assert sp_id not in metadata_refresher.run_once(now=due + interval - 1)
+        assert metadata_refresher.run_once(now=due + interval)[sp_id] == "not-modified"
+    assert standin.hits[304] == 2
@@ -0,0 +1,34 @@
+import threading
+
+from app.utils.metrics import Counters
+from app.utils.version_file import bump_version, version_stamp
+
+
+def test_each_bump_changes_the_stamp(tmp_path):
+    path = tmp_path / ".version"
+    assert version_stamp(path) is None
+    stamps = set()
+    for _ in range(3):
+        bump_version(path, "test")
+        stamps.add(version_stamp(path))
+    assert None not in stamps and len(stamps) == 3
+
+
+def test_bump_on_a_read_only_volume_is_not_fatal(tmp_path):
+    bump_version(tmp_path / "missing-dir" / ".version", "test")
+
+
+def test_counters_from_many_threads():
+    counters = Counters("hits", "peak")
+
+    def work():
+        for i in range(1000):
+            counters.count("hits")
+            counters.peak("peak", i)
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    counters.add(hits=2)
+    assert counters.snapshot() == {"hits": 8002, "peak": 999}